@@ -1,5 +1,6 @@
 #!/usr/bin/python
 
+import io
 from time import time
 
 import storable
@@ -14,10 +15,10 @@ def timethese(nr, methods):
             method()
         end = time()
         print(
-            '%(abbr)15s : %(timing)7.2f wallclock secs @ %(speed).02f/s (n=%(nr)d)'
+            '%(abbr)15s : %(timing)7.2f wallclock secs @ %(speed)8.3f ms/it (n=%(nr)d)'
             % {'abbr': k,
                'timing': (end - start),
-               'speed': (end - start) / nr,
+               'speed': (end - start) * 1000 / nr,
                'nr': nr}
         )
 
@@ -40,9 +41,90 @@ def run():
         'small_nfreeze': lambda: storable.thaw(small_data_nfreeze),
         'small_freeze': lambda: storable.thaw(small_data_freeze),
         'large_nfreeze': lambda: storable.thaw(large_data_nfreeze),
-        'large_freeze': lambda: storable.thaw(large_data_freeze)
+        'large_freeze': lambda: storable.thaw(large_data_freeze),
+        'large_fh': lambda: storable.deserialize(
+            io.BytesIO(large_data_nfreeze)),
+        'small_many': lambda: storable.thaw_many([small_data_nfreeze] * 100),
     })
 
+def scaling():
+    from multiprocessing import Pool
+    from struct import pack
+    from storable.parallel import thaw_parallel, thaw_split
+
+    with open("tests/large_simple01_nfreeze.storable", "rb") as fh:
+        blobs = [fh.read()] * 16
+
+    print('Scaling: thaw_parallel() of {} blobs of {} bytes'.format(
+        len(blobs), len(blobs[0])))
+    start = time()
+    storable.thaw_many(blobs)
+    serial = time() - start
+    print('%15s : %7.2f wallclock secs' % ('in-process', serial))
+    for workers in (1, 2, 4, 8):
+        with Pool(workers) as pool:
+            start = time()
+            thaw_parallel(blobs, pool=pool)
+            end = time()
+        print('%(abbr)15s : %(timing)7.2f wallclock secs @ %(speedup)5.2fx'
+              % {'abbr': '%d workers' % workers,
+                 'timing': end - start,
+                 'speedup': serial / (end - start)})
+
+    big = b''.join([blobs[0][:2], b'\x02', pack('!I', len(blobs))]
+                   + [blob[2:] for blob in blobs])
+    print('Scaling: thaw_split() of an array of {} bytes'.format(len(big)))
+    start = time()
+    storable.thaw(big)
+    serial = time() - start
+    print('%15s : %7.2f wallclock secs' % ('in-process', serial))
+    for workers in (2, 4, 8):
+        with Pool(workers) as pool:
+            start = time()
+            thaw_split(big, pool=pool)
+            end = time()
+        print('%(abbr)15s : %(timing)7.2f wallclock secs @ %(speedup)5.2fx'
+              % {'abbr': '%d workers' % workers,
+                 'timing': end - start,
+                 'speedup': serial / (end - start)})
+
+
+def scalar_policies():
+    from struct import pack
+
+    words = [b'hostname', b'12345', b'-3.25', b'some longer text value', b'0']
+    count = 100000
+    items = []
+    for i in range(count):
+        word = words[i % len(words)]
+        items.append(b'\x0a' + pack('B', len(word)) + word)
+    frozen = b'\x05\x0b\x02' + pack('!I', count) + b''.join(items)
+
+    print('Scalar policies: cost per scalar of {} mixed scalars'.format(count))
+    for policy in ('legacy', 'numeric', 'str', 'raw'):
+        decoder = storable.Decoder(scalars=policy)
+        best = None
+        for i in range(10):
+            start = time()
+            decoder.decode(frozen)
+            elapsed = time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print('%(abbr)15s : %(speed)8.1f ns/scalar'
+              % {'abbr': policy, 'speed': best * 1e9 / count})
+
+
+def freezing():
+    print('Freeze: time per key of a flat hash')
+    for count in (10000, 100000, 1000000):
+        data = dict(('key%d' % i, i) for i in range(count))
+        start = time()
+        storable.freeze(data)
+        elapsed = time() - start
+        print('%(abbr)15s : %(timing)7.2f wallclock secs @ %(speed)8.1f ns/key'
+              % {'abbr': '%d keys' % count, 'timing': elapsed,
+                 'speed': elapsed * 1e9 / count})
+
+
 #import cProfile
 #cProfile.run('run()')
 # import threading
@@ -55,4 +137,8 @@ def run():
 #
 # for t in tl:
 #     t.join()
-run()
+if __name__ == '__main__':
+    run()
+    scalar_policies()
+    freezing()
+    scaling()
@@ -26,4 +26,13 @@
 #
 
 __version__ = '1.2.4'
-from .core import thaw, retrieve, deserialize, freeze
+from .core import (thaw, thaw_many, Decoder, ScalarCache, retrieve,
+                   deserialize, freeze, freeze_into, store, nstore,
+                   store_fd, nstore_fd, register_encoder)
+from .lazy import LazyArray, LazyHash
+from .paths import get_path
+from .events import iterparse
+from .index import build_index
+from .records import RecordIndex, RecordWriter, iter_records
+from .push import PushDecoder
+from .columns import thaw_columns, iter_columns, retrieve_columns
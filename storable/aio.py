@@ -0,0 +1,133 @@
+#
+# License
+#
+# python storable is distributed under the zlib/libpng license, which is OSS
+# (Open Source Software) compliant.
+#
+# Copyright (C) 2009 Tim Aerts
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Tim Aerts <aardbeiplantje@gmail.com>
+#
+
+
+"""
+Decoding storables inside an asyncio event loop.
+
+:func:`read_storable` and :func:`read_storables` read storables from
+:class:`asyncio.StreamReader` objects, e.g. the frames a Perl daemon sends
+over TCP, on top of :class:`~storable.push.PushDecoder`. Waiting for a slow
+peer only suspends the coroutine, it does not block the event loop or need
+a thread.
+
+:func:`thaw_async` decodes a storable that is already in memory in short
+slices, so that other tasks keep running while a large one is decoded.
+"""
+
+import asyncio
+from time import perf_counter
+
+from .core import _PAUSED, _cached_header, process_item, thaw
+from .events import CHUNK_SIZE
+from .push import PushDecoder
+
+
+# Storables of at least this many bytes are decoded by the executor given to
+# thaw_async(), if any.
+EXECUTOR_THRESHOLD = 1024 * 1024
+
+# number of items decoded in the first slice, later slices are sized from
+# the time that took
+_FIRST_SLICE = 1000
+
+
+async def read_storable(reader):
+    """
+    Reads one storable from *reader* and returns it decoded. Exactly the
+    bytes of the storable are read, so *reader* can be used for anything
+    that follows. Each read asks for :attr:`PushDecoder.needed
+    <storable.push.PushDecoder.needed>` bytes, so the elements of a large
+    array or hash are read in a few steps, but small nested items can cost
+    a read each; :func:`read_storables` reads in whole chunks when nothing
+    else follows on the stream. Raises EOFError if the stream ends before the storable
+    starts and ValueError if it ends in the middle of it.
+    """
+    decoder = PushDecoder()
+    while True:
+        try:
+            chunk = await reader.readexactly(decoder.needed)
+        except asyncio.IncompleteReadError as error:
+            decoder.feed(error.partial)
+            decoder.close()
+            raise EOFError('No storable left to read')
+        results = decoder.feed(chunk)
+        if results:
+            return results[0]
+
+
+async def read_storables(reader, chunk_size=CHUNK_SIZE):
+    """
+    Yields the back-to-back storables read from *reader* until the end of
+    the stream, decoded. The stream is read in chunks of up to
+    *chunk_size* bytes. Raises ValueError if it ends in the middle of a
+    storable.
+    """
+    decoder = PushDecoder()
+    while True:
+        chunk = await reader.read(chunk_size)
+        if not chunk:
+            decoder.close()
+            return
+        for result in decoder.feed(chunk):
+            yield result
+
+
+async def thaw_async(frozen_data, slice_ms=5, executor=None,
+                     executor_threshold=EXECUTOR_THRESHOLD):
+    """
+    Decodes the ``freeze``/``nfreeze`` output *frozen_data* like
+    :func:`storable.thaw`, in slices of about *slice_ms* milliseconds with
+    the event loop running other tasks in between.
+
+    With *executor* (a :class:`concurrent.futures.Executor`), storables of
+    at least *executor_threshold* bytes are decoded by the executor
+    instead. A thread pool still holds the GIL while decoding, so a
+    process pool is what really takes the work off the loop's process, at
+    the cost of pickling the result back.
+    """
+    if executor is not None and len(frozen_data) >= executor_threshold:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, thaw, frozen_data)
+
+    buf = memoryview(frozen_data)
+    pos = 4 if buf[:4] == b'pst0' else 0
+    cache, pos = _cached_header(buf, pos)
+    cache['lscalar_views'] = False
+    seconds = slice_ms / 1000.0
+    budget = _FIRST_SLICE
+    while True:
+        start = perf_counter()
+        value, pos = process_item(buf, pos, cache, budget, 0)
+        if value is not _PAUSED:
+            return value
+        elapsed = perf_counter() - start
+        # aim the next slice at the time allowed, changing it gradually
+        if elapsed > 0:
+            budget = int(budget * min(2.0, max(0.5, seconds / elapsed)))
+        budget = max(budget, 100)
+        await asyncio.sleep(0)
@@ -0,0 +1,316 @@
+#
+# License
+#
+# python storable is distributed under the zlib/libpng license, which is OSS
+# (Open Source Software) compliant.
+#
+# Copyright (C) 2009 Tim Aerts
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Tim Aerts <aardbeiplantje@gmail.com>
+#
+
+"""
+Columnar decoding of arrays of hashes.
+
+``thaw_columns(frozen, path=('rows',))`` decodes the array of hashes found
+by following *path* (hash keys and array indices, like
+:func:`~storable.paths.get_path`) straight into a dict of columns, one
+list per hash key, without building a dict per row. Everything outside of
+the array is skipped. Columns that only hold numbers become
+``array.array`` or NumPy arrays, see *numeric_arrays* of
+:func:`~storable.core.thaw`.
+
+A key that is missing from a row, and an undefined value, are filled in
+with *missing* (None by default). Give a number (``float('nan')``, ``0``,
+...) to have numeric columns with gaps packed as well.
+
+:func:`iter_columns` yields the columns of *batch_size* rows at a time, so
+that arrays larger than memory can be processed from a memory mapped file
+(see :func:`retrieve_columns`).
+"""
+
+from array import array
+import mmap
+
+from .core import NETTAG, _hash_key, _numeric_arrays, _scalars, engine
+from .paths import _Step, _Walker
+
+
+def _locate(walker, path):
+    """
+    Follows *path* from the top of the storable. Returns the offset and
+    object number of the item it leads to, or the item itself (with None
+    as its offset) if the path passes through a back-reference.
+    """
+    buf = walker.buf
+    cache = walker.cache
+    size_unpack = cache['size_unpack']
+    size_len = cache['size_len']
+    pos = walker.root
+    tag = 0
+    for depth, step in enumerate(path):
+        step = _Step(step)
+        if step.keys is None or len(step.keys) != 1:
+            raise ValueError('thaw_columns() needs one key or index per '
+                             'step, got %r' % (path,))
+        pos, tag = walker.unwrap(pos, tag)
+        magic_type = buf[pos]
+        if magic_type == 0x00:
+            data = walker.resolve(NETTAG.unpack_from(buf, pos + 1)[0])
+            for step in path[depth:]:
+                data = data[step]
+            return None, data
+        tag += 1
+        if magic_type == 0x02:
+            size = size_unpack(buf, pos + 1)[0]
+            pos += 1 + size_len
+            if len(step.indices) != 1:
+                raise KeyError(path)
+            index = next(iter(step.indices))
+            if index < 0:
+                index += size
+            if not 0 <= index < size:
+                raise KeyError(path)
+            for _ in range(index):
+                pos, used = walker.skip(pos)
+                tag += used
+        elif magic_type == 0x03 or magic_type == 0x19:
+            flags_len = 1 if magic_type == 0x19 else 0
+            size = size_unpack(buf, pos + 1 + flags_len)[0]
+            pos += 1 + flags_len + size_len
+            for _ in range(size):
+                end, used = walker.skip(pos)
+                keysize = size_unpack(buf, end + flags_len)[0]
+                key_pos = end + flags_len + size_len
+                if buf[key_pos:key_pos + keysize].tobytes() in step.keys:
+                    break
+                pos = key_pos + keysize
+                tag += used
+            else:
+                raise KeyError(path)
+        else:
+            raise KeyError(path)
+    pos, tag = walker.unwrap(pos, tag)
+    if buf[pos] == 0x00:
+        return None, walker.resolve(NETTAG.unpack_from(buf, pos + 1)[0])
+    return pos, tag
+
+
+def _rows(walker, pos, tag):
+    """
+    Yields the rows of the array at *pos*, each as a list of ``(key,
+    value)`` pairs.
+    """
+    buf = walker.buf
+    cache = walker.cache
+    size_unpack = cache['size_unpack']
+    size_len = cache['size_len']
+    guess = cache['guess']
+    if buf[pos] != 0x02:
+        raise ValueError('thaw_columns() needs an array of hashes')
+    size = size_unpack(buf, pos + 1)[0]
+    pos += 1 + size_len
+    tag += 1
+    for _ in range(size):
+        pos, tag = walker.unwrap(pos, tag)
+        magic_type = buf[pos]
+        if magic_type != 0x03 and magic_type != 0x19:
+            # a back-reference or something that is not a hash
+            end, used = walker.skip(pos)
+            yield _row(walker.decode(pos, tag))
+            pos = end
+            tag += used
+            continue
+
+        flagged = magic_type == 0x19
+        flags_len = 1 if flagged else 0
+        count = size_unpack(buf, pos + 1 + flags_len)[0]
+        pos += 1 + flags_len + size_len
+        tag += 1
+        row = []
+        for _ in range(count):
+            magic_type = buf[pos]
+            if magic_type == 0x0a:
+                # SX_SCALAR, inlined
+                end = pos + 2 + buf[pos + 1]
+                value = guess(buf[pos + 2:end].tobytes())
+                tag += 1
+            elif magic_type in _scalars and magic_type < 0x1d:
+                value, end = engine[magic_type](buf, pos + 1, cache)
+                tag += 1
+            else:
+                end, used = walker.skip(pos)
+                value = walker.decode(pos, tag)
+                tag += used
+            keysize = size_unpack(buf, end + flags_len)[0]
+            pos = end + flags_len + size_len
+            raw = buf[pos:pos + keysize].tobytes()
+            pos += keysize
+            if flagged:
+                row.append((raw or None, value))
+            else:
+                row.append((_hash_key(raw, cache), value))
+        yield row
+
+
+def _row(data):
+    if not isinstance(data, dict):
+        raise ValueError('thaw_columns() needs an array of hashes, got %r'
+                         % (data,))
+    return list(data.items())
+
+
+def _decoded_rows(data):
+    if not isinstance(data, list):
+        raise ValueError('thaw_columns() needs an array of hashes')
+    return (_row(row) for row in data)
+
+
+def _columns(rows, missing, convert, keys=()):
+    """
+    Turns the rows (lists of ``(key, value)`` pairs) into a dict of
+    columns, which starts out with a column for each of *keys*.
+    """
+    columns = dict((key, []) for key in keys)
+    count = 0
+    for row in rows:
+        for key, value in row:
+            column = columns.get(key)
+            if column is None:
+                column = columns[key] = [missing] * count
+            column.append(missing if value is None else value)
+        count += 1
+        if len(row) != len(columns):
+            for column in columns.values():
+                if len(column) != count:
+                    column.append(missing)
+    if convert is not None:
+        for key, column in columns.items():
+            columns[key] = _pack(column, convert)
+    return columns
+
+
+def _pack(column, convert):
+    """
+    Returns *column* as an ``array.array`` passed to *convert* if it only
+    holds numbers, or as it is.
+    """
+    types = set(map(type, column))
+    if types == {int}:
+        typecode = 'q'
+    elif types == {float} or types == {int, float}:
+        typecode = 'd'
+    else:
+        return column
+    try:
+        return convert(array(typecode, column))
+    except OverflowError:
+        return column
+
+
+def _batches(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iter_columns(frozen_data, path=(), batch_size=65536, missing=None,
+                 numeric_arrays=True):
+    """
+    Like :func:`thaw_columns`, but yields the columns of *batch_size* rows
+    at a time. The columns of every batch have all the keys seen so far,
+    and a column is packed when all of its values in that batch are
+    numbers. *frozen_data* can be any buffer, such as a memory mapped file.
+    """
+    convert = _numeric_arrays(numeric_arrays)
+    walker = _Walker(memoryview(frozen_data))
+    pos, tag = _locate(walker, tuple(path))
+    if pos is None:
+        rows = _decoded_rows(tag)
+    else:
+        rows = _rows(walker, pos, tag)
+    keys = ()
+    for batch in _batches(rows, batch_size):
+        columns = _columns(batch, missing, convert, keys)
+        keys = list(columns)
+        yield columns
+
+
+def thaw_columns(frozen_data, path=(), missing=None, numeric_arrays=True):
+    """
+    Decodes the array of hashes at *path* in the storable *frozen_data*
+    into a dict of columns, from hash key to the list (or packed array) of
+    its values in all the rows. See :mod:`storable.columns`.
+    """
+    convert = _numeric_arrays(numeric_arrays)
+    walker = _Walker(memoryview(frozen_data))
+    pos, tag = _locate(walker, tuple(path))
+    if pos is None:
+        rows = _decoded_rows(tag)
+    else:
+        rows = _rows(walker, pos, tag)
+    return _columns(rows, missing, convert)
+
+
+def retrieve_columns(filepath, path=(), batch_size=None, missing=None,
+                     numeric_arrays=True):
+    """
+    :func:`thaw_columns` for the ``store``/``nstore`` file *filepath*, which
+    is decoded from a read-only memory mapping. With *batch_size*, returns
+    a generator like :func:`iter_columns` that keeps the file mapped until
+    it is done.
+    """
+    if batch_size is not None:
+        return _iter_file_columns(filepath, path, batch_size, missing,
+                                  numeric_arrays)
+    with open(filepath, 'rb') as fh:
+        mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    buf = memoryview(mapped)
+    try:
+        return thaw_columns(buf, path, missing, numeric_arrays)
+    finally:
+        buf.release()
+        _close(mapped)
+
+
+def _close(mapped):
+    try:
+        mapped.close()
+    except BufferError:
+        # back-references were resolved through a lazy view of the data,
+        # which keeps the mapping in use until it is garbage collected
+        pass
+
+
+def _iter_file_columns(filepath, path, batch_size, missing, numeric_arrays):
+    with open(filepath, 'rb') as fh:
+        mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    buf = memoryview(mapped)
+    try:
+        for columns in iter_columns(buf, path, batch_size, missing,
+                                    numeric_arrays):
+            yield columns
+    finally:
+        buf.release()
+        _close(mapped)
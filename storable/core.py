@@ -26,13 +26,19 @@
 #
 
 from __future__ import unicode_literals
-from functools import wraps
+from array import array
+from collections import OrderedDict
+import errno
+from functools import lru_cache, wraps
 import io
-from struct import calcsize, unpack
+from struct import Struct, calcsize
 import logging
+import mmap
 import os
 import sys
 
+from .shapes import make_record
+
 
 if sys.version_info > (3, 0):
     xrange = range
@@ -81,6 +87,138 @@ def _guess_type(data):
     return data if converted_result is None else converted_result
 
 
+def _raw_scalar(data):
+    return data
+
+
+def _str_scalar(data):
+    return data.decode('ascii') if data.isascii() else data
+
+
+# the bytes a number written by Perl can consist of, apart from digits
+_NUMBER_BYTES = b'0123456789+-.eE'
+
+
+def _numeric_scalar(data):
+    """
+    Like _guess_type(), but the bytes are checked first so that only
+    strings that look like numbers are tried as one: up to 18 plain digits
+    become an int straight away and anything with other characters (including "inf",
+    "nan" and padding whitespace) stays a string.
+    """
+    if len(data) < 19 and data.isdigit():
+        return int(data)
+    if not data.translate(None, _NUMBER_BYTES):
+        if data:
+            return _guess_type(data)
+        return ''
+    return data.decode('ascii') if data.isascii() else data
+
+
+# The ways to convert the bytes of scalars and hash keys, see Decoder
+SCALAR_POLICIES = {
+    'legacy': _guess_type,
+    'raw': _raw_scalar,
+    'str': _str_scalar,
+    'numeric': _numeric_scalar,
+}
+
+
+class ScalarCache(object):
+    """
+    A bounded table of converted scalars for the *dedupe* argument of
+    :func:`thaw`, :func:`retrieve` and :class:`Decoder`. Scalars of up to
+    *max_len* bytes are looked up in it before they are converted, so equal
+    short values (status strings, country codes, small numbers, ...) decode
+    to one shared object. At most *size* values are kept per conversion,
+    the least recently used one is dropped first.
+
+    One table can be used for many storables. :meth:`stats` tells how
+    often a value was found in it, every hit being one object less.
+    """
+
+    def __init__(self, size=10000, max_len=32):
+        self.size = size
+        self.max_len = max_len
+        self.hits = 0
+        self.misses = 0
+        self._tables = {}
+
+    def wrap(self, convert):
+        """
+        Returns the conversion function *convert* with the table in front of
+        it.
+        """
+        table = self._tables.get(convert)
+        if table is None:
+            table = self._tables[convert] = OrderedDict()
+        size = self.size
+        max_len = self.max_len
+        move_to_end = table.move_to_end
+
+        def dedupe(raw):
+            if len(raw) > max_len:
+                return convert(raw)
+            value = table.get(raw)
+            if value is None:
+                self.misses += 1
+                value = table[raw] = convert(raw)
+                if len(table) > size:
+                    table.popitem(last=False)
+            else:
+                self.hits += 1
+                move_to_end(raw)
+            return value
+        return dedupe
+
+    def stats(self):
+        """
+        Returns the number of ``hits`` and ``misses`` so far, the
+        ``hit_rate`` and the number of ``entries`` in the table.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            'entries': sum(len(table) for table in self._tables.values()),
+        }
+
+
+def _use_dedupe(cache, dedupe):
+    """
+    Puts the :class:`ScalarCache` *dedupe* in front of the scalar
+    conversions of the decoder cache *cache*.
+    """
+    cache['guess'] = dedupe.wrap(cache['guess'])
+    cache['utf8'] = dedupe.wrap(cache['utf8'])
+
+
+# Number of distinct hash keys remembered by a key table (see _hash_key)
+# before it is emptied and starts over.
+KEY_CACHE_SIZE = 4096
+
+
+def _hash_key(raw, cache):
+    """
+    Converts the bytes *raw* of a hash key like a scalar. The result is kept
+    in the key table ``cache['keys']``, which lives as long as the decoder
+    or the header setup it belongs to: a key that was seen before is looked
+    up instead of converted, and every hash gets the same (interned) object
+    for it.
+    """
+    keys = cache['keys']
+    key = keys.get(raw)
+    if key is None:
+        key = cache['guess'](raw)
+        if isinstance(key, str):
+            key = sys.intern(key)
+        if len(keys) >= cache['keys_max']:
+            keys.clear()
+        keys[raw] = key
+    return key
+
+
 def maybelogged(f):
     """
     If the DEBUG flag is set in this module (must be set before importing),
@@ -101,206 +239,277 @@ def maybelogged(f):
     return fun
 
 
+# Network order tags and indices (SX_OBJECT, SX_NETINT, SX_TIED_IDX, ...)
+NETINT = Struct('!i')
+NETTAG = Struct('!I')
+
+
+# Returned by the handlers of opcodes whose value is the item that follows
+# (references, blessings, tied wrappers, ...) or that pushed a frame which
+# produces their value once its children are decoded.
+_NEXT = object()
+
+# Returned by process_item() in place of a value when its budget ran out
+_PAUSED = object()
+
+# Frame kinds on the decoder stack (see process_item)
+_ARRAY = 0
+_HASH = 1
+_FLAG_HASH = 2
+_TIED_KEY = 3
+_TIED_IDX = 4
+_HOOK = 5
+
+
 @maybelogged
-def _read_size(fh, cache):
-    fmt = cache['size_unpack_fmt']
-    return unpack(fmt, fh.read(calcsize(fmt)))[0]
+def _read_size(buf, pos, cache):
+    return cache['size_unpack'](buf, pos)[0], pos + cache['size_len']
+
+
+def _reserve_object(cache):
+    """
+    Claims the next object number for an item whose value is only known once
+    the item(s) following it have been decoded. The slot is filled in by
+    process_item with the next value that gets created.
+    """
+    objects = cache['objects']
+    cache['pending'].append(len(objects))
+    objects.append(None)
 
 
 @maybelogged
-def SX_OBJECT(fh, cache):
+def SX_OBJECT(buf, pos, cache):
     # From Storable.xs store function:
     # * The tag is always written in network order.
-    i = SX_NETINT(fh, cache)
-    cache['has_sx_object'] = True
-    return (0, i)
+    # Containers are registered as soon as they are created and filled in
+    # place, so this also works for objects that are still being decoded
+    # (self-referencing data) and keeps shared data shared.
+    i = NETTAG.unpack_from(buf, pos)[0]
+    value = cache['objects'][i]
+    pinned = cache['pinned']
+    if pinned is not None:
+        # a hash referred to while it is decoded must stay what it is
+        pinned.add(id(value))
+    return value, pos + 4
 
 
 @maybelogged
-def SX_LSCALAR(fh, cache):
-    raw_result = fh.read(_read_size(fh, cache))
-    return _guess_type(raw_result)
+def SX_LSCALAR(buf, pos, cache):
+    size, pos = _read_size(buf, pos, cache)
+    end = pos + size
+    if cache['lscalar_views']:
+        return buf[pos:end], end
+    return cache['guess'](buf[pos:end].tobytes()), end
 
 
 @maybelogged
-def SX_LUTF8STR(fh, cache):
-    return fh.read(_read_size(fh, cache)).decode('utf-8')
+def SX_LUTF8STR(buf, pos, cache):
+    size, pos = _read_size(buf, pos, cache)
+    end = pos + size
+    return buf[pos:end].tobytes().decode('utf-8'), end
 
 
 @maybelogged
-def SX_ARRAY(fh, cache):
-    return [process_item(fh, cache) for _ in xrange(_read_size(fh, cache))]
+def SX_ARRAY(buf, pos, cache):
+    size, pos = _read_size(buf, pos, cache)
+    data = []
+    if size:
+        cache['stack'].append([_ARRAY, data, size])
+    return data, pos
 
 
 @maybelogged
-def SX_HASH(fh, cache):
+def SX_HASH(buf, pos, cache):
+    size, pos = _read_size(buf, pos, cache)
     data = {}
-    sz = _read_size(fh, cache)
-    for _ in xrange(sz):
-        value = process_item(fh, cache)
-        key = _guess_type(fh.read(_read_size(fh, cache)))
-        data[key] = value
-    return data
+    if size:
+        cache['stack'].append([_HASH, data, size])
+    return data, pos
 
 
 @maybelogged
-def SX_REF(fh, cache):
-    return process_item(fh, cache)
+def SX_REF(buf, pos, cache):
+    _reserve_object(cache)
+    return _NEXT, pos
 
 
 @maybelogged
-def SX_UNDEF(fh, cache):
-    return None
+def SX_UNDEF(buf, pos, cache):
+    return None, pos
 
 
 @maybelogged
-def SX_INTEGER(fh, cache):
-    fmt = cache['int_unpack_fmt']
-    return unpack(fmt, fh.read(calcsize(fmt)))[0]
+def SX_INTEGER(buf, pos, cache):
+    return cache['int_unpack'](buf, pos)[0], pos + cache['int_len']
 
 
 @maybelogged
-def SX_DOUBLE(fh, cache):
-    fmt = cache['double_unpack_fmt']
-    return unpack(fmt, fh.read(calcsize(fmt)))[0]
+def SX_DOUBLE(buf, pos, cache):
+    return cache['double_unpack'](buf, pos)[0], pos + cache['double_len']
 
 
 @maybelogged
-def SX_BYTE(fh, cache):
-    return _read_unsigned_byte(fh) - 128
+def SX_BYTE(buf, pos, cache):
+    return buf[pos] - 128, pos + 1
 
 
 @maybelogged
-def SX_NETINT(fh, cache):
-    fmt = '!I'
-    return unpack(fmt, fh.read(calcsize(fmt)))[0]
+def SX_NETINT(buf, pos, cache):
+    return NETINT.unpack_from(buf, pos)[0], pos + 4
 
 
 @maybelogged
-def SX_SCALAR(fh, cache):
-    size = _read_unsigned_byte(fh)
-    raw_result = fh.read(size)
-    return _guess_type(raw_result)
+def SX_SCALAR(buf, pos, cache):
+    end = pos + 1 + buf[pos]
+    return cache['guess'](buf[pos + 1:end].tobytes()), end
 
 
 @maybelogged
-def SX_UTF8STR(fh, cache):
-    return fh.read(_read_unsigned_byte(fh)).decode('utf-8')
+def SX_UTF8STR(buf, pos, cache):
+    end = pos + 1 + buf[pos]
+    return cache['utf8'](buf[pos + 1:end].tobytes()), end
 
 
 @maybelogged
-def SX_TIED_ARRAY(fh, cache):
-    return process_item(fh, cache)
+def SX_TIED_ARRAY(buf, pos, cache):
+    return _NEXT, pos
 
 
 @maybelogged
-def SX_TIED_HASH(fh, cache):
-    return SX_TIED_ARRAY(fh, cache)
+def SX_TIED_HASH(buf, pos, cache):
+    return SX_TIED_ARRAY(buf, pos, cache)
 
 
 @maybelogged
-def SX_TIED_SCALAR(fh, cache):
-    return SX_TIED_ARRAY(fh, cache)
+def SX_TIED_SCALAR(buf, pos, cache):
+    return SX_TIED_ARRAY(buf, pos, cache)
 
 
 @maybelogged
-def SX_SV_UNDEF(fh, cache):
-    return None
+def SX_SV_UNDEF(buf, pos, cache):
+    return None, pos
 
 
 @maybelogged
-def SX_SV_YES(fh, cache):
-    return True
+def SX_SV_YES(buf, pos, cache):
+    return True, pos
 
 
 @maybelogged
-def SX_SV_NO(fh, cache):
-    return False
+def SX_SV_NO(buf, pos, cache):
+    return False, pos
 
 
 @maybelogged
-def SX_BLESS(fh, cache):
-    size = _read_unsigned_byte(fh)
-    package_name = fh.read(size)
+def SX_BLESS(buf, pos, cache):
+    end = pos + 1 + buf[pos]
+    package_name = buf[pos + 1:end].tobytes()
     cache['classes'].append(package_name)
-    return process_item(fh, cache)
+    return _NEXT, end
 
 
 @maybelogged
-def SX_IX_BLESS(fh, cache):
-    indx = _read_unsigned_byte(fh)
+def SX_IX_BLESS(buf, pos, cache):
+    indx = buf[pos]
     package_name = cache['classes'][indx]
-    return process_item(fh, cache)
+    return _NEXT, pos + 1
 
 
 @maybelogged
-def SX_OVERLOAD(fh, cache):
-    return process_item(fh, cache)
+def SX_OVERLOAD(buf, pos, cache):
+    return SX_REF(buf, pos, cache)
 
 
 @maybelogged
-def SX_TIED_KEY(fh, cache):
-    data = process_item(fh, cache)
-    key = process_item(fh, cache)
-    return data
+def SX_TIED_KEY(buf, pos, cache):
+    # the tied object and then its key follow, only the former is kept
+    _reserve_object(cache)
+    cache['stack'].append([_TIED_KEY, None, 2])
+    return _NEXT, pos
 
 
 @maybelogged
-def SX_TIED_IDX(fh, cache):
-    data = process_item(fh, cache)
-    # idx's are always big-endian dumped by storable's freeze/nfreeze I think
-    indx_in_array = SX_NETINT(fh, cache)
-    return data
+def SX_TIED_IDX(buf, pos, cache):
+    # the tied object follows, then its index in network order
+    _reserve_object(cache)
+    cache['stack'].append([_TIED_IDX, None, 1])
+    return _NEXT, pos
 
 
 @maybelogged
-def SX_HOOK(fh, cache):
-    flags = _read_unsigned_byte(fh)
+def SX_HOOK(buf, pos, cache):
+    flags = buf[pos]
+    pos += 1
+
+    if flags & 0x40:   # SHF_NEED_RECURSE
+        # The hooked object's value is only known after the sub-objects
+        # that follow, so it takes over any pending object numbers itself.
+        objects = cache['objects']
+        pending = cache['pending']
+        slots = pending[:] + [len(objects)]
+        del pending[:]
+        objects.append(None)
+        cache['stack'].append([_HOOK, slots, 1])
+        return _NEXT, pos
+
+    return _read_hook_body(buf, pos, cache, flags)
 
-    while flags & 0x40:   # SHF_NEED_RECURSE
-        dummy = process_item(fh, cache)
-        flags = _read_unsigned_byte(fh)
 
+def _read_hook_body(buf, pos, cache, flags):
+    """
+    Reads what follows the SX_HOOK flags once all the sub-objects flagged by
+    SHF_NEED_RECURSE have been decoded.
+    """
     if flags & 0x20:   # SHF_IDX_CLASSNAME
         if flags & 0x04:   # SHF_LARGE_CLASSLEN
             # TODO: test
-            fmt = '>I'
-            indx = unpack(fmt, fh.read(calcsize(fmt)))[0]
+            indx = NETTAG.unpack_from(buf, pos)[0]
+            pos += 4
         else:
-            indx = _read_unsigned_byte(fh)
+            indx = buf[pos]
+            pos += 1
         package_name = cache['classes'][indx]
     else:
         if flags & 0x04:   # SHF_LARGE_CLASSLEN
             # TODO: test
             # FIXME: is this actually possible?
-            class_size = _read_size(fh, cache)
+            class_size, pos = _read_size(buf, pos, cache)
         else:
-            class_size = _read_unsigned_byte(fh)
+            class_size = buf[pos]
+            pos += 1
 
-        package_name = fh.read(class_size)
+        package_name = buf[pos:pos + class_size].tobytes()
+        pos += class_size
         cache['classes'].append(package_name)
 
     arguments = {}
 
     if flags & 0x08:   # SHF_LARGE_STRLEN
-        str_size = _read_size(fh, cache)
+        str_size, pos = _read_size(buf, pos, cache)
     else:
-        str_size = _read_unsigned_byte(fh)
+        str_size = buf[pos]
+        pos += 1
 
     if str_size:
-        frozen_str = _guess_type(fh.read(str_size))
+        frozen_str = cache['guess'](buf[pos:pos + str_size].tobytes())
+        pos += str_size
         arguments[0] = frozen_str
 
     if flags & 0x80:   # SHF_HAS_LIST
         if flags & 0x10:   # SHF_LARGE_LISTLEN
-            list_size = _read_size(fh, cache)
+            list_size, pos = _read_size(buf, pos, cache)
         else:
-            list_size = _read_unsigned_byte(fh)
+            list_size = buf[pos]
+            pos += 1
 
+        objects = cache['objects']
         for i in xrange(list_size):
-            fmt = '>I'
-            indx_in_array = unpack(fmt, fh.read(calcsize(fmt)))[0]
-            arguments[i + 1] = cache['objects'].get(indx_in_array)
+            indx_in_array = NETTAG.unpack_from(buf, pos)[0]
+            pos += 4
+            if indx_in_array < len(objects):
+                arguments[i + 1] = objects[indx_in_array]
+            else:
+                arguments[i + 1] = None
 
     # FIXME: implement the real callback STORABLE_thaw() still, for now, just
     # return the dictionary 'arguments' as data
@@ -319,169 +528,764 @@ def SX_HOOK(fh, cache):
         # TODO
         pass
 
-    return data
+    return data, pos
 
 
 @maybelogged
-def SX_FLAG_HASH(fh, cache):
+def SX_FLAG_HASH(buf, pos, cache):
     # TODO: NOT YET IMPLEMENTED!!!!!!
-    flags = _read_unsigned_byte(fh)
-    size = _read_size(fh, cache)
+    flags = buf[pos]
+    size, pos = _read_size(buf, pos + 1, cache)
     data = {}
-    for i in xrange(size):
-        value = process_item(fh, cache)
-        flags = _read_unsigned_byte(fh)
-        keysize = _read_size(fh, cache)
-        key = None
-        if keysize:
-            key = fh.read(keysize)
-        data[key] = value
+    if size:
+        cache['stack'].append([_FLAG_HASH, data, size])
+    return data, pos
 
-    return data
+
+def SX_VSTRING(buf, pos, cache):
+    end = pos + 1 + buf[pos]
+    return _read_vstring(buf, pos + 1, end, cache)
 
 
-def SX_VSTRING(fh, cache):
-    value = SX_SCALAR(fh, cache)
-    return tuple(x for x in value[1:].split('.'))
+def SX_LVSTRING(buf, pos, cache):
+    size, pos = _read_size(buf, pos, cache)
+    return _read_vstring(buf, pos, pos + size, cache)
 
 
-def SX_LVSTRING(fh, cache):
-    value = SX_LSCALAR(fh, cache)
-    return tuple(x for x in value[1:].split('.'))
+def _read_vstring(buf, pos, end, cache):
+    # The v-string magic ("v5.6.0") is followed by the scalar holding the
+    # characters it stands for. That scalar is the object that gets numbered,
+    # it is skipped here and replaced by the version components. (Its
+    # characters need not be valid UTF-8: Perl uses an extended encoding
+    # for code points beyond U+10FFFF.)
+    value = buf[pos:end].tobytes().decode('ascii')
+    end = skip_item(buf, end, cache)[0]
+    return tuple(x for x in value[1:].split('.')), end
 
 
 # *AFTER* all the subroutines
 engine = {
-    b'\x00': SX_OBJECT,      # ( 0): Already stored object
-    b'\x01': SX_LSCALAR,     # ( 1): Scalar (large binary) follows (length, data)
-    b'\x02': SX_ARRAY,       # ( 2): Array forthcoming (size, item list)
-    b'\x03': SX_HASH,        # ( 3): Hash forthcoming (size, key/value pair list)
-    b'\x04': SX_REF,         # ( 4): Reference to object forthcoming
-    b'\x05': SX_UNDEF,       # ( 5): Undefined scalar
-    b'\x06': SX_INTEGER,     # ( 6): Integer forthcoming
-    b'\x07': SX_DOUBLE,      # ( 7): Double forthcoming
-    b'\x08': SX_BYTE,        # ( 8): (signed) byte forthcoming
-    b'\x09': SX_NETINT,      # ( 9): Integer in network order forthcoming
-    b'\x0a': SX_SCALAR,      # (10): Scalar (binary, small) follows (length, data)
-    b'\x0b': SX_TIED_ARRAY,  # (11): Tied array forthcoming
-    b'\x0c': SX_TIED_HASH,   # (12): Tied hash forthcoming
-    b'\x0d': SX_TIED_SCALAR, # (13): Tied scalar forthcoming
-    b'\x0e': SX_SV_UNDEF,    # (14): Perl's immortal PL_sv_undef
-    b'\x0f': SX_SV_YES,      # (15): Perl's immortal PL_sv_yes
-    b'\x10': SX_SV_NO,       # (16): Perl's immortal PL_sv_no
-    b'\x11': SX_BLESS,       # (17): Object is blessed
-    b'\x12': SX_IX_BLESS,    # (18): Object is blessed, classname given by index
-    b'\x13': SX_HOOK,        # (19): Stored via hook, user-defined
-    b'\x14': SX_OVERLOAD,    # (20): Overloaded reference
-    b'\x15': SX_TIED_KEY,    # (21): Tied magic key forthcoming
-    b'\x16': SX_TIED_IDX,    # (22): Tied magic index forthcoming
-    b'\x17': SX_UTF8STR,     # (23): UTF-8 string forthcoming (small)
-    b'\x18': SX_LUTF8STR,    # (24): UTF-8 string forthcoming (large)
-    b'\x19': SX_FLAG_HASH,   # (25): Hash with flags forthcoming (size, flags, key/flags/value triplet list)
-    b'\x1d': SX_VSTRING,     # (29): vstring forthcoming (small)
-    b'\x1e': SX_LVSTRING,    # (30): vstring forthcoming (large)
+    0x00: SX_OBJECT,      # ( 0): Already stored object
+    0x01: SX_LSCALAR,     # ( 1): Scalar (large binary) follows (length, data)
+    0x02: SX_ARRAY,       # ( 2): Array forthcoming (size, item list)
+    0x03: SX_HASH,        # ( 3): Hash forthcoming (size, key/value pair list)
+    0x04: SX_REF,         # ( 4): Reference to object forthcoming
+    0x05: SX_UNDEF,       # ( 5): Undefined scalar
+    0x06: SX_INTEGER,     # ( 6): Integer forthcoming
+    0x07: SX_DOUBLE,      # ( 7): Double forthcoming
+    0x08: SX_BYTE,        # ( 8): (signed) byte forthcoming
+    0x09: SX_NETINT,      # ( 9): Integer in network order forthcoming
+    0x0a: SX_SCALAR,      # (10): Scalar (binary, small) follows (length, data)
+    0x0b: SX_TIED_ARRAY,  # (11): Tied array forthcoming
+    0x0c: SX_TIED_HASH,   # (12): Tied hash forthcoming
+    0x0d: SX_TIED_SCALAR, # (13): Tied scalar forthcoming
+    0x0e: SX_SV_UNDEF,    # (14): Perl's immortal PL_sv_undef
+    0x0f: SX_SV_YES,      # (15): Perl's immortal PL_sv_yes
+    0x10: SX_SV_NO,       # (16): Perl's immortal PL_sv_no
+    0x11: SX_BLESS,       # (17): Object is blessed
+    0x12: SX_IX_BLESS,    # (18): Object is blessed, classname given by index
+    0x13: SX_HOOK,        # (19): Stored via hook, user-defined
+    0x14: SX_OVERLOAD,    # (20): Overloaded reference
+    0x15: SX_TIED_KEY,    # (21): Tied magic key forthcoming
+    0x16: SX_TIED_IDX,    # (22): Tied magic index forthcoming
+    0x17: SX_UTF8STR,     # (23): UTF-8 string forthcoming (small)
+    0x18: SX_LUTF8STR,    # (24): UTF-8 string forthcoming (large)
+    0x19: SX_FLAG_HASH,   # (25): Hash with flags forthcoming (size, flags, key/flags/value triplet list)
+    0x1d: SX_VSTRING,     # (29): vstring forthcoming (small)
+    0x1e: SX_LVSTRING,    # (30): vstring forthcoming (large)
 }
 
 
+# Opcodes that do not get an object number of their own. Apart from
+# SX_OBJECT, these all wrap the item that follows them.
 exclude_for_cache = {
-    b'\x00',
-    b'\x0b',
-    b'\x0c',
-    b'\x0d',
-    b'\x11',
-    b'\x12',
+    0x00,
+    0x0b,
+    0x0c,
+    0x0d,
+    0x11,
+    0x12,
+}
+
+
+# Opcodes of plain scalars: they are complete as soon as their handler
+# returns and do not wrap or contain other items.
+_scalars = {
+    0x01,
+    0x05,
+    0x06,
+    0x07,
+    0x08,
+    0x09,
+    0x0a,
+    0x0e,
+    0x0f,
+    0x10,
+    0x17,
+    0x18,
+    0x1d,
+    0x1e,
 }
 
 
 @maybelogged
-def handle_sx_object_refs(cache, data):
-    iterateelements = None
-    if type(data) is list:
-        iterateelements = enumerate(data)
-    elif type(data) is dict:
-        iterateelements = iter(data.items())
+def process_item(buf, pos, cache, budget=None, base=None):
+    """
+    Decodes the item at offset *pos*, including everything nested in it, and
+    returns it together with the offset right after it.
+
+    This does not recurse: containers are created empty, registered, and
+    pushed on ``cache['stack']`` as a frame ``[kind, container, remaining]``.
+    They are then filled in place as their children are decoded, so the
+    nesting depth of the data is only limited by memory.
+
+    With a *budget*, decoding stops after about that many items and
+    ``(_PAUSED, pos)`` is returned if the item is not complete yet. All
+    the state is in the cache then: calling this again with the offset, a
+    new budget and as *base* the depth of ``cache['stack']`` at the first
+    call carries on where it stopped.
+    """
+    stack = cache['stack']
+    objects = cache['objects']
+    pending = cache['pending']
+    size_unpack = cache['size_unpack']
+    size_len = cache['size_len']
+    register = objects.append
+    guess = cache['guess']
+    keys = cache['keys']
+    numeric = cache['numeric_arrays']
+    records = cache['pinned'] is not None
+    depth = len(stack)
+    if base is None:
+        base = depth
+
+    while True:
+        if budget is not None:
+            if budget <= 0 and depth > base:
+                return _PAUSED, pos
+            budget -= 1
+        magic_type = buf[pos]
+        if magic_type == 0x0a:
+            # SX_SCALAR, inlined
+            end = pos + 2 + buf[pos + 1]
+            value = guess(buf[pos + 2:end].tobytes())
+            pos = end
+            register(value)
+        elif magic_type in _scalars:
+            value, pos = engine[magic_type](buf, pos + 1, cache)
+            register(value)
+        elif magic_type == 0x04:
+            # SX_REF, inlined: the referent follows
+            pending.append(len(objects))
+            register(None)
+            pos += 1
+            continue
+        elif magic_type == 0x02 or magic_type == 0x03:
+            # SX_ARRAY and SX_HASH, inlined
+            size = size_unpack(buf, pos + 1)[0]
+            pos += 1 + size_len
+            packed = None
+            if numeric is not None and magic_type == 0x02 and size:
+                # registers the array and its elements itself
+                packed = _numeric_array(buf, pos, size, cache)
+            if packed is not None:
+                value, pos = packed
+            else:
+                if magic_type == 0x02:
+                    value = []
+                    kind = _ARRAY
+                else:
+                    value = {}
+                    kind = _HASH
+                register(value)
+                if size:
+                    if records and kind == _HASH:
+                        # the object numbers the hash is known by, for when
+                        # it is turned into a record
+                        stack.append([kind, value, size,
+                                      pending + [len(objects) - 1]])
+                    else:
+                        stack.append([kind, value, size])
+                    depth += 1
+                if pending:
+                    for i in pending:
+                        objects[i] = value
+                    del pending[:]
+                if size:
+                    continue
+        else:
+            value, pos = engine[magic_type](buf, pos + 1, cache)
+            if value is _NEXT:
+                depth = len(stack)
+                continue
+            if magic_type not in exclude_for_cache:
+                register(value)
+            if len(stack) != depth:
+                # a container was opened, its children follow
+                depth += 1
+                if pending:
+                    for i in pending:
+                        objects[i] = value
+                    del pending[:]
+                continue
+        if pending:
+            # references waiting for the item they point to
+            for i in pending:
+                objects[i] = value
+            del pending[:]
+
+        # Hand the finished value to the innermost open frame. Whenever that
+        # completes the frame, its own value is handed on to the next one.
+        # Arrays and hashes decode runs of plain scalars right here, without
+        # going through the generic path above.
+        while depth > base:
+            frame = stack[-1]
+            kind = frame[0]
+            if kind == _ARRAY:
+                data = frame[1]
+                remaining = frame[2]
+                stop = 0
+                if budget is not None and remaining > budget:
+                    stop = remaining - max(budget, 1)
+                while True:
+                    data.append(value)
+                    remaining -= 1
+                    if remaining == stop:
+                        break
+                    magic_type = buf[pos]
+                    if magic_type == 0x0a:
+                        # SX_SCALAR, inlined
+                        end = pos + 2 + buf[pos + 1]
+                        value = guess(buf[pos + 2:end].tobytes())
+                        pos = end
+                    elif magic_type in _scalars:
+                        value, pos = engine[magic_type](buf, pos + 1, cache)
+                    else:
+                        break
+                    register(value)
+                if budget is not None:
+                    budget -= frame[2] - remaining
+                frame[2] = remaining
+            elif kind == _HASH:
+                data = frame[1]
+                remaining = frame[2]
+                stop = 0
+                if budget is not None and remaining > budget:
+                    stop = remaining - max(budget, 1)
+                while True:
+                    keysize = size_unpack(buf, pos)[0]
+                    pos += size_len
+                    end = pos + keysize
+                    raw = buf[pos:end].tobytes()
+                    key = keys.get(raw)
+                    if key is None:
+                        key = _hash_key(raw, cache)
+                    data[key] = value
+                    pos = end
+                    remaining -= 1
+                    if remaining == stop:
+                        break
+                    magic_type = buf[pos]
+                    if magic_type == 0x0a:
+                        # SX_SCALAR, inlined
+                        end = pos + 2 + buf[pos + 1]
+                        value = guess(buf[pos + 2:end].tobytes())
+                        pos = end
+                    elif magic_type in _scalars:
+                        value, pos = engine[magic_type](buf, pos + 1, cache)
+                    else:
+                        break
+                    register(value)
+                if budget is not None:
+                    budget -= frame[2] - remaining
+                frame[2] = remaining
+            else:
+                if kind == _FLAG_HASH:
+                    flags = buf[pos]
+                    keysize = size_unpack(buf, pos + 1)[0]
+                    pos += 1 + size_len
+                    key = None
+                    if keysize:
+                        key = buf[pos:pos + keysize].tobytes()
+                        pos += keysize
+                    frame[1][key] = value
+                elif kind == _TIED_KEY:
+                    if frame[2] == 2:
+                        frame[1] = value
+                    else:
+                        value = frame[1]
+                elif kind == _TIED_IDX:
+                    # idx's are always big-endian dumped by storable's
+                    # freeze/nfreeze I think
+                    indx_in_array = NETTAG.unpack_from(buf, pos)[0]
+                    pos += 4
+                elif kind == _HOOK:
+                    flags = buf[pos]
+                    pos += 1
+                    if flags & 0x40:   # SHF_NEED_RECURSE
+                        break
+                    value, pos = _read_hook_body(buf, pos, cache, flags)
+                    for i in frame[1]:
+                        objects[i] = value
+                frame[2] -= 1
+            if frame[2]:
+                break
+            stack.pop()
+            depth -= 1
+            if kind <= _FLAG_HASH:
+                value = frame[1]
+                if len(frame) > 3 and id(value) not in cache['pinned']:
+                    value = make_record(value)
+                    for i in frame[3]:
+                        objects[i] = value
+        else:
+            return value, pos
+
+
+# Longest run of array elements unpacked by one struct in _numeric_array()
+RUN_MAX = 4096
+
+
+@lru_cache(maxsize=256)
+def _run_struct(format, count):
+    """
+    Returns a struct for *count* items of the one-character *format*, each
+    one after its opcode byte. *format* starts with the byte order.
+    """
+    return Struct(format[0] + ('x' + format[1:]) * count)
+
+
+def _numeric_array(buf, pos, size, cache):
+    """
+    Decodes the *size* elements starting at *pos* of an array into an
+    ``array.array`` if they are all integers (``SX_BYTE``, ``SX_INTEGER``
+    and ``SX_NETINT``) or all doubles (``SX_DOUBLE``). Each run of elements
+    with the same opcode is unpacked with one ``unpack_from``. Returns the
+    array and the offset right after it, or None for any other array.
+    """
+    formats = cache['numeric_formats']
+    end = len(buf)
+    values = None
+    runs = []
+    while size:
+        op = buf[pos]
+        spec = formats.get(op)
+        if spec is None:
+            return None
+        typecode, format, width = spec
+        if values is None:
+            values = array(typecode)
+        elif values.typecode != typecode:
+            return None
+        count = min(size, RUN_MAX, (end - pos) // width)
+        if not count:
+            return None
+        ops = buf[pos:pos + count * width:width].tobytes()
+        count -= len(ops.lstrip(ops[:1]))
+        run = _run_struct(format, count).unpack_from(buf, pos)
+        if op == 0x08:
+            run = [x - 128 for x in run]
+        values.extend(run)
+        runs.append(run)
+        pos += count * width
+        size -= count
+
+    # the array and its elements get object numbers, in that order
+    value = cache['numeric_arrays'](values)
+    objects = cache['objects']
+    objects.append(value)
+    for run in runs:
+        objects.extend(run)
+    return value, pos
+
+
+def _numpy_array(values):
+    import numpy
+    return numpy.frombuffer(values, dtype=values.typecode)
+
+
+def _numeric_arrays(mode):
+    """
+    Returns the function that turns the ``array.array`` of a numeric array
+    into what is returned for the *numeric_arrays* option of :func:`thaw`,
+    or None if those arrays stay lists.
+    """
+    if mode is None or mode is False:
+        return None
+    if mode not in (True, 'array', 'numpy'):
+        raise ValueError('Unknown numeric_arrays mode %r, use True, '
+                         "'array' or 'numpy'" % (mode,))
+    if mode == 'array':
+        return _same
+    try:
+        import numpy
+    except ImportError:
+        if mode == 'numpy':
+            raise
+        return _same
+    return _numpy_array
+
+
+def _same(values):
+    return values
+
+
+# Containers spanning at least this many bytes get their extent remembered
+# by skip_item() when the cache has a 'spans' dict.
+SPAN_MEMO_MIN = 4096
+
+
+def _skip_hook_body(buf, pos, cache, flags, register_classes):
+    """
+    Counterpart of _read_hook_body() for skip_item().
+    """
+    if flags & 0x20:   # SHF_IDX_CLASSNAME
+        pos += 4 if flags & 0x04 else 1
     else:
-        return
+        if flags & 0x04:   # SHF_LARGE_CLASSLEN
+            class_size, pos = _read_size(buf, pos, cache)
+        else:
+            class_size = buf[pos]
+            pos += 1
+        if register_classes:
+            cache['classes'].append(buf[pos:pos + class_size].tobytes())
+        pos += class_size
 
-    for k, item in iterateelements:
-        if type(item) is list or type(item) is dict:
-            handle_sx_object_refs(cache, item)
-        elif type(item) is tuple:
-            data[k] = cache['objects'][item[1]]
-    return data
+    if flags & 0x08:   # SHF_LARGE_STRLEN
+        str_size, pos = _read_size(buf, pos, cache)
+    else:
+        str_size = buf[pos]
+        pos += 1
+    pos += str_size
+
+    if flags & 0x80:   # SHF_HAS_LIST
+        if flags & 0x10:   # SHF_LARGE_LISTLEN
+            list_size, pos = _read_size(buf, pos, cache)
+        else:
+            list_size = buf[pos]
+            pos += 1
+        refs = cache.get('refs')
+        if refs is not None:
+            refs.extend(NETTAG.unpack_from(buf, pos + 4 * i)[0]
+                        for i in range(list_size))
+        pos += 4 * list_size
+    return pos
 
 
 @maybelogged
-def process_item(fh, cache):
-    magic_type = fh.read(1)
-    if magic_type in exclude_for_cache:
-        data = engine[magic_type](fh, cache)
-    else:
-        i = cache['objectnr']
-        cache['objectnr'] += 1
-        data = engine[magic_type](fh, cache)
-        cache['objects'][i] = data
-    return data
+def skip_item(buf, pos, cache, register_classes=True):
+    """
+    Skips over the item at offset *pos*, including everything nested in it,
+    without building any Python objects. Returns the offset right after the
+    item and the number of object numbers (``SX_OBJECT`` tags) it uses, so
+    that an item following it can later be decoded on its own.
+
+    Like process_item() this does not recurse. Class names of blessed data
+    are added to ``cache['classes']`` unless *register_classes* is false,
+    which is what you want when skipping over data a second time. If the
+    cache holds a ``spans`` dict, the extent of large containers is recorded
+    in it and re-used on the next pass over the same bytes. Likewise, the
+    object numbers that back-references point to are appended to a
+    ``refs`` list in the cache.
+    """
+    size_unpack = cache['size_unpack']
+    size_len = cache['size_len']
+    int_len = cache['int_len']
+    double_len = cache['double_len']
+    spans = cache.get('spans')
+    refs = cache.get('refs')
+    stack = []
+    count = 0
+
+    while True:
+        start = pos
+        magic_type = buf[pos]
+        pos += 1
+        if magic_type == 0x0a or magic_type == 0x17:
+            # SX_SCALAR, SX_UTF8STR
+            pos += 1 + buf[pos]
+            count += 1
+        elif magic_type == 0x01 or magic_type == 0x18:
+            # SX_LSCALAR, SX_LUTF8STR
+            pos += size_len + size_unpack(buf, pos)[0]
+            count += 1
+        elif magic_type == 0x1d:
+            # SX_VSTRING: the scalar it applies to follows
+            pos += 1 + buf[pos]
+            continue
+        elif magic_type == 0x1e:
+            # SX_LVSTRING
+            pos += size_len + size_unpack(buf, pos)[0]
+            continue
+        elif magic_type == 0x02 or magic_type == 0x03 or magic_type == 0x19:
+            if spans is not None and start in spans:
+                pos, used = spans[start]
+                count += used
+            else:
+                if magic_type == 0x19:
+                    kind = _FLAG_HASH
+                    pos += 1
+                else:
+                    kind = _ARRAY if magic_type == 0x02 else _HASH
+                size = size_unpack(buf, pos)[0]
+                pos += size_len
+                count += 1
+                if size:
+                    stack.append([kind, size, start, count - 1])
+                    continue
+        elif magic_type == 0x04 or magic_type == 0x14:
+            # SX_REF, SX_OVERLOAD: the referent follows
+            count += 1
+            continue
+        elif magic_type == 0x05 or 0x0e <= magic_type <= 0x10:
+            # SX_UNDEF, SX_SV_UNDEF, SX_SV_YES, SX_SV_NO
+            count += 1
+        elif magic_type == 0x06:
+            pos += int_len
+            count += 1
+        elif magic_type == 0x07:
+            pos += double_len
+            count += 1
+        elif magic_type == 0x08:
+            pos += 1
+            count += 1
+        elif magic_type == 0x09:
+            pos += 4
+            count += 1
+        elif magic_type == 0x00:
+            if refs is not None:
+                refs.append(NETTAG.unpack_from(buf, pos)[0])
+            pos += 4
+        elif 0x0b <= magic_type <= 0x0d:
+            # SX_TIED_ARRAY, SX_TIED_HASH, SX_TIED_SCALAR
+            continue
+        elif magic_type == 0x11:
+            # SX_BLESS
+            size = buf[pos]
+            if register_classes:
+                cache['classes'].append(buf[pos + 1:pos + 1 + size].tobytes())
+            pos += 1 + size
+            continue
+        elif magic_type == 0x12:
+            # SX_IX_BLESS
+            pos += 1
+            continue
+        elif magic_type == 0x15 or magic_type == 0x16:
+            # SX_TIED_KEY, SX_TIED_IDX
+            count += 1
+            if magic_type == 0x15:
+                stack.append([_TIED_KEY, 2, start, 0])
+            else:
+                stack.append([_TIED_IDX, 1, start, 0])
+            continue
+        elif magic_type == 0x13:
+            # SX_HOOK
+            count += 1
+            flags = buf[pos]
+            pos += 1
+            if flags & 0x40:   # SHF_NEED_RECURSE
+                stack.append([_HOOK, 1, start, 0])
+                continue
+            pos = _skip_hook_body(buf, pos, cache, flags, register_classes)
+        else:
+            raise ValueError('Unknown storable opcode %d at offset %d'
+                             % (magic_type, start))
+
+        while stack:
+            frame = stack[-1]
+            kind = frame[0]
+            if kind == _HASH:
+                pos += size_len + size_unpack(buf, pos)[0]
+            elif kind == _FLAG_HASH:
+                pos += 1 + size_len + size_unpack(buf, pos + 1)[0]
+            elif kind == _TIED_IDX:
+                pos += 4
+            elif kind == _HOOK:
+                flags = buf[pos]
+                pos += 1
+                if flags & 0x40:   # SHF_NEED_RECURSE
+                    break
+                pos = _skip_hook_body(
+                    buf, pos, cache, flags, register_classes)
+            frame[1] -= 1
+            if frame[1]:
+                break
+            stack.pop()
+            if (spans is not None and kind <= _FLAG_HASH
+                    and pos - frame[2] >= SPAN_MEMO_MIN):
+                spans[frame[2]] = (pos, count - frame[3])
+        else:
+            return pos, count
 
 
 @maybelogged
-def thaw(frozen_data):
-    fh = io.BytesIO(frozen_data)
-    data = deserialize(fh)
-    fh.close()
-    return data
+def thaw(frozen_data, lazy=False, select=None, workers=None, dedupe=None,
+         numeric_arrays=None, records=False):
+    """
+    Decodes the Perl ``freeze``/``nfreeze`` output *frozen_data*.
+
+    With *lazy*, arrays and hashes are returned as
+    :class:`~storable.lazy.LazyArray` and :class:`~storable.lazy.LazyHash`
+    proxies that decode their children on first access. *frozen_data* is
+    then referenced, not copied, so it must not be modified while the
+    proxies are in use.
+
+    *select* is a path like ``['users', '*', 'email']``: only the data on it
+    is decoded and returned, everything else is skipped. See
+    :mod:`storable.paths`.
+
+    With *workers*, the elements of a large top level array or hash are
+    decoded by that many worker processes. See :mod:`storable.parallel`.
+
+    *dedupe* is a :class:`ScalarCache`: equal short scalars then decode to
+    the same object.
+
+    With *numeric_arrays*, arrays that only hold integers or only doubles
+    are returned as ``array.array('q')`` or ``array.array('d')`` (with
+    ``'array'``) or NumPy arrays (with ``'numpy'``, or with True when NumPy
+    is installed) instead of lists.
+
+    With *records*, hashes are returned as records with an attribute per
+    key, of a generated class with ``__slots__`` for every order of keys.
+    See :mod:`storable.shapes`.
+
+    *dedupe*, *numeric_arrays* and *records* only apply when all of the data
+    is decoded in this process: combined with *select*, *lazy* or *workers*
+    they raise a ValueError.
+    """
+    if select is not None:
+        _full_decode_only('select', dedupe, numeric_arrays, records)
+        from .paths import thaw as select_thaw
+        return select_thaw(memoryview(frozen_data), select)
+    if lazy:
+        _full_decode_only('lazy', dedupe, numeric_arrays, records)
+        from .lazy import thaw as lazy_thaw
+        return lazy_thaw(memoryview(frozen_data))
+    if workers is not None:
+        _full_decode_only('workers', dedupe, numeric_arrays, records)
+        from .parallel import thaw_split
+        return thaw_split(frozen_data, workers)
+    return _decode(memoryview(frozen_data), 0, dedupe=dedupe,
+                   numeric_arrays=numeric_arrays, records=records)[0]
+
+
+def _full_decode_only(option, dedupe, numeric_arrays, records):
+    if dedupe is not None or numeric_arrays or records:
+        raise ValueError('%s cannot be combined with dedupe, numeric_arrays '
+                         'or records' % option)
+
+
+def thaw_many(blobs, generator=False):
+    """
+    Decodes every ``freeze``/``nfreeze`` output in the iterable *blobs*
+    with one :class:`Decoder`. Returns a list, or with *generator* a
+    generator that decodes the storables as they are consumed.
+    """
+    results = Decoder().decode_many(blobs)
+    return results if generator else list(results)
 
 
 @maybelogged
-def retrieve(filepath):
+def retrieve(filepath, use_mmap=False, lscalar_views=False, lazy=False,
+             key=None, workers=None, dedupe=None, numeric_arrays=None,
+             records=False):
+    """
+    Reads the Perl ``store``/``nstore`` file *filepath*. See :func:`thaw`
+    for *lazy*, *dedupe*, *numeric_arrays* and *records*, which cannot be
+    combined with *lazy*, *key* or *workers* either.
+
+    With *key* (a hash key or array index, or a tuple of them for nested
+    data) only that item is decoded, using the file's offset index sidecar.
+    The sidecar is built first if it is missing or out of date. See
+    :mod:`storable.index`.
+
+    With *workers*, the elements of a large top level array or hash are
+    decoded by that many worker processes, which map the file themselves.
+    See :mod:`storable.parallel`.
+
+    With *use_mmap*, the file is mapped read-only and decoded straight from
+    the mapping. This avoids reading a copy of the file into memory and lets
+    processes reading the same file share the OS page cache. When
+    *lscalar_views* is also set, large binary scalars (``SX_LSCALAR``) are
+    returned as read-only memoryviews into the mapping instead of being
+    copied and converted. The mapping stays open for as long as any of
+    those views is alive.
+    """
+    if key is not None:
+        _full_decode_only('key', dedupe, numeric_arrays, records)
+        from .index import retrieve_key
+        return retrieve_key(filepath, key)
+    if lazy:
+        _full_decode_only('lazy', dedupe, numeric_arrays, records)
+    if workers is not None and not lazy:
+        _full_decode_only('workers', dedupe, numeric_arrays, records)
+        from .parallel import retrieve_split
+        return retrieve_split(filepath, workers)
+    if use_mmap:
+        return _retrieve_mmap(filepath, lscalar_views, lazy, dedupe,
+                              numeric_arrays, records)
     data = None
     with open(filepath, 'rb') as fh:
         file_magic = fh.read(4)
         if file_magic == b'pst0':
-            data = deserialize(fh)
+            if lazy:
+                data = thaw(fh.read(), lazy=True)
+            else:
+                data = deserialize(fh, dedupe, numeric_arrays, records)
     return data
 
 
-def _read_unsigned_byte(fh):
-    return unpack('B', fh.read(1))[0]
-
+def _retrieve_mmap(filepath, lscalar_views, lazy, dedupe=None,
+                   numeric_arrays=None, records=False):
+    with open(filepath, 'rb') as fh:
+        if os.fstat(fh.fileno()).st_size < 4:
+            return None
+        mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mapped, 'madvise'):
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
 
-def skip_magic_header_if_present(fh):
-    curr_pos = fh.tell()
-    file_magic = fh.read(4)
-    if file_magic != b'pst0':
-        fh.seek(curr_pos)
+    buf = memoryview(mapped)
+    data = None
+    try:
+        if buf[:4] == b'pst0':
+            if lazy:
+                from .lazy import thaw as lazy_thaw
+                data = lazy_thaw(buf, 0, lscalar_views)
+            else:
+                data = _decode(buf, 0, lscalar_views, dedupe,
+                               numeric_arrays, records)[0]
+    finally:
+        if not (lscalar_views or lazy):
+            buf.release()
+            mapped.close()
+    return data
 
 
-@maybelogged
-def deserialize(fh):
-    skip_magic_header_if_present(fh)
-    magic_byte = _read_unsigned_byte(fh)
+def _read_header(buf, pos):
+    """
+    Parses the storable header starting at *pos* (after the optional ``pst0``
+    file magic) and returns a fresh decoding cache with precompiled struct
+    unpackers for the header's byte order and sizes, together with the offset
+    of the first item.
+    """
+    magic_byte = buf[pos]
 
     is_network_byte_order = (magic_byte & 1) == 1
     major_version_number = magic_byte >> 1
-    minor_version_number = _read_unsigned_byte(fh)
+    minor_version_number = buf[pos + 1]
+    pos += 2
 
     nvsize = 8  # Size of double in bytes
-    integer_formats = {
-        2: 'H',
-        4: 'I',
-        8: 'Q',
-    }
-    double_formats = {
-        4: 'f',
-        8: 'd',
-    }
     if is_network_byte_order:
         byteorder = '!'
         # TODO: unsure what these values should be when reading a net-order
         # file
         intsize = 4
-        longsize = 8
-        ptrsize = 4
+        ivsize = 8
     else:
-        size = _read_unsigned_byte(fh)
-        archsize = fh.read(size)
+        size = buf[pos]
+        archsize = buf[pos + 1:pos + 1 + size].tobytes()
+        pos += 1 + size
 
         # 32-bit ppc:     4321
         # 32-bit x86:     1234
@@ -493,198 +1297,678 @@ def deserialize(fh):
         else:
             byteorder = '>'
 
-        x = fh.read(3)
-        intsize, longsize, ptrsize = unpack('3B', x)
+        # The byteorder string has one digit per byte of a Perl IV, which is
+        # what SX_INTEGER holds. This is not always sizeof(long): 32-bit
+        # perls built with 64-bit integers write 4 as longsize.
+        ivsize = size
+
+        intsize, longsize, ptrsize = buf[pos], buf[pos + 1], buf[pos + 2]
+        pos += 3
         if (major_version_number, minor_version_number) >= (2, 2):
-            nvsize = _read_unsigned_byte(fh)
+            nvsize = buf[pos]
+            pos += 1
             if nvsize > 8:
                 raise ValueError('Cannot handle 16 byte doubles')
 
+    size_struct = Struct(byteorder + integer_formats[intsize])
+    int_struct = Struct(byteorder + signed_integer_formats[ivsize])
+    double_struct = Struct(byteorder + double_formats[nvsize])
     cache = {
-        'objects': {},
-        'objectnr': 0,
+        'objects': [],
+        'pending': [],
+        'stack': [],
         'classes': [],
-        'has_sx_object': False,
-        'size_unpack_fmt': byteorder + integer_formats[intsize],
-        'int_unpack_fmt': byteorder + integer_formats[longsize],
-        'double_unpack_fmt': byteorder + double_formats[nvsize],
+        'size_unpack': size_struct.unpack_from,
+        'size_len': size_struct.size,
+        'int_unpack': int_struct.unpack_from,
+        'int_len': int_struct.size,
+        'double_unpack': double_struct.unpack_from,
+        'double_len': double_struct.size,
+        'guess': _guess_type,
+        'utf8': bytes.decode,
+        'keys': {},
+        'keys_max': KEY_CACHE_SIZE,
+        'numeric_arrays': None,
+        # ids of the hashes that must not become records, None without them
+        'pinned': None,
+        # opcode: array typecode, struct format and size with the opcode
+        'numeric_formats': {
+            0x06: ('q', int_struct.format, 1 + int_struct.size),
+            0x07: ('d', double_struct.format, 1 + double_struct.size),
+            0x08: ('q', '!B', 2),
+            0x09: ('q', NETINT.format, 5),
+        },
     }
-    data = process_item(fh, cache)
+    return cache, pos
+
+
+def _header_end(buf, pos):
+    """
+    Returns the offset right after the storable header starting at *pos*.
+    """
+    magic_byte = buf[pos]
+    if magic_byte & 1:
+        return pos + 2
+    end = pos + 3 + buf[pos + 2] + 3
+    if (magic_byte >> 1, buf[pos + 1]) >= (2, 2):
+        end += 1
+    return end
+
+
+# The decoder setup of every distinct header seen by _cached_header(), by
+# the header bytes.
+_header_configs = {}
+
+
+def _cached_header(buf, pos, configs=_header_configs):
+    """
+    Same as _read_header(), but the struct setup is only built once for
+    every distinct header and kept in *configs*, which matters when decoding
+    many small storables. The storables decoded with one setup also share
+    its hash key table.
+    """
+    end = _header_end(buf, pos)
+    key = buf[pos:end].tobytes()
+    config = configs.get(key)
+    if config is None:
+        config = _read_header(buf, pos)[0]
+        configs[key] = config
+    return dict(config, objects=[], pending=[], stack=[], classes=[]), end
+
+
+integer_formats = {
+    2: 'H',
+    4: 'I',
+    8: 'Q',
+}
+signed_integer_formats = {
+    2: 'h',
+    4: 'i',
+    8: 'q',
+}
+double_formats = {
+    4: 'f',
+    8: 'd',
+}
+
+
+def _decode(buf, pos, lscalar_views=False, dedupe=None, numeric_arrays=None,
+            records=False):
+    """
+    Decodes one storable image from the memoryview *buf* starting at offset
+    *pos*. Returns the decoded data and the offset right after it.
+    """
+    if buf[pos:pos + 4] == b'pst0':
+        pos += 4
+    cache, pos = _cached_header(buf, pos)
+    cache['lscalar_views'] = lscalar_views
+    if dedupe is not None:
+        _use_dedupe(cache, dedupe)
+    if numeric_arrays is not None:
+        cache['numeric_arrays'] = _numeric_arrays(numeric_arrays)
+    if records:
+        cache['pinned'] = set()
+    return process_item(buf, pos, cache)
+
+
+class Decoder(object):
+    """
+    Decodes many storables one after the other. The struct setup for every
+    distinct header (byte order, integer and double sizes, version) is
+    built the first time that header is seen, so each storable only costs
+    a fresh set of per-storable state on top of the decoding itself.
+
+    *scalars* is the policy for converting the bytes of scalars and hash
+    keys:
+
+    * ``'legacy'``: what :func:`thaw` does, numbers become int or float,
+      ASCII text str and anything else stays bytes,
+    * ``'numeric'``: the same results for the usual data, but only bytes
+      that look like a number are tried as one, which is a lot faster for
+      text. ``'inf'``, ``'nan'`` and numbers with whitespace around them
+      stay strings,
+    * ``'str'``: ASCII text becomes str, nothing is converted to numbers,
+    * ``'raw'``: everything stays bytes.
+
+    UTF-8 strings (``SX_UTF8STR``) are always decoded to str.
+
+    Hash keys are converted once per decoder: the converted keys are kept in
+    a table of up to *key_cache* entries, shared by everything it decodes,
+    so the hashes of all the storables share their key objects.
+
+    With *dedupe*, a :class:`ScalarCache`, equal short scalars decode to
+    the same object in all the storables. See :func:`thaw` for
+    *numeric_arrays* and *records*.
+    """
 
-    if cache['has_sx_object']:
-        handle_sx_object_refs(cache, data)
+    def __init__(self, lscalar_views=False, scalars='legacy',
+                 key_cache=KEY_CACHE_SIZE, dedupe=None, numeric_arrays=None,
+                 records=False):
+        if scalars not in SCALAR_POLICIES:
+            raise ValueError('Unknown scalar policy %r, use one of %s' % (
+                scalars, ', '.join(sorted(SCALAR_POLICIES))))
+        self.lscalar_views = lscalar_views
+        self.scalars = scalars
+        self.configs = {}
+        self.keys = {}
+        self.key_cache = key_cache
+        self.dedupe = dedupe
+        self.numeric_arrays = _numeric_arrays(numeric_arrays)
+        self.records = records
+
+    def decode(self, frozen_data):
+        """
+        Decodes one ``freeze``/``nfreeze`` output or ``store`` file image.
+        """
+        buf = memoryview(frozen_data)
+        pos = 4 if frozen_data[:4] == b'pst0' else 0
+        if buf[pos] & 1:
+            # network order, the header is just the version
+            end = pos + 2
+        else:
+            end = _header_end(buf, pos)
+        header = bytes(frozen_data[pos:end])
+        config = self.configs.get(header)
+        if config is None:
+            config = _read_header(buf, pos)[0]
+            config['lscalar_views'] = self.lscalar_views
+            config['guess'] = SCALAR_POLICIES[self.scalars]
+            config['keys'] = self.keys
+            config['keys_max'] = self.key_cache
+            if self.dedupe is not None:
+                _use_dedupe(config, self.dedupe)
+            config['numeric_arrays'] = self.numeric_arrays
+            self.configs[header] = config
+        cache = config.copy()
+        cache['objects'] = []
+        cache['pending'] = []
+        cache['stack'] = []
+        cache['classes'] = []
+        if self.records:
+            cache['pinned'] = set()
+        return process_item(buf, end, cache)[0]
+
+    def decode_many(self, blobs):
+        """
+        Yields the decoded data of every storable in the iterable *blobs*.
+        """
+        decode = self.decode
+        for frozen_data in blobs:
+            yield decode(frozen_data)
 
+
+@maybelogged
+def deserialize(fh, dedupe=None, numeric_arrays=None, records=False):
+    """
+    Decodes the storable at the current position of the binary file handle
+    *fh* and leaves *fh* right after it. A seekable handle is read to the
+    end and then moved back, anything else (pipes, sockets) is read
+    exactly up to the end of the storable.
+    """
+    if not fh.seekable():
+        buf = _read_storable(fh)
+        return _decode(memoryview(buf), 0, dedupe=dedupe,
+                       numeric_arrays=numeric_arrays, records=records)[0]
+    start = fh.tell()
+    buf = fh.read()
+    data, pos = _decode(memoryview(buf), 0, dedupe=dedupe,
+                        numeric_arrays=numeric_arrays, records=records)
+    # leave the handle right after the data we consumed, like the
+    # previous read-as-you-go implementation did
+    fh.seek(start + pos)
     return data
 
 
+def _read_storable(fh):
+    """
+    Reads the bytes of one storable from *fh* without reading past its end,
+    in pieces of the size the push decoder asks for.
+    """
+    from .push import PushDecoder
+
+    decoder = PushDecoder(raw=True)
+    while True:
+        chunk = fh.read(decoder.needed)
+        if not chunk:
+            decoder.close()
+            raise ValueError('No storable data left to read')
+        results = decoder.feed(chunk)
+        if results:
+            return results[0]
+
+
+@maybelogged
+def freeze(py_jsonable, pst_prefix=True, version=(5, 9), native=False):
+    """
+    Returns the storable form of *py_jsonable*, like Perl's ``nfreeze``,
+    or with *native* like Perl's ``freeze``. See :func:`freeze_into`.
+    """
+    out = bytearray()
+    freeze_into(py_jsonable, out, pst_prefix, version, native)
+    return bytes(out)
+
+
 @maybelogged
-def freeze(py_jsonable, pst_prefix=True, version=(5, 9)):
-    ret_bytes = bytes()
+def freeze_into(py_jsonable, buffer, pst_prefix=True, version=(5, 9),
+                native=False):
+    """
+    Like :func:`freeze`, but appends the output to *buffer*: a bytearray or
+    a writable binary file object such as ``io.BytesIO``. Everything is
+    written in one pass in the order it is produced, so the time taken
+    grows linearly with the size of the output. Returns *buffer*.
+
+    *version* is the first header byte and the Storable minor version the
+    output is for. The output is in network order, unless *native* is
+    set: then the header describes this machine's byte order and sizes,
+    integers are written as 8 byte ``SX_INTEGER`` and floats as
+    ``SX_DOUBLE``, all in native order, which Perl reads without
+    converting anything.
+    """
+    write = getattr(buffer, 'write', None) or buffer.extend
     if pst_prefix:
-        ret_bytes += b'pst0'
-    ret_bytes += bytes(bytearray(version))
-    ret_bytes += process_item(py_jsonable)
-    return ret_bytes
+        write(b'pst0')
+    _write_header(write, version, native)
+    serialize_item(py_jsonable, _encoder(write, native))
+    return buffer
+
+
+def _write_header(write, version, native):
+    major, minor = version
+    if not native:
+        write(bytes(bytearray((major | 1, minor))))
+        return
+    major &= ~1
+    write(bytes(bytearray((major, minor, len(NATIVE_BYTEORDER)))))
+    write(NATIVE_BYTEORDER)
+    sizes = [calcsize('i'), calcsize('l'), calcsize('P')]
+    if (major >> 1, minor) >= (2, 2):
+        sizes.append(NATIVE_DOUBLE.size)
+    write(bytes(bytearray(sizes)))
+
+
+# Size of the chunks in which store(), nstore() and nstore_fd() write
+STORE_CHUNK_SIZE = 1 << 16
+
+
+class _ChunkWriter(object):
+    """
+    Collects the pieces of the output and hands them to *sink* in chunks of
+    about *chunk_size* bytes, so that only one chunk is held in memory.
+    """
+
+    def __init__(self, sink, chunk_size):
+        self.sink = sink
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+
+    def write(self, data):
+        buffer = self.buffer
+        buffer += data
+        if len(buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.sink(self.buffer)
+            self.buffer = bytearray()
+
+
+def _sink(fh):
+    """
+    Returns a function that writes all the bytes it is given to the binary
+    file or socket *fh*. A non-blocking raw file that cannot take all of
+    them raises BlockingIOError, with the number of bytes of the chunk that
+    were written.
+    """
+    sendall = getattr(fh, 'sendall', None)
+    if sendall is not None:
+        return sendall
+    write = fh.write
+    raw = isinstance(fh, io.RawIOBase)
+
+    def write_all(data):
+        view = memoryview(data)
+        done = 0
+        while done < len(view):
+            written = write(view[done:])
+            if written is None:
+                if raw:
+                    # a non-blocking raw file that would block
+                    raise BlockingIOError(
+                        errno.EAGAIN, 'The file is not ready for writing',
+                        done)
+                # other file objects write everything or raise
+                break
+            # raw files can write less than they were given
+            done += written
+    return write_all
+
+
+def _store_fd(py_jsonable, fh, version, chunk_size, native):
+    writer = _ChunkWriter(_sink(fh), chunk_size)
+    freeze_into(py_jsonable, writer, True, version, native)
+    writer.flush()
 
 
 @maybelogged
-def unsigned_int(value, area=4, depth=0):
+def nstore_fd(py_jsonable, fh, version=(5, 9), chunk_size=STORE_CHUNK_SIZE):
     """
-    Returns unsigned value with area param's byte-length
-    This is also used for writing out the size
+    Writes *py_jsonable* to *fh*, a binary file object or a socket, like
+    Perl's ``nstore_fd``: the ``pst0`` file magic followed by the
+    ``nfreeze`` output. The output is handed over in chunks of
+    *chunk_size* bytes as it is produced, so only one chunk of it is ever
+    held in memory.
     """
-    final = []
-    for i in range(area-1, -1, -1):
-        digit = 256**i
-        dig_val = value // digit
-        final.append(dig_val)
-        value -= (dig_val * digit)
-    return bytes(bytearray(final))
+    _store_fd(py_jsonable, fh, version, chunk_size, False)
 
 
 @maybelogged
-def byte_len(size, area=4):
-    return unsigned_int(size, area=area)
+def store_fd(py_jsonable, fh, version=(5, 9), chunk_size=STORE_CHUNK_SIZE):
+    """
+    Same as :func:`nstore_fd`, but in native order like Perl's
+    ``store_fd``.
+    """
+    _store_fd(py_jsonable, fh, version, chunk_size, True)
 
 
 @maybelogged
-def signed_smallint(value, depth=0):
+def nstore(py_jsonable, filepath, version=(5, 9), chunk_size=STORE_CHUNK_SIZE):
     """
-    Returns signed value
+    Writes *py_jsonable* to the file *filepath* like Perl's ``nstore``,
+    see :func:`nstore_fd`.
     """
-    negative = (value < 0)
-    value = abs(value)
-    if value >= 128:
-        raise ValueError("A small int must be less <128 to fit in a byte.")
-    if not negative:
-        value = value + 128
-    return b'\x08' + bytes(bytearray([value]))
+    with open(filepath, 'wb') as fh:
+        nstore_fd(py_jsonable, fh, version, chunk_size)
 
 
 @maybelogged
-def signed_normalint(value, area=4, depth=0):
+def store(py_jsonable, filepath, version=(5, 9), chunk_size=STORE_CHUNK_SIZE):
     """
-    Returns signed value
+    Writes *py_jsonable* to the file *filepath* in native order like Perl's
+    ``store``, see :func:`store_fd`.
     """
-    # TODO: accept cache arg and depend on int_unpack_fmt
-    return b'\x09' + pack('!i', value)
+    with open(filepath, 'wb') as fh:
+        store_fd(py_jsonable, fh, version, chunk_size)
+
+
+# Byte order string of the header of native output, for the 8 byte
+# integers it holds
+NATIVE_BYTEORDER = b'12345678' if sys.byteorder == 'little' else b'87654321'
+_NATIVE = '<' if sys.byteorder == 'little' else '>'
+
+# Packers for the output, in network order and in native order
+NETDOUBLE = Struct('!d')
+NATIVE_SIZE = Struct(_NATIVE + 'I')
+NATIVE_INTEGER = Struct(_NATIVE + 'q')
+NATIVE_DOUBLE = Struct(_NATIVE + 'd')
+_SMALL = Struct('!BB')
+
+# Encoder setups, see _encoder()
+_encoders = {
+    False: {
+        'native': False,
+        'size_pack': NETTAG.pack,
+        'double_pack': NETDOUBLE.pack,
+    },
+    True: {
+        'native': True,
+        'size_pack': NATIVE_SIZE.pack,
+        'int_pack': NATIVE_INTEGER.pack,
+        'double_pack': NATIVE_DOUBLE.pack,
+    },
+}
+
+
+def _encoder(write, native):
+    """
+    Returns the state the serializers share: the *write* function for the
+    output, the packers for its byte order, the object number and the
+    object itself of every array and hash written so far by id (``seen``,
+    which keeps them alive so that their ids are not reused) and the number
+    the next item gets (``count``).
+    """
+    return dict(_encoders[bool(native)], write=write, seen={}, count=0)
+
+
+def _start_container(x, cache, depth, opcode):
+    """
+    Writes the start of the array or hash *x*, behind a reference unless it
+    is the top level item. If *x* was written before, a back-reference to
+    it (``SX_OBJECT``) is written instead and False is returned.
+
+    Object numbers follow Storable: every item gets the next one in the
+    order they are written, the reference before what it refers to, except
+    for the back-references themselves.
+    """
+    write = cache['write']
+    if depth:
+        write(b'\x04')
+        cache['count'] += 1
+    seen = cache['seen']
+    known = seen.get(id(x))
+    if known is not None:
+        write(b'\x00')
+        write(NETTAG.pack(known[0]))
+        return False
+    seen[id(x)] = (cache['count'], x)
+    cache['count'] += 1
+    write(opcode)
+    return True
+
+
+def _string_bytes(s):
+    if isinstance(s, bytes):
+        return s
+    elif isinstance(s, str):
+        return s.encode('utf-8')
+    elif isinstance(s, (io.BytesIO, io.BufferedReader)):
+        return s.read()
+    return str(s).encode('utf-8')
+
+
+INT_MAX = 2147483647
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
 
 
 @maybelogged
-def serialize_double(value, depth=0):
-    return b'\x07' + pack('!d', value)
+def signed_smallint(value, cache, depth=0):
+    if not -128 <= value < 128:
+        raise ValueError("A small int must be less <128 to fit in a byte.")
+    cache['write'](_SMALL.pack(0x08, value + 128))
 
 
 @maybelogged
-def serialize_string(s, area=4, depth=0):
-    if isinstance(s, bytes):
-        ret_bytes = s
-    elif isinstance(s, basestring):
-        ret_bytes = s.encode('utf-8')
-    elif isinstance(s, io.BytesIO):
-        ret_bytes = s.read().encode('utf-8')
-    elif isinstance(s, io.BufferedReader):
-        ret_bytes = s.read().encode('utf-8')
+def signed_normalint(value, cache, depth=0):
+    write = cache['write']
+    if cache['native']:
+        write(b'\x06')
+        write(cache['int_pack'](value))
+    else:
+        write(b'\x09')
+        write(NETINT.pack(value))
+
+
+@maybelogged
+def serialize_integer(value, cache, depth=0):
+    if -128 <= value < 128:
+        signed_smallint(value, cache, depth)
+    elif cache['native']:
+        if INT64_MIN <= value <= INT64_MAX:
+            signed_normalint(value, cache, depth)
+        else:
+            serialize_scalar(value, cache, depth)
+    elif abs(value) < INT_MAX:
+        signed_normalint(value, cache, depth)
+    else:
+        # too big so print it out like a string
+        serialize_scalar(value, cache, depth)
+
+
+@maybelogged
+def serialize_double(value, cache, depth=0):
+    cache['write'](b'\x07')
+    cache['write'](cache['double_pack'](value))
+
+
+@maybelogged
+def serialize_float(value, cache, depth=0):
+    if cache['native'] or value > INT_MAX:
+        serialize_double(value, cache, depth)
     else:
-        ret_bytes = str(s).encode('utf-8')
-    return bytes(byte_len(len(ret_bytes), area) + ret_bytes)
+        serialize_scalar(value, cache, depth)
+
 
 @maybelogged
-def serialize_scalar(py_str, depth=0):
-    return b'\x0a' + serialize_string(py_str, area=1, depth=depth)
+def serialize_scalar(py_str, cache, depth=0):
+    write = cache['write']
+    data = _string_bytes(py_str)
+    if len(data) > 255:
+        write(b'\x01')
+        write(cache['size_pack'](len(data)))
+    else:
+        write(_SMALL.pack(0x0a, len(data)))
+    write(data)
+
 
 @maybelogged
-def serialize_longscalar(py_str, depth=0):
-    return b'\x01' + serialize_string(py_str, area=4, depth=depth)
+def serialize_longscalar(py_str, cache, depth=0):
+    write = cache['write']
+    data = _string_bytes(py_str)
+    write(b'\x01')
+    write(cache['size_pack'](len(data)))
+    write(data)
 
 
 @maybelogged
-def serialize_unicode(py_str, depth=0):
-    return b'\x18' + serialize_string(py_str, area=4, depth=depth)
+def serialize_unicode(py_str, cache, depth=0):
+    write = cache['write']
+    data = _string_bytes(py_str)
+    if len(data) > 255:
+        write(b'\x18')
+        write(cache['size_pack'](len(data)))
+    else:
+        write(_SMALL.pack(0x17, len(data)))
+    write(data)
 
 
 @maybelogged
-def serialize_null(isNone, depth=0):
-    return b'\x05' + b''
+def serialize_null(isNone, cache, depth=0):
+    cache['write'](b'\x05')
 
 
 @maybelogged
-def serialize_array(py_arr, depth=0):
+def serialize_array(py_arr, cache, depth=0):
     # note, for 0-length arrays, it'll be the length
     # and then nothing after
-    prefix = b''
-    if depth == 0:
-        prefix = b'\x02'
-    else:
-        prefix = b'\x04\x02'
-    return prefix + bytes(byte_len(len(py_arr)) + b''.join([process_item(x, depth=depth+1) for x in py_arr]))
+    if not _start_container(py_arr, cache, depth, b'\x02'):
+        return
+    cache['write'](cache['size_pack'](len(py_arr)))
+    depth += 1
+    for x in py_arr:
+        serialize_item(x, cache, depth)
 
 
 @maybelogged
-def serialize_dict(py_dict, depth=0):
+def serialize_dict(py_dict, cache, depth=0):
     """
     dicts (or associative arrays) start with the
     *number of keys* (not byte length) and then
     does value-key pairs with the key mostly being
     a string
     """
-    dict_len = len(py_dict)  # number of keys
-    v_bytes = b''
+    if not _start_container(py_dict, cache, depth, b'\x03'):
+        return
+    write = cache['write']
+    size_pack = cache['size_pack']
+    write(size_pack(len(py_dict)))
     for k, v in py_dict.items():
-        v_bytes += process_item(v, depth=depth+1)
-        v_bytes += serialize_string(str(k), depth=depth)
-    prefix = b''
-    if depth == 0:
-        prefix = b'\x03'
+        serialize_item(v, cache, depth + 1)
+        key = k if isinstance(k, bytes) else str(k).encode('utf-8')
+        write(size_pack(len(key)))
+        write(key)
+
+
+@maybelogged
+def serialize_str(py_str, cache, depth=0):
+    if py_str.isascii():
+        serialize_scalar(py_str, cache, depth)
     else:
-        prefix = b'\x04\x03'
-    return prefix + bytes(byte_len(dict_len)) + v_bytes
+        serialize_unicode(py_str, cache, depth)
+
+
+# The serializer of every type, see register_encoder()
+encoders = {
+    dict: serialize_dict,
+    list: serialize_array,
+    int: serialize_integer,
+    bool: serialize_integer,
+    float: serialize_float,
+    type(None): serialize_null,
+    io.BytesIO: serialize_longscalar,
+    io.BufferedReader: serialize_longscalar,
+    bytes: serialize_scalar,
+    str: serialize_str,
+}
 
+# Serializers that number the items they write themselves, see
+# _start_container()
+_self_numbering = {serialize_array, serialize_dict}
 
-INT_MAX = 2147483647
+# The serializer of every type seen so far, including subclasses of the
+# types in encoders
+_dispatch = dict(encoders)
+
+
+def register_encoder(type, fn):
+    """
+    Has :func:`freeze` and friends write values of *type* (and of its
+    subclasses) as what ``fn(value)`` returns: a str, number, bytes, None,
+    list, dict or anything else with an encoder. For instance::
+
+        register_encoder(decimal.Decimal, str)
+        register_encoder(datetime.datetime, datetime.datetime.isoformat)
+        register_encoder(uuid.UUID, str)
+    """
+    def serialize_converted(x, cache, depth=0):
+        serialize_item(fn(x), cache, depth)
+
+    encoders[type] = serialize_converted
+    _self_numbering.add(serialize_converted)
+    _dispatch.clear()
+    _dispatch.update(encoders)
 
 
 @maybelogged
 def detect_type(x):
-    if isinstance(x, dict):
-        return serialize_dict
-    elif isinstance(x, list):
-        return serialize_array
-    elif isinstance(x, int):
-        if -128 < x < 128:
-            return signed_smallint
-        elif abs(x) < INT_MAX:
-            return signed_normalint
-        else:
-            # too big so print it out like a string
-            return serialize_scalar
-    elif isinstance(x, bool):
-        return signed_smallint
-    elif isinstance(x, float):
-        if x > INT_MAX:
-            return serialize_double
-        else:
-            return serialize_scalar
-    elif x is None:
-        return serialize_null
-    elif isinstance(x, io.BytesIO):
-        return serialize_longscalar
-    elif isinstance(x, io.BufferedReader):
-        return serialize_longscalar
-    elif isinstance(x, basestring):
-        if max([ord(c) for c in x]) > 128:
-            return serialize_unicode
-        elif len(x) < 256:
-            return serialize_scalar
+    """
+    Returns the serializer for *x*: the one of its type, or else of the
+    nearest base class of its type that has one.
+    """
+    cls = type(x)
+    method = _dispatch.get(cls)
+    if method is None:
+        for base in cls.__mro__[1:]:
+            method = encoders.get(base)
+            if method is not None:
+                break
         else:
-            return serialize_longscalar
-    else:
-        raise NotImplementedError("unable to serialize type %s with value %s" % (type(x), x))
+            raise NotImplementedError("unable to serialize type %s with value %s" % (type(x), x))
+        _dispatch[cls] = method
+    return method
 
 
 @maybelogged
-def process_item(x, depth=0):
-    method = detect_type(x)
-    return bytes(method(x, depth=depth))
-
-
+def serialize_item(x, cache=None, depth=0):
+    """
+    Writes the storable form of *x* with the encoder state *cache* (see
+    _encoder()). Without it, returns the network order output instead.
+    """
+    if cache is None:
+        out = bytearray()
+        serialize_item(x, _encoder(out.extend, False), depth)
+        return bytes(out)
+    method = _dispatch.get(type(x)) or detect_type(x)
+    if method not in _self_numbering:
+        cache['count'] += 1
+    method(x, cache, depth)
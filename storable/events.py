@@ -0,0 +1,291 @@
+#
+# License
+#
+# python storable is distributed under the zlib/libpng license, which is OSS
+# (Open Source Software) compliant.
+#
+# Copyright (C) 2009 Tim Aerts
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Tim Aerts <aardbeiplantje@gmail.com>
+#
+
+"""
+Event based decoding of storables in constant memory.
+
+:func:`iterparse` yields ``(event, value)`` tuples while it reads through
+the data, without building the decoded structure:
+
+* ``('start_array', size)`` and ``('start_hash', size)`` open a container,
+* ``('end', None)`` closes it again,
+* ``('key', key)`` gives the key of the hash entry whose value was just
+  reported. Storable writes a hash value *before* its key, and the key
+  events keep that order so nothing has to be held back,
+* ``('scalar', value)`` is a plain value, decoded like :func:`storable.thaw`
+  does. Hooked (``STORABLE_freeze``) objects are reported as one scalar as
+  well,
+* ``('bless', classname)`` precedes the item that is blessed into
+  *classname*,
+* ``('backref', number)`` stands for an item that was seen before. Items are
+  numbered in the order they start, from 0, like Perl does: containers,
+  scalars, hooked objects and references each take a number.
+
+References themselves do not produce events, the item they point to does.
+"""
+
+from struct import error as StructError
+
+from .core import (
+    NETTAG,
+    _guess_type,
+    _hash_key,
+    _read_header,
+    _scalars,
+    engine,
+    process_item,
+    skip_item,
+)
+from .lazy import _ObjectTable
+
+
+CHUNK_SIZE = 64 * 1024
+
+# the longest possible header after the file magic
+_HEADER_MAX = 2 + 1 + 8 + 4
+
+_ARRAY = 0
+_HASH = 1
+_FLAG_HASH = 2
+
+
+class _Stream(object):
+    """
+    A window on the input. Byte buffers are used as they are, file handles
+    are read in chunks and only the part that is still needed is kept.
+    """
+
+    def __init__(self, source, chunk_size):
+        self.pos = 0
+        # offset of the window in the input
+        self.offset = 0
+        self.chunk_size = chunk_size
+        if hasattr(source, 'read'):
+            self.fh = source
+            self.data = bytearray()
+            self.eof = False
+        else:
+            self.fh = None
+            self.data = source
+            self.eof = True
+        self.view = memoryview(self.data)
+
+    def fill(self, size):
+        """
+        Makes *size* bytes from the current position available if the input
+        has that many left. Returns the number of bytes available.
+        """
+        available = len(self.data) - self.pos
+        if available >= size or self.eof:
+            return available
+        self.view.release()
+        del self.data[:self.pos]
+        self.offset += self.pos
+        self.pos = 0
+        while len(self.data) < size:
+            chunk = self.fh.read(max(self.chunk_size, size - len(self.data)))
+            if not chunk:
+                self.eof = True
+                break
+            self.data += chunk
+        self.view = memoryview(self.data)
+        return len(self.data)
+
+    def need(self, size):
+        if self.fill(size) < size:
+            raise ValueError('Storable data is truncated at offset %d'
+                             % (self.offset + len(self.data)))
+        return self.view
+
+    def item_end(self, cache):
+        """
+        Makes the whole item at the current position available and returns
+        the offset right after it and the number of object numbers it uses.
+        """
+        while True:
+            try:
+                end, used = skip_item(self.view, self.pos, cache, False)
+            except (IndexError, StructError):
+                end = None
+            if end is not None and end <= len(self.data):
+                return end, used
+            if self.eof:
+                raise ValueError('Storable data is truncated at offset %d'
+                                 % (self.offset + len(self.data)))
+            available = len(self.data) - self.pos
+            self.fill(max(2 * available, end - self.pos if end else 0, 16))
+
+    def close(self):
+        self.view.release()
+        if self.fh is not None and hasattr(self.fh, 'seekable'):
+            if self.fh.seekable():
+                # leave the file right after the storable, like deserialize()
+                self.fh.seek(self.pos - len(self.data), 1)
+
+
+def _hooked_object(hooked, tag):
+    try:
+        return hooked[tag]
+    except KeyError:
+        raise ValueError('iterparse() cannot resolve object %d for a hooked '
+                         'object' % tag)
+
+
+def iterparse(source, chunk_size=CHUNK_SIZE):
+    """
+    Yields the decoding events (see :mod:`storable.events`) of the storable
+    in *source*, which is either a byte buffer or a file handle opened in
+    binary mode. A file handle is read in chunks of *chunk_size* bytes and
+    is left right after the storable if it is seekable. The ``pst0`` magic
+    of ``store`` files is skipped if present.
+    """
+    stream = _Stream(source, chunk_size)
+    try:
+        if stream.fill(4) >= 4 and stream.view[:4] == b'pst0':
+            stream.pos += 4
+        stream.fill(_HEADER_MAX)
+        cache, stream.pos = _read_header(stream.view, stream.pos)
+        cache['lscalar_views'] = False
+        for event in _events(stream, cache):
+            yield event
+    finally:
+        stream.close()
+
+
+def _events(stream, cache):
+    size_unpack = cache['size_unpack']
+    size_len = cache['size_len']
+    classes = cache['classes']
+    stack = []
+    tag = 0
+    hooked = {}
+
+    while True:
+        view = stream.need(1)
+        pos = stream.pos
+        magic_type = view[pos]
+        if magic_type == 0x04 or magic_type == 0x14:
+            # SX_REF, SX_OVERLOAD: the referent follows
+            stream.pos += 1
+            tag += 1
+            continue
+        elif 0x0b <= magic_type <= 0x0d:
+            # SX_TIED_ARRAY, SX_TIED_HASH, SX_TIED_SCALAR
+            stream.pos += 1
+            continue
+        elif magic_type == 0x11:
+            # SX_BLESS
+            size = stream.need(2)[stream.pos + 1]
+            view = stream.need(2 + size)
+            pos = stream.pos
+            classname = view[pos + 2:pos + 2 + size].tobytes()
+            classes.append(classname)
+            stream.pos += 2 + size
+            yield 'bless', classname
+            continue
+        elif magic_type == 0x12:
+            # SX_IX_BLESS
+            view = stream.need(2)
+            pos = stream.pos
+            stream.pos += 2
+            yield 'bless', classes[view[pos + 1]]
+            continue
+        elif magic_type == 0x02 or magic_type == 0x03 or magic_type == 0x19:
+            flags_len = 1 if magic_type == 0x19 else 0
+            view = stream.need(1 + flags_len + size_len)
+            pos = stream.pos
+            size = size_unpack(view, pos + 1 + flags_len)[0]
+            stream.pos += 1 + flags_len + size_len
+            tag += 1
+            if magic_type == 0x02:
+                yield 'start_array', size
+                kind = _ARRAY
+            else:
+                yield 'start_hash', size
+                kind = _FLAG_HASH if flags_len else _HASH
+            if size:
+                stack.append([kind, size])
+                continue
+            yield 'end', None
+        elif magic_type == 0x0a:
+            # SX_SCALAR, the most common item by far
+            size = stream.need(2)[stream.pos + 1]
+            view = stream.need(2 + size)
+            pos = stream.pos
+            stream.pos += 2 + size
+            tag += 1
+            yield 'scalar', _guess_type(view[pos + 2:pos + 2 + size].tobytes())
+        elif magic_type == 0x00:
+            # SX_OBJECT
+            view = stream.need(5)
+            pos = stream.pos
+            stream.pos += 5
+            yield 'backref', NETTAG.unpack_from(view, pos + 1)[0]
+        else:
+            end, used = stream.item_end(cache)
+            view = stream.view
+            pos = stream.pos
+            if magic_type in _scalars:
+                value = engine[magic_type](view, pos + 1, cache)[0]
+            else:
+                # hooked objects and tied elements, which can refer to the
+                # objects inside earlier hooked objects
+                objects = _ObjectTable(
+                    lambda i: _hooked_object(hooked, i), tag)
+                item_cache = dict(cache, pending=[], stack=[], objects=objects)
+                value = process_item(view, pos, item_cache)[0]
+                for i, obj in enumerate(objects.items):
+                    hooked[tag + i] = obj
+            stream.pos = end
+            tag += used
+            yield 'scalar', value
+
+        # the item is complete, which may complete the containers around it
+        while stack:
+            frame = stack[-1]
+            kind = frame[0]
+            if kind != _ARRAY:
+                flags_len = 1 if kind == _FLAG_HASH else 0
+                view = stream.need(flags_len + size_len)
+                pos = stream.pos + flags_len
+                keysize = size_unpack(view, pos)[0]
+                pos += size_len
+                view = stream.need(flags_len + size_len + keysize)
+                pos = stream.pos + flags_len + size_len
+                raw = view[pos:pos + keysize].tobytes()
+                stream.pos = pos + keysize
+                if kind == _HASH:
+                    yield 'key', _hash_key(raw, cache)
+                else:
+                    yield 'key', raw or None
+            frame[1] -= 1
+            if frame[1]:
+                break
+            stack.pop()
+            yield 'end', None
+        else:
+            return
@@ -0,0 +1,386 @@
+#
+# License
+#
+# python storable is distributed under the zlib/libpng license, which is OSS
+# (Open Source Software) compliant.
+#
+# Copyright (C) 2009 Tim Aerts
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Tim Aerts <aardbeiplantje@gmail.com>
+#
+
+"""
+Offset index files for random access into large ``store``/``nstore`` files.
+
+:func:`build_index` scans a file once and writes a sidecar file next to it
+(``<file>.idx``) with the byte offset, object number and opcode of every top
+level hash value or array element, and optionally of the items below them.
+``retrieve(path, key=...)`` then looks the item up in the sidecar and only
+decodes that item. A sidecar is ignored (and rebuilt) when the size or the
+modification time of the file it belongs to changed.
+
+Run ``python -m storable.index [--depth N] FILE...`` to build sidecars.
+"""
+
+from array import array
+from struct import Struct
+import mmap
+import os
+import sys
+
+from .paths import _Step, _Walker, _MISSING
+
+
+INDEX_SUFFIX = '.idx'
+
+# magic, version, root opcode, depth, file size, file mtime (ns), entry count,
+# key blob size, class count, class blob size
+_HEADER = Struct('<4sBBHqqqqqq')
+_MAGIC = b'PSIX'
+_VERSION = 1
+
+_CONTAINERS = (0x02, 0x03, 0x19)
+
+# the arrays are stored little endian
+_SWAP = sys.byteorder != 'little'
+
+
+class StorableIndex(object):
+    """
+    The offsets of the items in one storable file. Entry *i* is the item
+    with key ``keys[i]`` in the container that is entry ``parents[i]`` (-1
+    for the top level item). Array elements have their index as key.
+    """
+
+    def __init__(self, stat, root_opcode, depth):
+        self.size, self.mtime = stat
+        self.root_opcode = root_opcode
+        self.depth = depth
+        self.parents = array('q')
+        self.offsets = array('q')
+        self.tags = array('q')
+        self.opcodes = array('B')
+        self.key_ends = array('q')
+        self.key_blob = bytearray()
+        self.classes = []
+        self._lookup = None
+        self._counts = None
+
+    def add(self, parent, key, offset, tag, opcode):
+        self.parents.append(parent)
+        self.offsets.append(offset)
+        self.tags.append(tag)
+        self.opcodes.append(opcode)
+        self.key_blob += key
+        self.key_ends.append(len(self.key_blob))
+        return len(self.offsets) - 1
+
+    def key(self, i):
+        start = self.key_ends[i - 1] if i else 0
+        return bytes(self.key_blob[start:self.key_ends[i]])
+
+    def opcode(self, i):
+        return self.root_opcode if i < 0 else self.opcodes[i]
+
+    def find(self, parent, step):
+        """
+        Returns the entry of *step* (a hash key or array index) in the
+        container *parent*, or None if it is not indexed.
+        """
+        if self._lookup is None:
+            self._lookup = dict(
+                ((self.parents[i], self.key(i)), i)
+                for i in range(len(self.offsets)))
+        if (isinstance(step, int) and step < 0
+                and self.opcode(parent) == 0x02):
+            if self._counts is None:
+                self._counts = {}
+                for i in self.parents:
+                    self._counts[i] = self._counts.get(i, 0) + 1
+            step += self._counts.get(parent, 0)
+        for key in _Step(step).keys:
+            if (parent, key) in self._lookup:
+                return self._lookup[parent, key]
+        return None
+
+    def is_valid_for(self, filepath):
+        return (self.size, self.mtime) == _stat(filepath)
+
+    def write(self, index_path):
+        classes = self.classes
+        class_ends = array('q')
+        class_blob = bytearray()
+        for name in classes:
+            class_blob += name
+            class_ends.append(len(class_blob))
+        arrays = (self.parents, self.offsets, self.tags, self.key_ends,
+                  class_ends)
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'wb') as fh:
+            fh.write(_HEADER.pack(
+                _MAGIC, _VERSION, self.root_opcode, self.depth, self.size,
+                self.mtime, len(self.offsets), len(self.key_blob),
+                len(classes), len(class_blob)))
+            for values in arrays:
+                if _SWAP:
+                    values = array(values.typecode, values)
+                    values.byteswap()
+                fh.write(values.tobytes())
+            fh.write(self.opcodes.tobytes())
+            fh.write(self.key_blob)
+            fh.write(class_blob)
+        os.rename(tmp_path, index_path)
+
+    @classmethod
+    def read(cls, index_path):
+        with open(index_path, 'rb') as fh:
+            data = fh.read()
+        (magic, version, root_opcode, depth, size, mtime, count, key_size,
+         class_count, class_size) = _HEADER.unpack_from(data)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError('%s is not a storable index' % index_path)
+        index = cls((size, mtime), root_opcode, depth)
+        pos = _HEADER.size
+        index.parents, pos = _take(data, pos, 'q', count)
+        index.offsets, pos = _take(data, pos, 'q', count)
+        index.tags, pos = _take(data, pos, 'q', count)
+        index.key_ends, pos = _take(data, pos, 'q', count)
+        class_ends, pos = _take(data, pos, 'q', class_count)
+        index.opcodes, pos = _take(data, pos, 'B', count)
+        index.key_blob = bytearray(data[pos:pos + key_size])
+        pos += key_size
+        start = 0
+        for end in class_ends:
+            index.classes.append(data[pos + start:pos + end])
+            start = end
+        if pos + class_size != len(data):
+            raise ValueError('Storable index %s is truncated' % index_path)
+        return index
+
+
+def _take(data, pos, typecode, count):
+    values = array(typecode)
+    end = pos + values.itemsize * count
+    values.frombytes(data[pos:end])
+    if len(values) != count:
+        raise ValueError('Storable index is truncated')
+    if _SWAP:
+        values.byteswap()
+    return values, end
+
+
+def _stat(filepath):
+    st = os.stat(filepath)
+    return st.st_size, st.st_mtime_ns
+
+
+def _map(filepath):
+    with open(filepath, 'rb') as fh:
+        if os.fstat(fh.fileno()).st_size < 4:
+            raise ValueError('%s is not a storable file' % filepath)
+        mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    buf = memoryview(mapped)
+    if buf[:4] != b'pst0':
+        buf.release()
+        mapped.close()
+        raise ValueError('%s is not a storable file' % filepath)
+    return mapped, buf
+
+
+def _close(mapped, buf):
+    try:
+        buf.release()
+        mapped.close()
+    except BufferError:
+        # something still refers to the mapping, it is closed when that goes
+        pass
+
+
+def _index_children(walker, pos, tag, level):
+    """
+    Reads the children of the container at *pos* (which has object number
+    *tag*), and their children up to *level* levels down, in one pass.
+    Returns the offset right after the container, the number of object
+    numbers it uses and its children as ``(key, offset, tag, opcode,
+    children)`` tuples.
+    """
+    buf = walker.buf
+    cache = walker.cache
+    size_unpack = cache['size_unpack']
+    size_len = cache['size_len']
+    magic_type = buf[pos]
+    is_array = magic_type == 0x02
+    flags_len = 1 if magic_type == 0x19 else 0
+    size = size_unpack(buf, pos + 1 + flags_len)[0]
+    pos += 1 + flags_len + size_len
+    start_tag = tag
+    tag += 1
+    entries = []
+    for i in range(size):
+        inner, inner_tag = walker.unwrap(pos, tag)
+        children = ()
+        if level > 1 and buf[inner] in _CONTAINERS:
+            end, used, children = _index_children(
+                walker, inner, inner_tag, level - 1)
+            used += inner_tag - tag
+        else:
+            end, used = walker.skip(pos)
+        if is_array:
+            key = str(i).encode('ascii')
+        else:
+            keysize = size_unpack(buf, end + flags_len)[0]
+            key_pos = end + flags_len + size_len
+            key = buf[key_pos:key_pos + keysize].tobytes()
+            end = key_pos + keysize
+        entries.append((key, pos, tag, buf[inner], children))
+        pos = end
+        tag += used
+    return pos, tag - start_tag, entries
+
+
+def _add_entries(index, parent, entries):
+    for key, offset, tag, opcode, children in entries:
+        entry = index.add(parent, key, offset, tag, opcode)
+        if children:
+            _add_entries(index, entry, children)
+
+
+def build_index(filepath, depth=1, index_path=None):
+    """
+    Scans the storable file *filepath* and writes its offset index to
+    *index_path* (``filepath + '.idx'`` by default). *depth* is the number
+    of levels of hash values and array elements that are indexed. Returns
+    the :class:`StorableIndex`.
+    """
+    index_path = index_path or filepath + INDEX_SUFFIX
+    index = _scan(filepath, depth)
+    index.write(index_path)
+    _loaded[index_path] = index
+    return index
+
+
+def _scan(filepath, depth):
+    stat = _stat(filepath)
+    mapped, buf = _map(filepath)
+    try:
+        walker = _Walker(buf)
+        pos, tag = walker.unwrap(walker.root, 0)
+        index = StorableIndex(stat, buf[pos], depth)
+        if depth > 0 and buf[pos] in _CONTAINERS:
+            # registers all the class names on the way
+            entries = _index_children(walker, pos, tag, depth)[2]
+            _add_entries(index, -1, entries)
+        else:
+            # the class names, for decoding any item on its own
+            walker.skip(walker.root)
+        index.classes = walker.cache['classes']
+    finally:
+        walker = None
+        _close(mapped, buf)
+    return index
+
+
+# indexes that were used before, by sidecar path
+_loaded = {}
+
+
+def load_index(filepath, index_path=None, depth=1):
+    """
+    Returns the offset index of *filepath*, from its sidecar if that is
+    up to date and otherwise by scanning the file (and writing the sidecar
+    if possible).
+    """
+    index_path = index_path or filepath + INDEX_SUFFIX
+    index = _loaded.get(index_path)
+    if index is not None and index.is_valid_for(filepath):
+        return index
+    try:
+        index = StorableIndex.read(index_path)
+    except (IOError, OSError, ValueError):
+        index = None
+    if index is None or not index.is_valid_for(filepath):
+        index = _scan(filepath, depth)
+        try:
+            index.write(index_path)
+        except (IOError, OSError):
+            pass
+    _loaded[index_path] = index
+    return index
+
+
+def retrieve_key(filepath, key, index_path=None):
+    """
+    Decodes the item at *key* in the storable file *filepath*. *key* is a
+    hash key or array index, or a tuple of them for nested data. Only the
+    part of the path that is not in the index is looked up in the file.
+    Raises a KeyError if there is no such item.
+    """
+    path = key if isinstance(key, (tuple, list)) else (key,)
+    index = load_index(filepath, index_path)
+
+    entry = -1
+    done = 0
+    for step in path:
+        if done == index.depth or index.opcode(entry) not in _CONTAINERS:
+            # the rest of the path is not in the index
+            break
+        entry = index.find(entry, step)
+        if entry is None:
+            raise KeyError(key)
+        done += 1
+
+    mapped, buf = _map(filepath)
+    try:
+        walker = _Walker(buf)
+        walker.cache['classes'] = list(index.classes)
+        walker.scanned_to = len(buf)
+        if entry < 0:
+            pos, tag = walker.root, 0
+        else:
+            pos, tag = index.offsets[entry], index.tags[entry]
+        rest = [_Step(step) for step in path[done:]]
+        value = walker.project(pos, tag, rest)
+        for _ in rest:
+            if value is _MISSING or not value:
+                raise KeyError(key)
+            if isinstance(value, list):
+                value = value[0]
+            else:
+                value = next(iter(value.values()))
+        walker = None
+    finally:
+        _close(mapped, buf)
+    return value
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Build offset index files for storable files.')
+    parser.add_argument('--depth', type=int, default=1,
+                        help='number of nesting levels to index')
+    parser.add_argument('files', nargs='+')
+    args = parser.parse_args(argv)
+    for filepath in args.files:
+        index = build_index(filepath, args.depth)
+        print('%s: %d entries' % (filepath, len(index.offsets)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,373 @@
+#
+# License
+#
+# python storable is distributed under the zlib/libpng license, which is OSS
+# (Open Source Software) compliant.
+#
+# Copyright (C) 2009 Tim Aerts
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Tim Aerts <aardbeiplantje@gmail.com>
+#
+
+"""
+On-demand decoding of storables.
+
+``thaw(data, lazy=True)`` and ``retrieve(path, lazy=True)`` return
+:class:`LazyArray` and :class:`LazyHash` proxies instead of lists and dicts.
+A proxy only records where its children start in the buffer (the first time
+it is used) and decodes a child when it is accessed, caching the result.
+Nested arrays and hashes become proxies again, so reading a few keys from a
+huge structure only decodes what is on the way to them.
+"""
+
+from array import array
+from bisect import bisect_right
+try:
+    from collections.abc import Mapping, Sequence
+except ImportError:  # Python 2
+    from collections import Mapping, Sequence
+
+from .core import (
+    NETTAG,
+    _hash_key,
+    _read_header,
+    _scalars,
+    engine,
+    process_item,
+    skip_item,
+)
+
+
+class _Document(object):
+    """
+    Shared state of all the proxies decoded from one buffer: the buffer, the
+    decoder cache for its header and the table of materialised objects by
+    object number, which keeps back-references (``SX_OBJECT``) working
+    between separately decoded subtrees.
+    """
+
+    def __init__(self, buf, cache):
+        self.buf = buf
+        self.cache = cache
+        self.objects = {}
+        self.root = None
+        # class names are registered the first time bytes are passed over
+        self.scanned_to = 0
+        cache['spans'] = {}
+
+    def skip(self, pos):
+        end, used = skip_item(
+            self.buf, pos, self.cache, pos >= self.scanned_to)
+        if end > self.scanned_to:
+            self.scanned_to = end
+        return end, used
+
+    def item(self, pos, tag):
+        """
+        Materialises the item at *pos*, whose first object number is *tag*.
+        """
+        buf = self.buf
+        objects = self.objects
+        refs = []
+        while True:
+            magic_type = buf[pos]
+            if magic_type == 0x04 or magic_type == 0x14:
+                # SX_REF, SX_OVERLOAD: the referent follows
+                refs.append(tag)
+                tag += 1
+                pos += 1
+            elif 0x0b <= magic_type <= 0x0d:
+                # SX_TIED_ARRAY, SX_TIED_HASH, SX_TIED_SCALAR
+                pos += 1
+            elif magic_type == 0x11:
+                # SX_BLESS
+                end = pos + 2 + buf[pos + 1]
+                if pos >= self.scanned_to:
+                    self.cache['classes'].append(buf[pos + 2:end].tobytes())
+                    self.scanned_to = end
+                pos = end
+            elif magic_type == 0x12:
+                # SX_IX_BLESS
+                pos += 2
+            else:
+                break
+
+        if magic_type == 0x00:
+            value = self.resolve(NETTAG.unpack_from(buf, pos + 1)[0])
+        else:
+            if magic_type == 0x02:
+                size, pos = self._read_size(pos + 1)
+                value = LazyArray(self, pos, size, tag)
+            elif magic_type == 0x03:
+                size, pos = self._read_size(pos + 1)
+                value = LazyHash(self, pos, size, tag)
+            elif magic_type == 0x19:
+                size, pos = self._read_size(pos + 2)
+                value = LazyHash(self, pos, size, tag, flagged=True)
+            elif magic_type in _scalars:
+                value = engine[magic_type](buf, pos + 1, self.cache)[0]
+            else:
+                # hooks and tied elements are rare and small, they are
+                # decoded in one go
+                value = self._decode(pos, tag)
+            objects[tag] = value
+        for i in refs:
+            objects[i] = value
+        return value
+
+    def _read_size(self, pos):
+        cache = self.cache
+        return cache['size_unpack'](self.buf, pos)[0], pos + cache['size_len']
+
+    def _decode(self, pos, tag):
+        table = _ObjectTable(self.resolve, tag)
+        cache = dict(self.cache, objects=table, pending=[], stack=[],
+                     classes=list(self.cache['classes']))
+        value = process_item(self.buf, pos, cache)[0]
+        for i, obj in enumerate(table.items):
+            self.objects.setdefault(tag + i, obj)
+        return value
+
+    def resolve(self, tag):
+        """
+        Returns the object with number *tag*, materialising the containers on
+        the way to it from the root if that did not happen yet.
+        """
+        objects = self.objects
+        if tag in objects:
+            return objects[tag]
+        value = self.root
+        while tag not in objects:
+            if not isinstance(value, (LazyArray, LazyHash)):
+                raise ValueError('Invalid object number %d' % tag)
+            value = value._child_for_tag(tag)
+        return objects[tag]
+
+
+class _ObjectTable(object):
+    """
+    Stands in for the object list of process_item() when a subtree starting
+    at object number *base* is decoded in one go. Numbers below *base* are
+    looked up with *resolve*.
+    """
+
+    def __init__(self, resolve, base):
+        self.resolve = resolve
+        self.base = base
+        self.items = []
+        self.append = self.items.append
+
+    def __len__(self):
+        return self.base + len(self.items)
+
+    def __getitem__(self, i):
+        if i >= self.base:
+            return self.items[i - self.base]
+        return self.resolve(i)
+
+    def __setitem__(self, i, value):
+        self.items[i - self.base] = value
+
+
+class _LazyContainer(object):
+
+    __slots__ = ('_document', '_pos', '_size', '_tag', '_offsets', '_tags',
+                 '_children')
+
+    def __init__(self, document, pos, size, tag):
+        self._document = document
+        self._pos = pos
+        self._size = size
+        self._tag = tag
+        self._offsets = None
+        self._tags = None
+        self._children = {}
+
+    def __len__(self):
+        return self._size
+
+    def _index(self):
+        """
+        Records the offset and first object number of every child.
+        """
+        document = self._document
+        offsets = array('q')
+        tags = array('q')
+        pos = self._pos
+        tag = self._tag + 1
+        for i in range(self._size):
+            offsets.append(pos)
+            tags.append(tag)
+            pos, used = document.skip(pos)
+            tag += used
+            pos = self._after_child(pos, i)
+        self._offsets = offsets
+        self._tags = tags
+
+    def _after_child(self, pos, i):
+        return pos
+
+    def _child(self, i):
+        try:
+            return self._children[i]
+        except KeyError:
+            pass
+        if self._offsets is None:
+            self._index()
+        value = self._document.item(self._offsets[i], self._tags[i])
+        self._children[i] = value
+        return value
+
+    def _child_for_tag(self, tag):
+        if self._offsets is None:
+            self._index()
+        return self._child(bisect_right(self._tags, tag) - 1)
+
+
+class LazyArray(_LazyContainer, Sequence):
+    """
+    Read-only, list-like view of a Perl array that decodes its elements on
+    first access.
+    """
+
+    __slots__ = ()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._child(i) for i in range(*index.indices(self._size))]
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError('array index out of range')
+        return self._child(index)
+
+    def __iter__(self):
+        for i in range(self._size):
+            yield self._child(i)
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, tuple, LazyArray)):
+            return NotImplemented
+        return len(self) == len(other) and all(
+            a == b for a, b in zip(self, other))
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<LazyArray of %d items>' % self._size
+
+
+class LazyHash(_LazyContainer, Mapping):
+    """
+    Read-only, dict-like view of a Perl hash that decodes its values on
+    first access. The keys are all read the first time the hash is used.
+    """
+
+    __slots__ = ('_flagged', '_keys')
+
+    def __init__(self, document, pos, size, tag, flagged=False):
+        super(LazyHash, self).__init__(document, pos, size, tag)
+        self._flagged = flagged
+        self._keys = None
+
+    def _index(self):
+        self._keys = {}
+        super(LazyHash, self)._index()
+
+    def _after_child(self, pos, i):
+        buf = self._document.buf
+        if self._flagged:
+            pos += 1  # flags
+        keysize, pos = self._document._read_size(pos)
+        raw = buf[pos:pos + keysize].tobytes()
+        if self._flagged:
+            key = raw or None
+        else:
+            key = _hash_key(raw, self._document.cache)
+        self._keys[key] = i
+        return pos + keysize
+
+    def _key_index(self):
+        if self._keys is None:
+            self._index()
+        return self._keys
+
+    def __getitem__(self, key):
+        return self._child(self._key_index()[key])
+
+    def __contains__(self, key):
+        return key in self._key_index()
+
+    def __iter__(self):
+        return iter(self._key_index())
+
+    def __repr__(self):
+        return '<LazyHash of %d items>' % self._size
+
+
+def materialize(data, memo=None):
+    """
+    Returns *data* with all the lazy proxies in it replaced by lists and
+    dicts. Shared and self-referencing data stays that way. Pass the same
+    *memo* dict to several calls to keep data shared between their results.
+    """
+    memo = {} if memo is None else memo
+    todo = []
+
+    def convert(value):
+        if not isinstance(value, (LazyArray, LazyHash)):
+            return value
+        key = id(value)
+        if key not in memo:
+            memo[key] = [] if isinstance(value, LazyArray) else {}
+            todo.append(value)
+        return memo[key]
+
+    result = convert(data)
+    while todo:
+        value = todo.pop()
+        target = memo[id(value)]
+        if isinstance(value, LazyArray):
+            target.extend(convert(item) for item in value)
+        else:
+            for key in value:
+                target[key] = convert(value[key])
+    return result
+
+
+def thaw(buf, pos=0, lscalar_views=False):
+    """
+    Lazy counterpart of :func:`storable.core.thaw` for the memoryview *buf*.
+    The buffer has to stay alive as long as the returned proxies are used.
+    """
+    return _open(buf, pos, lscalar_views).root
+
+
+def _open(buf, pos, lscalar_views=False):
+    if buf[pos:pos + 4] == b'pst0':
+        pos += 4
+    cache, pos = _read_header(buf, pos)
+    cache['lscalar_views'] = lscalar_views
+    document = _Document(buf, cache)
+    document.root = document.item(pos, 0)
+    return document
@@ -0,0 +1,479 @@
+#
+# License
+#
+# python storable is distributed under the zlib/libpng license, which is OSS
+# (Open Source Software) compliant.
+#
+# Copyright (C) 2009 Tim Aerts
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Tim Aerts <aardbeiplantje@gmail.com>
+#
+
+"""
+Decoding on several cores with a pool of worker processes.
+
+:func:`thaw_parallel` and :func:`retrieve_parallel` spread a batch of
+storables over the workers. The input does not go through pickle: blobs
+are copied once into a :mod:`multiprocessing.shared_memory` block that the
+workers read from, and files are opened by the workers themselves. Only
+the decoded data is sent back, one pickle per chunk of storables.
+
+:func:`thaw_split` and :func:`retrieve_split` do the same for the elements
+of one big top level array or hash (``thaw(..., workers=N)`` and
+``retrieve(..., workers=N)``). The parent scans the element boundaries
+first, cuts the elements into ranges and has the workers decode the ranges,
+then joins the results in order. A back-reference (``SX_OBJECT``) must
+point into the range it is in, so:
+
+* ranges that refer to data in earlier ranges are merged with them and
+  decoded as one,
+* ranges that refer to the top level container itself are decoded in the
+  calling process, while the workers are busy with the rest.
+
+Data that refers across a lot of the elements therefore falls back to
+decoding (most of) it serially. Shared data only stays shared within one
+range; everything that is referred to from elsewhere is in the same range
+by construction.
+"""
+
+from bisect import bisect_right
+import mmap
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+
+from .core import (
+    Decoder,
+    _decode,
+    _hash_key,
+    _read_header,
+    process_item,
+    skip_item,
+    thaw_many,
+)
+from .lazy import _ObjectTable
+
+
+# Batches smaller than this (in bytes) are decoded in the calling process,
+# starting processes and moving the results costs more than it saves.
+MIN_PARALLEL_BYTES = 256 * 1024
+
+# The elements of a top level container are cut into this many ranges per
+# worker, so that workers that are done early can take another one.
+RANGES_PER_WORKER = 4
+
+
+def _attach(name):
+    """
+    Opens the shared memory block *name* created by the parent process,
+    which stays responsible for removing it.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+    # Before Python 3.13, attaching registers the block with the resource
+    # tracker, which would remove it (and warn about a leak) when a worker
+    # that was started before the tracker exits.
+    from multiprocessing import resource_tracker
+    register = resource_tracker.register
+    resource_tracker.register = _ignore
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def _ignore(*args):
+    pass
+
+
+def _share(blobs):
+    """
+    Copies *blobs* into a new shared memory block. Returns the block and
+    the offset of every blob in it, plus the end of the last one.
+    """
+    offsets = [0]
+    for blob in blobs:
+        offsets.append(offsets[-1] + len(blob))
+    block = shared_memory.SharedMemory(create=True, size=max(offsets[-1], 1))
+    buf = block.buf
+    for blob, start, end in zip(blobs, offsets, offsets[1:]):
+        buf[start:end] = blob
+    del buf
+    return block, offsets
+
+
+def _thaw_shared(task):
+    name, offsets = task
+    block = _attach(name)
+    buf = block.buf
+    decode = Decoder().decode
+    results = []
+    try:
+        for start, end in zip(offsets, offsets[1:]):
+            view = buf[start:end]
+            results.append(decode(view))
+            view.release()
+    finally:
+        del buf
+        block.close()
+    return results
+
+
+def _retrieve_files(paths):
+    decode = Decoder().decode
+    results = []
+    for path in paths:
+        with open(path, 'rb') as fh:
+            if os.fstat(fh.fileno()).st_size < 4:
+                results.append(None)
+                continue
+            mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapped)
+        try:
+            results.append(decode(view) if view[:4] == b'pst0' else None)
+        finally:
+            view.release()
+            mapped.close()
+    return results
+
+
+def _chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _chunksize(count, workers, chunksize):
+    if chunksize:
+        return chunksize
+    # a few chunks per worker evens out storables of different sizes
+    return max(1, -(-count // (workers * 4)))
+
+
+def _serial(count, total, workers, pool):
+    if count < 2 or total < MIN_PARALLEL_BYTES:
+        return True
+    return pool is None and workers < 2
+
+
+def _map(function, tasks, workers, pool):
+    if pool is not None:
+        return pool.map(function, tasks)
+    with multiprocessing.Pool(workers) as pool:
+        return pool.map(function, tasks)
+
+
+def thaw_parallel(blobs, workers=None, chunksize=None, pool=None):
+    """
+    Decodes the ``freeze``/``nfreeze`` outputs in *blobs* on *workers*
+    processes (the number of CPUs by default), *chunksize* storables at a
+    time, and returns the results in order. A
+    :class:`multiprocessing.pool.Pool` can be passed in as *pool* to re-use
+    its processes. Small batches are decoded in this process.
+    """
+    blobs = list(blobs)
+    workers = workers or os.cpu_count() or 1
+    total = sum(len(blob) for blob in blobs)
+    if _serial(len(blobs), total, workers, pool):
+        return thaw_many(blobs)
+
+    block, offsets = _share(blobs)
+    try:
+        size = _chunksize(len(blobs), workers, chunksize)
+        tasks = [(block.name, offsets[i:i + size + 1])
+                 for i in range(0, len(blobs), size)]
+        results = []
+        for chunk in _map(_thaw_shared, tasks, workers, pool):
+            results.extend(chunk)
+        return results
+    finally:
+        block.close()
+        block.unlink()
+
+
+def retrieve_parallel(paths, workers=None, chunksize=None, pool=None):
+    """
+    Reads the ``store``/``nstore`` files *paths* like :func:`thaw_parallel`
+    decodes blobs. The workers map the files themselves.
+    """
+    paths = list(paths)
+    workers = workers or os.cpu_count() or 1
+    total = sum(os.path.getsize(path) for path in paths)
+    if _serial(len(paths), total, workers, pool):
+        return _retrieve_files(paths)
+
+    size = _chunksize(len(paths), workers, chunksize)
+    results = []
+    for chunk in _map(_retrieve_files, _chunks(paths, size), workers, pool):
+        results.extend(chunk)
+    return results
+
+
+def _root(buf, pos):
+    """
+    Returns the offset of the header of the storable at *pos*, its decoder
+    cache and the offset of the top level item with any blessing skipped.
+    """
+    if buf[pos:pos + 4] == b'pst0':
+        pos += 4
+    header = pos
+    cache, pos = _read_header(buf, pos)
+    cache['lscalar_views'] = False
+    while True:
+        magic_type = buf[pos]
+        if magic_type == 0x11:
+            # SX_BLESS, which decodes to the plain container
+            end = pos + 2 + buf[pos + 1]
+            cache['classes'].append(buf[pos + 2:end].tobytes())
+            pos = end
+        elif magic_type == 0x12:
+            # SX_IX_BLESS
+            pos += 2
+        else:
+            return header, cache, pos
+
+
+def _scan_ranges(buf, cache, pos, parts):
+    """
+    Cuts the elements of the container at *pos* into about *parts* ranges
+    of similar byte size. Returns the ranges as lists ``[offset, count,
+    tag, classes, root, earliest]``: the offset of the first element, the
+    number of elements, the object number of the first element, the number
+    of class names known before it, whether the elements refer to the
+    container and the earliest object number they refer to in an earlier
+    range (or None).
+    """
+    size_unpack = cache['size_unpack']
+    size_len = cache['size_len']
+    magic_type = buf[pos]
+    flags_len = 1 if magic_type == 0x19 else 0
+    size = size_unpack(buf, pos + 1 + flags_len)[0]
+    pos += 1 + flags_len + size_len
+    limit = max(1, (len(buf) - pos) // parts)
+
+    classes = cache['classes']
+    refs = cache['refs'] = []
+    ranges = []
+    # the container is object number 0, its elements follow
+    tag = 1
+    start = pos
+    start_tag = tag
+    start_classes = len(classes)
+    count = 0
+    for i in range(size):
+        pos, used = skip_item(buf, pos, cache)
+        if magic_type != 0x02:
+            pos += flags_len + size_len + size_unpack(buf, pos + flags_len)[0]
+        tag += used
+        count += 1
+        if pos - start >= limit or i == size - 1:
+            earlier = [ref for ref in refs if 0 < ref < start_tag]
+            ranges.append([start, count, start_tag, start_classes,
+                           0 in refs, min(earlier) if earlier else None])
+            del refs[:]
+            start = pos
+            start_tag = tag
+            start_classes = len(classes)
+            count = 0
+    del cache['refs']
+    return ranges
+
+
+def _group_ranges(ranges):
+    """
+    Merges every range that refers into an earlier range with it and all
+    the ranges in between. Returns ``[first, last, root]`` lists of range
+    numbers, where *root* is set if the group refers to the container.
+    """
+    tags = [item[2] for item in ranges]
+    groups = []
+    for i, item in enumerate(ranges):
+        group = [i, i, item[4]]
+        if item[5] is not None:
+            first = bisect_right(tags, item[5]) - 1
+            while groups and groups[-1][1] >= first:
+                merged = groups.pop()
+                group[0] = merged[0]
+                group[2] = group[2] or merged[2]
+        groups.append(group)
+    return groups
+
+
+def _outside(tag):
+    raise ValueError('Object %d is outside of the decoded range' % tag)
+
+
+def _decode_range(buf, header, pos, count, tag, classes, kind, resolve):
+    """
+    Decodes *count* elements of a container of opcode *kind*, starting at
+    *pos* with object number *tag*. Returns the elements, or ``(key,
+    value)`` tuples for hashes.
+    """
+    cache = _read_header(buf, header)[0]
+    cache['lscalar_views'] = False
+    cache['classes'] = list(classes)
+    cache['objects'] = _ObjectTable(resolve, tag)
+    size_unpack = cache['size_unpack']
+    size_len = cache['size_len']
+    flagged = kind == 0x19
+    flags_len = 1 if flagged else 0
+    values = []
+    for _ in range(count):
+        value, pos = process_item(buf, pos, cache)
+        if kind == 0x02:
+            values.append(value)
+            continue
+        keysize = size_unpack(buf, pos + flags_len)[0]
+        pos += flags_len + size_len
+        raw = buf[pos:pos + keysize].tobytes()
+        pos += keysize
+        if flagged:
+            values.append((raw or None, value))
+        else:
+            values.append((_hash_key(raw, cache), value))
+    return values
+
+
+def _open_source(source):
+    """
+    Returns a memoryview of the shared memory block or the file *source*
+    refers to, and a function that closes it again.
+    """
+    kind, name = source
+    if kind == 'shm':
+        block = _attach(name)
+        buf = block.buf
+
+        def close():
+            buf.release()
+            block.close()
+    else:
+        with open(name, 'rb') as fh:
+            mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(mapped)
+
+        def close():
+            buf.release()
+            mapped.close()
+    return buf, close
+
+
+def _decode_range_task(task):
+    source, args = task
+    buf, close = _open_source(source)
+    try:
+        return _decode_range(buf, *(args + (_outside,)))
+    finally:
+        close()
+
+
+def _split(buf, source, workers, pool):
+    """
+    Decodes the storable in *buf*, which the workers open from *source*.
+    """
+    header, cache, pos = _root(buf, 0)
+    kind = buf[pos]
+    if (len(buf) < MIN_PARALLEL_BYTES or kind not in (0x02, 0x03, 0x19)
+            or (pool is None and workers < 2)):
+        return _decode(buf, 0)[0]
+
+    ranges = _scan_ranges(buf, cache, pos, workers * RANGES_PER_WORKER)
+    groups = _group_ranges(ranges)
+    if len(groups) < 2:
+        return _decode(buf, 0)[0]
+
+    data = [] if kind == 0x02 else {}
+    classes = cache['classes']
+    tasks = []
+    local = []
+    for first, last, root in groups:
+        offset, count, tag, known = ranges[first][:4]
+        count = sum(item[1] for item in ranges[first:last + 1])
+        args = (header, offset, count, tag, classes[:known], kind)
+        if root:
+            local.append((len(tasks) + len(local), args))
+        else:
+            tasks.append((source, args))
+
+    def resolve(tag):
+        if tag:
+            _outside(tag)
+        return data
+
+    def run(pool):
+        pending = pool.map_async(_decode_range_task, tasks)
+        # ranges that refer to the container are done here meanwhile
+        done = dict((i, _decode_range(buf, *(args + (resolve,))))
+                    for i, args in local)
+        remote = iter(pending.get())
+        return [done[i] if i in done else next(remote)
+                for i in range(len(groups))]
+
+    if pool is None:
+        with multiprocessing.Pool(workers) as pool:
+            results = run(pool)
+    else:
+        results = run(pool)
+    for values in results:
+        if kind == 0x02:
+            data.extend(values)
+        else:
+            data.update(values)
+    return data
+
+
+def thaw_split(frozen_data, workers=None, pool=None):
+    """
+    Decodes the ``freeze``/``nfreeze`` output *frozen_data*, spreading the
+    elements of its top level array or hash over *workers* processes (the
+    number of CPUs by default) or the processes of *pool*. Other and small
+    storables are decoded in this process. See the module documentation
+    for how back-references are handled.
+    """
+    workers = workers or os.cpu_count() or 1
+    buf = memoryview(frozen_data)
+    if len(buf) < MIN_PARALLEL_BYTES or (pool is None and workers < 2):
+        return _decode(buf, 0)[0]
+    block, offsets = _share([frozen_data])
+    try:
+        return _split(buf, ('shm', block.name), workers, pool)
+    finally:
+        buf.release()
+        block.close()
+        block.unlink()
+
+
+def retrieve_split(filepath, workers=None, pool=None):
+    """
+    Reads the ``store``/``nstore`` file *filepath* like :func:`thaw_split`
+    decodes a blob. The file is mapped in every process, not copied.
+    """
+    workers = workers or os.cpu_count() or 1
+    with open(filepath, 'rb') as fh:
+        if os.fstat(fh.fileno()).st_size < 4:
+            return None
+        mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    buf = memoryview(mapped)
+    try:
+        if buf[:4] != b'pst0':
+            return None
+        return _split(buf, ('file', filepath), workers, pool)
+    finally:
+        buf.release()
+        mapped.close()
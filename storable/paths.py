@@ -0,0 +1,298 @@
+#
+# License
+#
+# python storable is distributed under the zlib/libpng license, which is OSS
+# (Open Source Software) compliant.
+#
+# Copyright (C) 2009 Tim Aerts
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Tim Aerts <aardbeiplantje@gmail.com>
+#
+
+"""
+Decoding of selected parts of a storable.
+
+A path is a sequence of steps, one per level of nesting. A step is a hash
+key, an array index, ``'*'`` for every element, or a set of keys/indices.
+Hash keys are compared with the raw key bytes (``1`` and ``'1'`` select the
+same key), so keys that are not selected are never converted.
+
+Everything that is not on the path is skipped over in the byte stream
+without creating Python objects for it. Back-references (``SX_OBJECT``) to
+data outside of the selected part return that data in full.
+"""
+
+from .core import NETTAG, _hash_key, _read_header, process_item, skip_item
+from .lazy import _ObjectTable, _open, materialize
+
+
+WILDCARD = '*'
+
+_MISSING = object()
+
+
+class _Step(object):
+    """
+    A compiled path step: the raw hash keys and array indices it selects,
+    or None for both if it is a wildcard.
+    """
+
+    __slots__ = ('keys', 'indices')
+
+    def __init__(self, step):
+        if isinstance(step, (set, frozenset, list, tuple)):
+            alternatives = step
+        elif isinstance(step, str) and step == WILDCARD:
+            self.keys = self.indices = None
+            return
+        else:
+            alternatives = [step]
+
+        keys = set()
+        indices = set()
+        for alternative in alternatives:
+            if isinstance(alternative, bytes):
+                keys.add(alternative)
+            elif isinstance(alternative, bool):
+                raise TypeError('Invalid path step %r' % (alternative,))
+            elif isinstance(alternative, int):
+                keys.add(str(alternative).encode('ascii'))
+                indices.add(alternative)
+            elif isinstance(alternative, float):
+                keys.add(repr(alternative).encode('ascii'))
+            elif isinstance(alternative, str):
+                keys.add(alternative.encode('utf-8'))
+                if alternative.lstrip('-').isdigit():
+                    indices.add(int(alternative))
+            else:
+                raise TypeError('Invalid path step %r' % (alternative,))
+        self.keys = frozenset(keys)
+        self.indices = frozenset(indices)
+
+
+class _Walker(object):
+
+    def __init__(self, buf, pos=0):
+        self.buf = buf
+        self.start = pos
+        if buf[pos:pos + 4] == b'pst0':
+            pos += 4
+        self.cache, self.root = _read_header(buf, pos)
+        self.cache['lscalar_views'] = False
+        # class names are registered the first time bytes are skipped
+        self.scanned_to = self.root
+        # lazy view of the data, for back-references out of the selection
+        self.document = None
+        self.memo = {}
+
+    def skip(self, pos):
+        end, used = skip_item(
+            self.buf, pos, self.cache, pos >= self.scanned_to)
+        if end > self.scanned_to:
+            self.scanned_to = end
+        return end, used
+
+    def unwrap(self, pos, tag):
+        """
+        Steps over references, blessings and tied wrappers. Returns the
+        offset and object number of the item they wrap.
+        """
+        buf = self.buf
+        while True:
+            magic_type = buf[pos]
+            if magic_type == 0x04 or magic_type == 0x14:
+                # SX_REF, SX_OVERLOAD
+                tag += 1
+                pos += 1
+            elif 0x0b <= magic_type <= 0x0d:
+                # SX_TIED_ARRAY, SX_TIED_HASH, SX_TIED_SCALAR
+                pos += 1
+            elif magic_type == 0x11:
+                # SX_BLESS
+                end = pos + 2 + buf[pos + 1]
+                if pos >= self.scanned_to:
+                    self.cache['classes'].append(buf[pos + 2:end].tobytes())
+                    self.scanned_to = end
+                pos = end
+            elif magic_type == 0x12:
+                # SX_IX_BLESS
+                pos += 2
+            else:
+                return pos, tag
+
+    def decode(self, pos, tag):
+        cache = dict(self.cache, objects=_ObjectTable(self.resolve, tag),
+                     pending=[], stack=[], classes=list(self.cache['classes']))
+        return process_item(self.buf, pos, cache)[0]
+
+    def resolve(self, tag):
+        if self.document is None:
+            self.document = _open(self.buf, self.start)
+        return materialize(self.document.resolve(tag), self.memo)
+
+    def project(self, pos, tag, steps, depth=0):
+        """
+        Returns the part of the item at *pos* selected by ``steps[depth:]``,
+        or _MISSING if nothing of it is, which includes hashes and arrays
+        with no entry left.
+        """
+        if depth == len(steps):
+            return self.decode(pos, tag)
+
+        buf = self.buf
+        cache = self.cache
+        size_unpack = cache['size_unpack']
+        size_len = cache['size_len']
+        pos, tag = self.unwrap(pos, tag)
+        magic_type = buf[pos]
+        if magic_type == 0x00:
+            target = self.resolve(NETTAG.unpack_from(buf, pos + 1)[0])
+            return _project_value(target, steps, depth)
+
+        if magic_type not in (0x02, 0x03, 0x19):
+            # scalars, hooks and tied items are decoded in full
+            return _project_value(self.decode(pos, tag), steps, depth)
+
+        step = steps[depth]
+        tag += 1
+        if magic_type == 0x02:
+            size = size_unpack(buf, pos + 1)[0]
+            pos += 1 + size_len
+            wanted = step.indices
+            if wanted is not None:
+                wanted = set(i + size if i < 0 else i for i in wanted)
+                last = max(wanted) if wanted else -1
+            result = []
+            for i in range(size):
+                if wanted is not None and i > last:
+                    break
+                end, used = self.skip(pos)
+                if wanted is None or i in wanted:
+                    value = self.project(pos, tag, steps, depth + 1)
+                    if value is not _MISSING:
+                        result.append(value)
+                pos = end
+                tag += used
+            return result or _MISSING
+
+        else:
+            flagged = magic_type == 0x19
+            flags_len = 1 if flagged else 0
+            size = size_unpack(buf, pos + 1 + flags_len)[0]
+            pos += 1 + flags_len + size_len
+            wanted = step.keys
+            todo = None if wanted is None else len(wanted)
+            result = {}
+            for _ in range(size):
+                end, used = self.skip(pos)
+                keysize = size_unpack(buf, end + flags_len)[0]
+                key_pos = end + flags_len + size_len
+                key_end = key_pos + keysize
+                raw = buf[key_pos:key_end].tobytes()
+                if wanted is None or raw in wanted:
+                    value = self.project(pos, tag, steps, depth + 1)
+                    if value is not _MISSING:
+                        if flagged:
+                            result[raw or None] = value
+                        else:
+                            result[_hash_key(raw, self.cache)] = value
+                    if todo is not None:
+                        todo -= 1
+                        if not todo:
+                            break
+                pos = key_end
+                tag += used
+            return result or _MISSING
+
+
+def _project_value(value, steps, depth):
+    """
+    Applies ``steps[depth:]`` to data that was already decoded.
+    """
+    if depth == len(steps):
+        return value
+    step = steps[depth]
+    if isinstance(value, list):
+        wanted = step.indices
+        if wanted is not None:
+            wanted = set(i + len(value) if i < 0 else i for i in wanted)
+        result = []
+        for i, item in enumerate(value):
+            if wanted is None or i in wanted:
+                item = _project_value(item, steps, depth + 1)
+                if item is not _MISSING:
+                    result.append(item)
+        return result or _MISSING
+    if isinstance(value, dict):
+        result = {}
+        for key, item in value.items():
+            if isinstance(key, bytes):
+                raw = key
+            elif key is None:
+                raw = b''
+            else:
+                raw = str(key).encode('utf-8')
+            if step.keys is None or raw in step.keys:
+                item = _project_value(item, steps, depth + 1)
+                if item is not _MISSING:
+                    result[key] = item
+        return result or _MISSING
+    return _MISSING
+
+
+def thaw(buf, select, pos=0):
+    """
+    Decodes the part of the storable in the memoryview *buf* selected by
+    the path *select*. Hashes and arrays on the path only keep the selected
+    entries: arrays become lists of the selected elements, in order, and
+    entries where the rest of the path does not match are left out, so a
+    hash or array with nothing selected in it is left out of its parent as
+    well. Returns None if nothing matches at all.
+    """
+    steps = [step if isinstance(step, _Step) else _Step(step)
+             for step in select]
+    walker = _Walker(buf, pos)
+    value = walker.project(walker.root, 0, steps)
+    return None if value is _MISSING else value
+
+
+def get_path(frozen_data, path):
+    """
+    Returns the value found by following *path* (hash keys and array
+    indices, no wildcards) from the top of the storable *frozen_data*.
+    Only that value is decoded. Raises a KeyError if the path does not
+    exist.
+    """
+    steps = []
+    for step in path:
+        step = _Step(step)
+        if step.keys is None or len(step.keys) != 1:
+            raise ValueError('get_path() needs one key or index per step, '
+                             'got %r' % (path,))
+        steps.append(step)
+
+    value = thaw(memoryview(frozen_data), steps)
+    for _ in steps:
+        if not value:
+            raise KeyError(path)
+        if isinstance(value, list):
+            value = value[0]
+        else:
+            value = next(iter(value.values()))
+    return value
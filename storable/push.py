@@ -0,0 +1,372 @@
+#
+# License
+#
+# python storable is distributed under the zlib/libpng license, which is OSS
+# (Open Source Software) compliant.
+#
+# Copyright (C) 2009 Tim Aerts
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Tim Aerts <aardbeiplantje@gmail.com>
+#
+
+
+"""
+A push decoder for storables arriving in pieces, e.g. from a socket.
+
+:class:`PushDecoder` does no I/O of its own. The caller hands it the data as
+it comes in with :meth:`~PushDecoder.feed`, which returns the storables
+that were completed by it. The decoder keeps scanning where the previous
+chunk ended: a partial item is picked up again from its start, everything
+before it is never looked at again. A storable is decoded once all of it
+has arrived.
+
+See :mod:`storable.aio` for the asyncio adapters.
+"""
+
+from struct import error as StructError
+
+from .core import _cached_header, _header_end, process_item
+
+
+_ARRAY = 0
+_HASH = 1
+_FLAG_HASH = 2
+_TIED_KEY = 3
+_TIED_IDX = 4
+_HOOK = 5
+
+# item opcodes with a fixed size, that is the opcode and what follows it,
+# by opcode; the sizes of SX_INTEGER and SX_DOUBLE depend on the header
+_FIXED = {
+    0x00: 5,   # SX_OBJECT
+    0x05: 1,   # SX_UNDEF
+    0x08: 2,   # SX_BYTE
+    0x09: 5,   # SX_NETINT
+    0x0e: 1,   # SX_SV_UNDEF
+    0x0f: 1,   # SX_SV_YES
+    0x10: 1,   # SX_SV_NO
+}
+
+
+class _Short(Exception):
+    """
+    Raised when the data up to the offset in ``args[0]`` is needed but has
+    not arrived yet.
+    """
+
+
+class PushDecoder(object):
+    """
+    Decodes back-to-back storables (``nfreeze``/``freeze`` output, with or
+    without the ``pst0`` file magic) from data that is fed in pieces.
+
+    :attr:`needed` is the least number of bytes that have to be fed before
+    the next storable can possibly be complete, which lets a caller read
+    exactly up to the end of a storable. It counts the smallest possible
+    size of the elements that are still to come in the arrays and hashes
+    being read, so that large containers are read in few steps.
+
+    With *raw*, :meth:`feed` returns the bytes of the complete storables
+    (without the ``pst0`` magic) instead of decoding them.
+    """
+
+    def __init__(self, raw=False):
+        self.raw = raw
+        self.needed = 1
+        self._buffer = bytearray()
+        self._configs = {}
+        self._start_frame(0)
+
+    def _start_frame(self, start):
+        # offset of the storable, of its first item and of the scan
+        self._start = start
+        self._header = None
+        self._first = None
+        self._pos = None
+        self._stack = []
+        # whether the item before _pos is complete and the frames on the
+        # stack are to be checked
+        self._closing = False
+        self._config = None
+
+    def feed(self, data):
+        """
+        Adds the bytes *data* and returns a list of the storables that are
+        now complete, decoded.
+        """
+        buffer = self._buffer
+        buffer += data
+        results = []
+        while True:
+            try:
+                end = self._scan()
+            except _Short as short:
+                self.needed = short.args[0] - len(buffer) + self._rest()
+                break
+            results.append(self._decode())
+            self._start_frame(end)
+            if end == len(buffer):
+                self.needed = 1
+                break
+        if self._start:
+            # drop what was decoded, the offsets are relative to the start
+            shift = self._start
+            del buffer[:shift]
+            self._start = 0
+            if self._header is not None:
+                self._header -= shift
+            if self._first is not None:
+                self._first -= shift
+                self._pos -= shift
+        return results
+
+    def close(self):
+        """
+        Tells the decoder that no more data follows. Raises a ValueError if
+        a storable was only partly received.
+        """
+        if self._buffer:
+            raise ValueError('Storable data is truncated: %d bytes of an '
+                             'incomplete storable are left'
+                             % len(self._buffer))
+
+    def _rest(self):
+        """
+        Returns the least number of bytes the items that follow the current
+        one in the open arrays and hashes take: a byte for every array
+        element, and the value and key length for every hash entry.
+        """
+        size_len = self._config['size_len'] if self._config else 4
+        rest = 0
+        for kind, count in self._stack:
+            if kind == _ARRAY:
+                rest += count - 1
+            elif kind == _HASH:
+                rest += (count - 1) * (1 + size_len)
+            elif kind == _FLAG_HASH:
+                rest += (count - 1) * (2 + size_len)
+        return rest
+
+    def _need(self, end):
+        if end > len(self._buffer):
+            raise _Short(end)
+
+    def _decode(self):
+        if self.raw:
+            return bytes(self._buffer[self._header:self._pos])
+        view = memoryview(self._buffer)
+        try:
+            cache = _cached_header(view, self._header, self._configs)[0]
+            cache['lscalar_views'] = False
+            return process_item(view, self._first, cache)[0]
+        finally:
+            view.release()
+
+    def _scan(self):
+        """
+        Scans on from where the previous call stopped. Returns the end of
+        the storable once it is complete, and raises _Short otherwise.
+        """
+        buf = self._buffer
+        need = self._need
+        if self._first is None:
+            start = self._start
+            need(start + 1)
+            if buf[start] == 0x70:
+                # 'p', which a header never starts with: the pst0 magic
+                need(start + 4)
+                if buf[start:start + 4] != b'pst0':
+                    raise ValueError('Invalid storable magic at offset %d'
+                                     % start)
+                start += 4
+            need(start + 1)
+            if not buf[start] & 1:
+                # native order, the byte order string length follows
+                need(start + 3)
+            need(start + 2)
+            end = _header_end(buf, start)
+            need(end)
+            view = memoryview(buf)
+            try:
+                self._config = _cached_header(view, start, self._configs)[0]
+            finally:
+                view.release()
+            self._header = start
+            self._first = self._pos = end
+
+        config = self._config
+        size_unpack = config['size_unpack']
+        size_len = config['size_len']
+        stack = self._stack
+        pos = self._pos
+        try:
+            while True:
+                if not self._closing:
+                    need(pos + 1)
+                    magic_type = buf[pos]
+                    if magic_type in _FIXED:
+                        end = pos + _FIXED[magic_type]
+                    elif magic_type == 0x0a or magic_type == 0x17:
+                        # SX_SCALAR, SX_UTF8STR
+                        need(pos + 2)
+                        end = pos + 2 + buf[pos + 1]
+                    elif (magic_type == 0x01 or magic_type == 0x18
+                          or magic_type == 0x1e):
+                        # SX_LSCALAR, SX_LUTF8STR, SX_LVSTRING
+                        need(pos + 1 + size_len)
+                        end = pos + 1 + size_len + size_unpack(buf, pos + 1)[0]
+                        if magic_type == 0x1e:
+                            # the scalar it applies to follows
+                            need(end)
+                            pos = end
+                            continue
+                    elif magic_type == 0x1d:
+                        # SX_VSTRING
+                        need(pos + 2)
+                        end = pos + 2 + buf[pos + 1]
+                        need(end)
+                        pos = end
+                        continue
+                    elif magic_type == 0x06:
+                        end = pos + 1 + config['int_len']
+                    elif magic_type == 0x07:
+                        end = pos + 1 + config['double_len']
+                    elif (magic_type == 0x02 or magic_type == 0x03
+                          or magic_type == 0x19):
+                        flags_len = 1 if magic_type == 0x19 else 0
+                        end = pos + 1 + flags_len + size_len
+                        need(end)
+                        size = size_unpack(buf, pos + 1 + flags_len)[0]
+                        pos = end
+                        if size:
+                            if magic_type == 0x02:
+                                stack.append([_ARRAY, size])
+                            elif magic_type == 0x03:
+                                stack.append([_HASH, size])
+                            else:
+                                stack.append([_FLAG_HASH, size])
+                            continue
+                        self._closing = True
+                        end = pos
+                    elif (magic_type == 0x04 or magic_type == 0x14
+                          or 0x0b <= magic_type <= 0x0d):
+                        # references and tied items: the item follows
+                        need(pos + 1)
+                        pos += 1
+                        continue
+                    elif magic_type == 0x11:
+                        # SX_BLESS
+                        need(pos + 2)
+                        end = pos + 2 + buf[pos + 1]
+                        need(end)
+                        pos = end
+                        continue
+                    elif magic_type == 0x12:
+                        # SX_IX_BLESS
+                        need(pos + 2)
+                        pos += 2
+                        continue
+                    elif magic_type == 0x15 or magic_type == 0x16:
+                        # SX_TIED_KEY, SX_TIED_IDX
+                        if magic_type == 0x15:
+                            stack.append([_TIED_KEY, 2])
+                        else:
+                            stack.append([_TIED_IDX, 1])
+                        pos += 1
+                        continue
+                    elif magic_type == 0x13:
+                        # SX_HOOK
+                        need(pos + 2)
+                        flags = buf[pos + 1]
+                        if flags & 0x40:   # SHF_NEED_RECURSE
+                            stack.append([_HOOK, 1])
+                            pos += 2
+                            continue
+                        end = self._hook_end(pos + 2, flags)
+                    else:
+                        raise ValueError('Unknown storable opcode %d at '
+                                         'offset %d' % (magic_type, pos))
+                    need(end)
+                    pos = end
+                    self._closing = True
+
+                # the item before pos is complete
+                if not stack:
+                    return pos
+                frame = stack[-1]
+                kind = frame[0]
+                if kind == _HASH or kind == _FLAG_HASH:
+                    flags_len = 1 if kind == _FLAG_HASH else 0
+                    need(pos + flags_len + size_len)
+                    end = (pos + flags_len + size_len
+                           + size_unpack(buf, pos + flags_len)[0])
+                    need(end)
+                    pos = end
+                elif kind == _TIED_IDX:
+                    need(pos + 4)
+                    pos += 4
+                elif kind == _HOOK:
+                    need(pos + 1)
+                    flags = buf[pos]
+                    if flags & 0x40:   # SHF_NEED_RECURSE
+                        # another sub-object follows
+                        pos += 1
+                        self._closing = False
+                        continue
+                    end = self._hook_end(pos + 1, flags)
+                    need(end)
+                    pos = end
+                frame[1] -= 1
+                if frame[1]:
+                    self._closing = False
+                else:
+                    stack.pop()
+        except StructError:
+            raise ValueError('Invalid storable data at offset %d' % pos)
+        finally:
+            self._pos = pos
+
+    def _hook_end(self, pos, flags):
+        """
+        Returns the end of the SX_HOOK body that starts at *pos*, right
+        after the flags.
+        """
+        buf = self._buffer
+        need = self._need
+        size_unpack = self._config['size_unpack']
+        size_len = self._config['size_len']
+
+        def length(pos, large):
+            if large:
+                need(pos + size_len)
+                return size_unpack(buf, pos)[0], pos + size_len
+            need(pos + 1)
+            return buf[pos], pos + 1
+
+        if flags & 0x20:   # SHF_IDX_CLASSNAME
+            pos += 4 if flags & 0x04 else 1
+        else:
+            size, pos = length(pos, flags & 0x04)   # SHF_LARGE_CLASSLEN
+            pos += size
+        size, pos = length(pos, flags & 0x08)   # SHF_LARGE_STRLEN
+        pos += size
+        if flags & 0x80:   # SHF_HAS_LIST
+            size, pos = length(pos, flags & 0x10)   # SHF_LARGE_LISTLEN
+            pos += 4 * size
+        return pos
@@ -0,0 +1,266 @@
+#
+# License
+#
+# python storable is distributed under the zlib/libpng license, which is OSS
+# (Open Source Software) compliant.
+#
+# Copyright (C) 2009 Tim Aerts
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Tim Aerts <aardbeiplantje@gmail.com>
+#
+
+"""
+Logs of back-to-back storables, as written by calling Perl's ``nstore_fd``
+or printing ``nfreeze`` output for one record after another.
+
+* :func:`iter_records` reads the records from a file, pipe or buffer,
+* :class:`RecordWriter` appends records to a log,
+* :class:`RecordIndex` keeps the offset of every record in a sidecar file
+  (``<log>.ridx``), so that any record can be read without going through
+  the ones before it.
+"""
+
+from array import array
+import os
+import sys
+
+from .core import _cached_header, _header_end, freeze, process_item
+from .events import CHUNK_SIZE, _Stream
+
+
+INDEX_SUFFIX = '.ridx'
+
+# the index is stored little endian
+_SWAP = sys.byteorder != 'little'
+
+
+def _frames(stream):
+    """
+    Yields ``(offset, cache, end)`` for every record in *stream*: the
+    absolute offset of the record, a fresh decoder cache for its header and
+    the end of its top item in the stream window. The stream is positioned
+    at the start of that item.
+    """
+    while stream.fill(1):
+        start = stream.offset + stream.pos
+        if stream.fill(4) >= 4:
+            if stream.view[stream.pos:stream.pos + 4] == b'pst0':
+                stream.pos += 4
+        # make sure the whole header is there, so that a record that is
+        # cut short inside it raises ValueError like one cut short later
+        if not stream.need(1)[stream.pos] & 1:
+            # native order, the byte order string length follows
+            stream.need(3)
+        stream.need(_header_end(stream.view, stream.pos) - stream.pos)
+        cache, stream.pos = _cached_header(stream.view, stream.pos)
+        cache['lscalar_views'] = False
+        end = stream.item_end(cache)[0]
+        yield start, cache, end
+        stream.pos = end
+
+
+def _open_source(source):
+    if isinstance(source, str):
+        return open(source, 'rb'), True
+    return source, False
+
+
+def iter_records(source, offsets=False, chunk_size=CHUNK_SIZE):
+    """
+    Yields the decoded records in *source*: a file name, a binary file
+    handle (which can be a pipe) or a byte buffer. Handles are read in
+    chunks of *chunk_size* bytes. With *offsets*, ``(offset, record)``
+    tuples are yielded instead.
+    """
+    source, close = _open_source(source)
+    stream = _Stream(source, chunk_size)
+    try:
+        for start, cache, end in _frames(stream):
+            record = process_item(stream.view, stream.pos, cache)[0]
+            yield (start, record) if offsets else record
+    finally:
+        stream.close()
+        if close:
+            source.close()
+
+
+class RecordIndex(object):
+    """
+    The offsets of the records in the log file *filepath*, kept in the
+    sidecar file *index_path* (``filepath + '.ridx'`` by default).
+
+    The sidecar holds the start offset of every record followed by the
+    offset up to which the log was indexed. Records appended to the log
+    since are added when the index is opened or :meth:`refresh` is called.
+    Logs are expected to only grow: the index is rebuilt if the log got
+    shorter.
+    """
+
+    def __init__(self, filepath, index_path=None):
+        self.filepath = filepath
+        self.index_path = index_path or filepath + INDEX_SUFFIX
+        self.offsets = array('q')
+        self.end = 0
+        self._fh = None
+        try:
+            self._load()
+        except (IOError, OSError, ValueError):
+            self.offsets = array('q')
+            self.end = 0
+        self.refresh()
+
+    def _load(self):
+        offsets = array('q')
+        with open(self.index_path, 'rb') as fh:
+            offsets.frombytes(fh.read())
+        if not offsets:
+            raise ValueError('Empty record index %s' % self.index_path)
+        if _SWAP:
+            offsets.byteswap()
+        self.end = offsets.pop()
+        self.offsets = offsets
+
+    def save(self):
+        offsets = array('q', self.offsets)
+        offsets.append(self.end)
+        if _SWAP:
+            offsets.byteswap()
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'wb') as fh:
+            fh.write(offsets.tobytes())
+        os.rename(tmp_path, self.index_path)
+
+    def refresh(self):
+        """
+        Indexes the records appended to the log since the index was last
+        updated and saves the index if anything changed.
+        """
+        size = os.path.getsize(self.filepath)
+        if size == self.end:
+            return
+        if size < self.end:
+            self.offsets = array('q')
+            self.end = 0
+        with open(self.filepath, 'rb') as fh:
+            fh.seek(self.end)
+            stream = _Stream(fh, CHUNK_SIZE)
+            stream.offset = self.end
+            try:
+                for start, cache, end in _frames(stream):
+                    self.offsets.append(start)
+                    self.end = stream.offset + end
+            except ValueError:
+                # the last record is still being written
+                pass
+            stream.close()
+        self.save()
+
+    def add(self, offset, end):
+        """
+        Records a record written at *offset*, up to *end*, by this process.
+        """
+        if offset != self.end:
+            self.refresh()
+        else:
+            self.offsets.append(offset)
+            self.end = end
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, n):
+        """
+        Reads and decodes record *n*.
+        """
+        count = len(self.offsets)
+        if n < 0:
+            n += count
+        if not 0 <= n < count:
+            raise IndexError('record index out of range')
+        start = self.offsets[n]
+        end = self.offsets[n + 1] if n + 1 < count else self.end
+        if self._fh is None:
+            self._fh = open(self.filepath, 'rb')
+        self._fh.seek(start)
+        return next(iter_records(self._fh.read(end - start)))
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class RecordWriter(object):
+    """
+    Appends records to the log *file*, a file name or a binary file handle
+    (which is not closed by :meth:`close`). Records are frozen with
+    :func:`storable.freeze`, including the ``pst0`` magic like Perl's
+    ``nstore_fd`` writes it. With *index*, the :class:`RecordIndex` of the
+    log file is kept up to date as well.
+    """
+
+    def __init__(self, file, index=False):
+        if isinstance(file, str):
+            self.fh = open(file, 'ab')
+            self._close = True
+        else:
+            self.fh = file
+            self._close = False
+        self.index = None
+        if index:
+            if not self._close:
+                raise ValueError('An index needs the log file name')
+            self.index = RecordIndex(file)
+
+    def append(self, data):
+        self.append_frozen(freeze(data))
+
+    def append_frozen(self, frozen):
+        """
+        Appends the output of ``freeze``/``nfreeze``/``nstore_fd``.
+        """
+        self.fh.write(frozen)
+        if self.index is not None:
+            self.fh.flush()
+            end = self.fh.tell()
+            self.index.add(end - len(frozen), end)
+
+    def flush(self):
+        self.fh.flush()
+
+    def close(self):
+        if self.index is not None:
+            self.index.save()
+            self.index.close()
+        if self._close:
+            self.fh.close()
+        else:
+            self.fh.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,160 @@
+#
+# License
+#
+# python storable is distributed under the zlib/libpng license, which is OSS
+# (Open Source Software) compliant.
+#
+# Copyright (C) 2009 Tim Aerts
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Tim Aerts <aardbeiplantje@gmail.com>
+#
+
+"""
+Records for hashes that share their keys.
+
+Rows frozen by Perl are mostly arrays of hashes that all have the same keys.
+With ``records=True`` (see :func:`~storable.core.thaw`), every such hash is
+decoded into an instance of a generated class with ``__slots__`` for its
+keys instead of a dict, which takes a fraction of the memory. There is one
+class per order of keys, shared by everything decoded in the process, and
+records keep the keys in that order like the dicts they replace.
+
+Hashes with keys that cannot be attribute names (numbers, keywords, names
+starting with ``__``, ...) stay dicts, and so does every hash once there
+are :data:`SHAPES_MAX` classes.
+"""
+
+from collections.abc import Mapping
+import keyword
+from reprlib import recursive_repr
+
+
+SHAPES_MAX = 1024
+
+# The record class of every order of keys seen so far, None for keys that
+# cannot be a record.
+_classes = {}
+
+_MISSING = object()
+
+
+class Record(Mapping):
+    """
+    Base class of the generated record classes. The values of a hash are
+    attributes of its record, named after the keys. A record is also a
+    read-only :class:`~collections.abc.Mapping` of the keys to the values,
+    so ``record['name']``, ``get()``, ``keys()``, ``items()`` and the like
+    work as on the dict it replaces, and :meth:`_asdict` returns it as one.
+    Keys that are mapping methods (``get``, ``items``, ...) keep the hash a
+    dict.
+    """
+
+    __slots__ = ()
+    _fields = ()
+    _setters = ()
+
+    def __getitem__(self, key):
+        if key in self._fields:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def _asdict(self):
+        return dict((name, getattr(self, name)) for name in self._fields)
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            other = other._asdict()
+        elif not isinstance(other, Mapping):
+            return NotImplemented
+        return self._asdict() == dict(other)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    @recursive_repr()
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(
+            '%s=%r' % (name, getattr(self, name)) for name in self._fields))
+
+    def __reduce__(self):
+        return _rebuild, (self._fields, [getattr(self, name)
+                                         for name in self._fields])
+
+
+def _valid(name):
+    return (isinstance(name, str) and name.isidentifier()
+            and not keyword.iskeyword(name) and not name.startswith('__')
+            and not hasattr(Record, name))
+
+
+def record_class(keys):
+    """
+    Returns the record class for a hash with the keys *keys* (a tuple), or
+    None if it stays a dict.
+    """
+    cls = _classes.get(keys, _MISSING)
+    if cls is not _MISSING:
+        return cls
+    if len(_classes) >= SHAPES_MAX:
+        return None
+    cls = None
+    if all(_valid(name) for name in keys):
+        cls = type(str('Record'), (Record,), {
+            '__slots__': keys,
+            '_fields': keys,
+        })
+        cls._setters = tuple(cls.__dict__[name].__set__ for name in keys)
+    _classes[keys] = cls
+    return cls
+
+
+def make_record(data):
+    """
+    Returns the dict *data* as a record, or *data* itself if it stays a
+    dict.
+    """
+    cls = record_class(tuple(data))
+    if cls is None:
+        return data
+    record = cls.__new__(cls)
+    for name, setter in zip(cls._fields, cls._setters):
+        setter(record, data[name])
+    return record
+
+
+def _rebuild(fields, values):
+    cls = record_class(fields)
+    if cls is None:
+        return dict(zip(fields, values))
+    record = cls.__new__(cls)
+    for setter, value in zip(cls._setters, values):
+        setter(record, value)
+    return record
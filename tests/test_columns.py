@@ -0,0 +1,98 @@
+from array import array as typed_array
+from struct import pack
+import glob
+import tempfile
+import unittest
+
+import storable
+
+from test_decoder import NETORDER_HEADER, array, backref, hash_, ref, scalar
+
+
+def double(value):
+    return b'\x07' + pack('!d', value)
+
+
+# 0: hash, 1: 'x', 2: ref, 3: rows, 4: ref, 5: first row, ...
+ROWS = NETORDER_HEADER + hash_(meta=scalar(b'x'), rows=ref(array(
+    ref(hash_(id=scalar(b'1'), name=scalar(b'a'), score=double(1.5))),
+    ref(hash_(name=scalar(b'b'), id=scalar(b'2'))),
+    ref(hash_(id=scalar(b'3'), tags=ref(array(scalar(b'q'))),
+              score=b'\x05')),
+    backref(5),
+)))
+
+
+class TestColumns(unittest.TestCase):
+
+    def test_columns(self):
+        columns = storable.thaw_columns(ROWS, path=['rows'])
+        self.assertEqual(columns, {
+            'id': typed_array('q', [1, 2, 3, 1]),
+            'name': ['a', 'b', None, 'a'],
+            'score': [1.5, None, None, 1.5],
+            'tags': [None, None, ['q'], None],
+        })
+
+    def test_missing(self):
+        columns = storable.thaw_columns(ROWS, path=['rows'], missing=-1.0,
+                                        numeric_arrays='array')
+        self.assertEqual(columns['score'],
+                         typed_array('d', [1.5, -1.0, -1.0, 1.5]))
+        self.assertEqual(columns['name'], ['a', 'b', -1.0, 'a'])
+
+    def test_unpacked(self):
+        columns = storable.thaw_columns(ROWS, path=['rows'],
+                                        numeric_arrays=None)
+        self.assertEqual(columns['id'], [1, 2, 3, 1])
+
+    def test_batches(self):
+        batches = list(storable.iter_columns(ROWS, path=['rows'],
+                                             batch_size=2))
+        self.assertEqual(len(batches), 2)
+        self.assertEqual(batches[0]['name'], ['a', 'b'])
+        self.assertEqual(sorted(batches[1]), ['id', 'name', 'score', 'tags'])
+        self.assertEqual(list(batches[1]['id']), [3, 1])
+
+    def test_path_through_backref(self):
+        blob = NETORDER_HEADER + array(
+            ref(array(ref(hash_(a=scalar(b'1'))))), ref(backref(2)))
+        self.assertEqual(storable.thaw_columns(blob, path=[-1]),
+                         {'a': typed_array('q', [1])})
+
+    def test_bad_paths(self):
+        with self.assertRaises(KeyError):
+            storable.thaw_columns(ROWS, path=['nope'])
+        with self.assertRaises(ValueError):
+            storable.thaw_columns(ROWS, path=['meta'])
+        with self.assertRaises(ValueError):
+            storable.thaw_columns(ROWS, path=['*'])
+
+    def test_retrieve(self):
+        with tempfile.NamedTemporaryFile(suffix='.storable') as fh:
+            fh.write(b'pst0' + ROWS)
+            fh.flush()
+            self.assertEqual(
+                storable.retrieve_columns(fh.name, path=['rows']),
+                storable.thaw_columns(ROWS, path=['rows']))
+            batches = storable.retrieve_columns(fh.name, path=['rows'],
+                                                batch_size=3)
+            self.assertEqual([len(batch['name']) for batch in batches],
+                             [3, 1])
+
+    def test_same_values_as_thaw(self):
+        for infile in glob.glob('tests/resources/*/*/*freeze.storable'):
+            with open(infile, 'rb') as fh:
+                blob = fh.read()
+            data = storable.thaw(blob)
+            if not (isinstance(data, list) and data and all(
+                    isinstance(row, dict) for row in data)):
+                continue
+            columns = storable.thaw_columns(blob, numeric_arrays=None)
+            for i, row in enumerate(data):
+                for key, value in row.items():
+                    self.assertEqual(repr(columns[key][i]), repr(value))
+
+
+if __name__ == '__main__':
+    unittest.main()
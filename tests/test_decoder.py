@@ -0,0 +1,409 @@
+from array import array as typed_array
+from struct import pack
+import glob
+import io
+import os
+import sys
+import tempfile
+import unittest
+
+import storable
+
+
+NETORDER_HEADER = b'\x05\x0b'
+
+
+def array(*items):
+    return b'\x02' + pack('!I', len(items)) + b''.join(items)
+
+
+def ref(item):
+    return b'\x04' + item
+
+
+def scalar(value):
+    return b'\x0a' + pack('B', len(value)) + value
+
+
+def hash_(**items):
+    blob = b'\x03' + pack('!I', len(items))
+    for key, value in items.items():
+        key = key.encode('ascii')
+        blob += value + pack('!I', len(key)) + key
+    return blob
+
+
+def backref(tag):
+    return b'\x00' + pack('!I', tag)
+
+
+class TestDeepNesting(unittest.TestCase):
+
+    def test_nesting_deeper_than_recursion_limit(self):
+        depth = sys.getrecursionlimit() * 10
+        blob = NETORDER_HEADER + (b'\x04\x02' + pack('!I', 1)) * depth
+        blob += scalar(b'leaf')
+
+        data = storable.thaw(blob)
+        for _ in range(depth):
+            self.assertEqual(len(data), 1)
+            data = data[0]
+        self.assertEqual(data, 'leaf')
+
+    def test_deep_hash_chain(self):
+        depth = sys.getrecursionlimit() * 10
+        blob = NETORDER_HEADER
+        blob += (b'\x04\x03' + pack('!I', 1)) * depth
+        blob += scalar(b'leaf')
+        blob += (pack('!I', 4) + b'next') * depth
+
+        data = storable.thaw(blob)
+        for _ in range(depth):
+            data = data['next']
+        self.assertEqual(data, 'leaf')
+
+    def test_siblings_after_nested_containers(self):
+        blob = NETORDER_HEADER + array(
+            ref(array(scalar(b'a'), ref(array()))),
+            scalar(b'b'),
+            ref(array(ref(array(scalar(b'c'))))),
+        )
+        self.assertEqual(storable.thaw(blob), [['a', []], 'b', [['c']]])
+
+
+class TestBackReferences(unittest.TestCase):
+
+    def test_self_referencing_array(self):
+        # 0: outer array, 1: 'yy', 2: the ref, pointing back to 0
+        blob = NETORDER_HEADER + array(scalar(b'yy'), ref(backref(0)))
+        data = storable.thaw(blob)
+        self.assertEqual(data[0], 'yy')
+        self.assertIs(data[1], data)
+
+    def test_shared_substructure(self):
+        # 0: outer array, 1: ref, 2: inner array, 3: 'x', 4: ref to 2
+        blob = NETORDER_HEADER + array(
+            ref(array(scalar(b'x'))), ref(backref(2)), backref(1))
+        data = storable.thaw(blob)
+        self.assertEqual(data[0], ['x'])
+        self.assertIs(data[0], data[1])
+        self.assertIs(data[0], data[2])
+
+    def test_cycle_through_incomplete_hash(self):
+        # 0: hash, 1: ref, 2: inner hash, 3: ref back to the outer hash
+        blob = NETORDER_HEADER + hash_(
+            child=ref(hash_(parent=ref(backref(0)))),
+            name=scalar(b'root'),
+        )
+        data = storable.thaw(blob)
+        self.assertIs(data['child']['parent'], data)
+        self.assertEqual(data['name'], 'root')
+
+    def test_backref_in_deep_nesting(self):
+        depth = sys.getrecursionlimit() * 10
+        blob = NETORDER_HEADER + (b'\x04\x02' + pack('!I', 1)) * depth
+        blob += backref(0)
+        data = storable.thaw(blob)
+        inner = data
+        for _ in range(depth - 1):
+            inner = inner[0]
+        self.assertIs(inner[0], data)
+
+
+class TestDecoder(unittest.TestCase):
+
+    files = glob.glob('tests/resources/*/*/*freeze.storable')
+
+    def blobs(self):
+        for infile in self.files:
+            with open(infile, 'rb') as fh:
+                yield fh.read()
+
+    def test_same_result_as_thaw(self):
+        expected = [repr(storable.thaw(blob)) for blob in self.blobs()]
+        self.assertEqual([repr(data) for data in storable.thaw_many(
+            self.blobs())], expected)
+        results = storable.thaw_many(self.blobs(), generator=True)
+        self.assertFalse(isinstance(results, list))
+        self.assertEqual([repr(data) for data in results], expected)
+
+    def test_header_setup_is_reused(self):
+        decoder = storable.Decoder()
+        for blob in self.blobs():
+            decoder.decode(blob)
+            decoder.decode(b'pst0' + blob)
+        headers = set()
+        for blob in self.blobs():
+            end = 2 if blob[0] & 1 else 2 + 1 + blob[2] + 3 + 1
+            headers.add(blob[:end])
+        self.assertEqual(len(decoder.configs), len(headers))
+
+    def test_state_is_not_shared(self):
+        decoder = storable.Decoder()
+        blob = NETORDER_HEADER + array(ref(array()), ref(backref(2)))
+        first = decoder.decode(blob)
+        second = decoder.decode(blob)
+        self.assertIs(first[0], first[1])
+        self.assertIsNot(first[0], second[0])
+
+
+class TestScalarPolicies(unittest.TestCase):
+
+    values = [b'42', b'007', b'-1.5', b'1.0', b'1e5', b'text', b'inf',
+              b' 12', b'', b'\xe9t\xe9']
+
+    def decode(self, scalars):
+        blob = NETORDER_HEADER + array(
+            *[scalar(value) for value in self.values]
+            + [ref(hash_(**{'1': scalar(b'x')}))])
+        return storable.Decoder(scalars=scalars).decode(blob)
+
+    def test_policies(self):
+        self.assertEqual(self.decode('legacy'), [
+            42, 7, -1.5, '1.0', '1e5', 'text', float('inf'), 12, '',
+            b'\xe9t\xe9', {1: 'x'}])
+        self.assertEqual(self.decode('numeric'), [
+            42, 7, -1.5, '1.0', '1e5', 'text', 'inf', ' 12', '',
+            b'\xe9t\xe9', {1: 'x'}])
+        self.assertEqual(self.decode('str'), [
+            '42', '007', '-1.5', '1.0', '1e5', 'text', 'inf', ' 12', '',
+            b'\xe9t\xe9', {'1': 'x'}])
+        self.assertEqual(self.decode('raw'), self.values + [{b'1': b'x'}])
+
+    def test_numeric_matches_legacy_on_corpus(self):
+        legacy = storable.Decoder()
+        numeric = storable.Decoder(scalars='numeric')
+        for infile in glob.glob('tests/resources/x86_64-linux/*/*.storable'):
+            with open(infile, 'rb') as fh:
+                blob = fh.read()
+            self.assertEqual(repr(numeric.decode(blob)),
+                             repr(legacy.decode(blob)), infile)
+
+    def test_long_digit_strings(self):
+        blob = storable.freeze(['1' * 5000, '9' * 18], pst_prefix=False)
+        self.assertEqual(storable.Decoder(scalars='numeric').decode(blob),
+                         storable.Decoder().decode(blob))
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            storable.Decoder(scalars='fast')
+
+
+class TestKeyInterning(unittest.TestCase):
+
+    blob = NETORDER_HEADER + array(
+        ref(hash_(name=scalar(b'a'), age=scalar(b'1'))),
+        ref(hash_(name=scalar(b'b'), age=scalar(b'2'))),
+    )
+
+    def test_keys_are_shared(self):
+        decoder = storable.Decoder()
+        first = decoder.decode(self.blob)
+        second = decoder.decode(self.blob)
+        self.assertEqual(second, [{'name': 'a', 'age': 1},
+                                  {'name': 'b', 'age': 2}])
+        keys = [key for data in first + second for key in data]
+        for name in ('name', 'age'):
+            shared = [key for key in keys if key == name]
+            self.assertEqual(len(shared), 4)
+            for key in shared:
+                self.assertIs(key, shared[0])
+
+    def test_key_table_is_bounded(self):
+        decoder = storable.Decoder(key_cache=3)
+        blob = NETORDER_HEADER + hash_(**dict(
+            ('k%d' % i, scalar(b'x')) for i in range(10)))
+        data = decoder.decode(blob)
+        self.assertEqual(sorted(data), sorted('k%d' % i for i in range(10)))
+        self.assertLessEqual(len(decoder.keys), 3)
+
+
+class TestScalarCache(unittest.TestCase):
+
+    def test_equal_scalars_are_shared(self):
+        utf8 = b'\x17' + pack('B', 3) + b'\xc3\xa9t'
+        blob = NETORDER_HEADER + array(
+            scalar(b'active'), scalar(b'active'), utf8, utf8,
+            scalar(b'1234'), scalar(b'1234'))
+        dedupe = storable.ScalarCache()
+        data = storable.thaw(blob, dedupe=dedupe)
+        self.assertEqual(data, storable.thaw(blob))
+        for i in (0, 2, 4):
+            self.assertIs(data[i], data[i + 1])
+        stats = dedupe.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (3, 3))
+        self.assertEqual(stats['hit_rate'], 0.5)
+        self.assertEqual(stats['entries'], 3)
+
+    def test_bounds(self):
+        dedupe = storable.ScalarCache(size=2, max_len=4)
+        decoder = storable.Decoder(dedupe=dedupe)
+        long_value = scalar(b'longer')
+        data = decoder.decode(NETORDER_HEADER + array(
+            long_value, long_value, scalar(b'a'), scalar(b'b'),
+            scalar(b'c'), scalar(b'a')))
+        self.assertEqual(data, ['longer', 'longer', 'a', 'b', 'c', 'a'])
+        self.assertIsNot(data[0], data[1])
+        stats = dedupe.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (0, 4))
+        self.assertEqual(stats['entries'], 2)
+
+    def test_retrieve(self):
+        infile = ('tests/resources/x86_64-linux/3.23/'
+                  '026_complex07_3.23_x86_64-linux_nstore.storable')
+        for use_mmap in (False, True):
+            dedupe = storable.ScalarCache()
+            self.assertEqual(
+                repr(storable.retrieve(infile, use_mmap=use_mmap,
+                                       dedupe=dedupe)),
+                repr(storable.retrieve(infile)))
+            self.assertTrue(dedupe.stats()['misses'])
+
+    def test_only_for_full_decodes(self):
+        blob = NETORDER_HEADER + array(scalar(b'a'))
+        options = [{'dedupe': storable.ScalarCache()},
+                   {'numeric_arrays': 'array'}, {'records': True}]
+        for option in options:
+            for other in ({'lazy': True}, {'select': [0]}, {'workers': 2}):
+                with self.assertRaises(ValueError):
+                    storable.thaw(blob, **dict(option, **other))
+            infile = ('tests/resources/x86_64-linux/3.23/'
+                      '026_complex07_3.23_x86_64-linux_nstore.storable')
+            for other in ({'lazy': True}, {'key': 0}, {'workers': 2},
+                          {'lazy': True, 'use_mmap': True}):
+                with self.assertRaises(ValueError):
+                    storable.retrieve(infile, **dict(option, **other))
+
+
+def unpacked(data, seen=None):
+    # the same data with lists in place of array.arrays, cycles included
+    if seen is None:
+        seen = {}
+    if isinstance(data, typed_array):
+        return data.tolist()
+    if id(data) in seen:
+        return seen[id(data)]
+    if isinstance(data, list):
+        result = seen[id(data)] = []
+        result.extend(unpacked(item, seen) for item in data)
+        return result
+    if isinstance(data, dict):
+        result = seen[id(data)] = {}
+        for key, value in data.items():
+            result[key] = unpacked(value, seen)
+        return result
+    return data
+
+
+class TestNumericArrays(unittest.TestCase):
+
+    def byte(self, value):
+        return b'\x08' + pack('B', value + 128)
+
+    def netint(self, value):
+        return b'\x09' + pack('!i', value)
+
+    def double(self, value):
+        return b'\x07' + pack('!d', value)
+
+    def test_arrays(self):
+        blob = NETORDER_HEADER + array(
+            ref(array(self.byte(1), self.byte(-5), self.netint(100000),
+                      self.netint(7), self.byte(3))),
+            ref(array(self.double(1.5), self.double(2.5))),
+            ref(array(self.double(1.5), self.byte(2))),
+            ref(array(self.byte(1), scalar(b'x'))),
+            backref(4),
+        )
+        data = storable.thaw(blob, numeric_arrays='array')
+        self.assertEqual(data[0], typed_array('q', [1, -5, 100000, 7, 3]))
+        self.assertEqual(data[1], typed_array('d', [1.5, 2.5]))
+        self.assertEqual(data[2:], [[1.5, 2], [1, 'x'], -5])
+
+    def test_long_runs(self):
+        count = storable.core.RUN_MAX * 2 + 10
+        blob = NETORDER_HEADER + array(*(
+            [self.netint(i) for i in range(count)] + [self.byte(-1)]))
+        data = storable.Decoder(numeric_arrays='array').decode(blob)
+        self.assertEqual(data, typed_array('q', list(range(count)) + [-1]))
+
+    def test_same_result_on_corpus(self):
+        for infile in glob.glob('tests/resources/*/*/*freeze.storable'):
+            with open(infile, 'rb') as fh:
+                blob = fh.read()
+            self.assertEqual(
+                repr(unpacked(storable.thaw(blob, numeric_arrays='array'))),
+                repr(storable.thaw(blob)), infile)
+
+    def test_numpy(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest('NumPy is not installed')
+        blob = NETORDER_HEADER + array(self.double(1.5), self.double(2.5))
+        data = storable.thaw(blob, numeric_arrays='numpy')
+        self.assertIsInstance(data, numpy.ndarray)
+        self.assertEqual(data.tolist(), [1.5, 2.5])
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            storable.Decoder(numeric_arrays='list')
+
+
+class TestDeserialize(unittest.TestCase):
+
+    def test_pipe(self):
+        # only the bytes of the storable are read, what follows stays
+        first = storable.freeze({'a': [1, 2]}, pst_prefix=False)
+        second = storable.freeze('next', pst_prefix=False)
+        read_end, write_end = os.pipe()
+        with os.fdopen(read_end, 'rb') as fh:
+            with os.fdopen(write_end, 'wb') as out:
+                out.write(first + second)
+            self.assertEqual(storable.deserialize(fh), {'a': [1, 2]})
+            self.assertEqual(fh.read(), second)
+
+    def test_pipe_truncated(self):
+        read_end, write_end = os.pipe()
+        with os.fdopen(read_end, 'rb') as fh:
+            with os.fdopen(write_end, 'wb') as out:
+                out.write(storable.freeze([1, 2], pst_prefix=False)[:-1])
+            with self.assertRaises(ValueError):
+                storable.deserialize(fh)
+
+    def test_seekable(self):
+        first = storable.freeze({'a': [1, 2]}, pst_prefix=False)
+        fh = io.BytesIO(first + b'rest')
+        self.assertEqual(storable.deserialize(fh), {'a': [1, 2]})
+        self.assertEqual(fh.read(), b'rest')
+
+
+class TestMmapRetrieve(unittest.TestCase):
+
+    files = glob.glob('tests/resources/x86_64-linux/3.23/*_nstore.storable')
+
+    def test_same_result_as_buffered_retrieve(self):
+        for infile in self.files:
+            self.assertEqual(
+                repr(storable.retrieve(infile, use_mmap=True)),
+                repr(storable.retrieve(infile)), infile)
+
+    def test_lscalar_views(self):
+        infile = ('tests/resources/x86_64-linux/3.23/'
+                  '006_large_scalar_3.23_x86_64-linux_nstore.storable')
+        data = storable.retrieve(infile, use_mmap=True, lscalar_views=True)
+        self.assertIsInstance(data, memoryview)
+        self.assertTrue(data.readonly)
+        self.assertEqual(data.tobytes().decode('ascii'),
+                         storable.retrieve(infile))
+
+    def test_not_a_store_file(self):
+        with tempfile.NamedTemporaryFile(suffix='.storable') as fh:
+            self.assertIsNone(storable.retrieve(fh.name, use_mmap=True))
+            fh.write(b'\x05\x0b\x05')
+            fh.flush()
+            self.assertIsNone(storable.retrieve(fh.name, use_mmap=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
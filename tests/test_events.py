@@ -0,0 +1,116 @@
+import glob
+import io
+import unittest
+
+import storable
+from storable import iterparse
+
+from test_decoder import NETORDER_HEADER, array, backref, hash_, ref, scalar
+
+
+def build(events):
+    """
+    Builds the data back from the events, like thaw() would.
+    """
+    stack = []
+    value = None
+    for event, arg in events:
+        if event == 'start_array':
+            stack.append([])
+            continue
+        if event == 'start_hash':
+            stack.append({})
+            continue
+        if event == 'key':
+            stack[-1][arg] = value
+            continue
+        if event == 'end':
+            value = stack.pop()
+        elif event == 'scalar':
+            value = arg
+        elif event == 'bless':
+            continue
+        else:
+            raise AssertionError('unexpected event %r' % event)
+        if stack and isinstance(stack[-1], list):
+            stack[-1].append(value)
+    return value
+
+
+class TestIterparse(unittest.TestCase):
+
+    def test_events(self):
+        blob = NETORDER_HEADER + array(
+            scalar(b'a'),
+            ref(hash_(k=ref(array()))),
+            ref(backref(2)),
+        )
+        self.assertEqual(list(iterparse(blob)), [
+            ('start_array', 3),
+            ('scalar', 'a'),
+            ('start_hash', 1),
+            ('start_array', 0),
+            ('end', None),
+            ('key', 'k'),
+            ('end', None),
+            ('backref', 2),
+            ('end', None),
+        ])
+
+    def test_bless(self):
+        blob = NETORDER_HEADER + array(
+            b'\x11\x03Foo' + array(), b'\x12\x00' + scalar(b'x'))
+        self.assertEqual(list(iterparse(blob)), [
+            ('start_array', 2),
+            ('bless', b'Foo'),
+            ('start_array', 0),
+            ('end', None),
+            ('bless', b'Foo'),
+            ('scalar', 'x'),
+            ('end', None),
+        ])
+
+    def test_same_data_as_thaw(self):
+        for infile in glob.glob('tests/resources/x86_64-linux/*/*.storable'):
+            with open(infile, 'rb') as fh:
+                frozen = fh.read()
+            events = list(iterparse(frozen))
+            if any(event == 'backref' for event, _ in events):
+                continue
+            expected = storable.thaw(frozen[4:] if infile.endswith(
+                'store.storable') else frozen)
+            self.assertEqual(repr(build(events)), repr(expected), infile)
+
+    def test_file_handle(self):
+        for infile in glob.glob('tests/resources/x86_64-linux/3.23/*.storable'):
+            with open(infile, 'rb') as fh:
+                frozen = fh.read()
+                fh.seek(0)
+                self.assertEqual(list(iterparse(fh, chunk_size=3)),
+                                 list(iterparse(frozen)), infile)
+
+    def test_constant_memory(self):
+        with open('tests/large_simple01_nfreeze.storable', 'rb') as fh:
+            frozen = fh.read()
+        fh = io.BytesIO(frozen + b'trailing')
+        depth = records = 0
+        for event, arg in iterparse(fh, chunk_size=1024):
+            if event.startswith('start_'):
+                depth += 1
+                if depth == 2:
+                    records += 1
+            elif event == 'end':
+                depth -= 1
+        self.assertEqual(records, 10000)
+        # the handle is left right after the storable
+        self.assertEqual(fh.read(), b'trailing')
+
+    def test_truncated(self):
+        blob = NETORDER_HEADER + array(scalar(b'abc'), scalar(b'def'))
+        for source in (blob[:-2], io.BytesIO(blob[:-2])):
+            with self.assertRaises(ValueError):
+                list(iterparse(source))
+
+
+if __name__ == '__main__':
+    unittest.main()
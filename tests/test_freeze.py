@@ -0,0 +1,290 @@
+from collections import OrderedDict
+import datetime
+import decimal
+import io
+import os
+import glob
+import socket
+from struct import calcsize
+import sys
+import tempfile
+import threading
+import unittest
+import uuid
+
+import storable
+
+from test_decoder import array, backref, ref
+
+
+class TestFreeze(unittest.TestCase):
+
+    data = {
+        'string': 'text',
+        'empty': '',
+        'long': 'x' * 1000,
+        'unicode': 'été',
+        'bytes': b'\xff\x00',
+        'numbers': [0, 1, -1, 127, -128, 128, -129, 70000, -70000, 2 ** 40,
+                    1.5, 1e20],
+        'nested': {'a': [[], {}], 'b': None},
+    }
+
+    def test_round_trip(self):
+        frozen = storable.freeze(self.data)
+        self.assertEqual(frozen[:4], b'pst0')
+        self.assertEqual(storable.thaw(frozen[4:]), self.data)
+
+    def test_freeze_into(self):
+        frozen = storable.freeze(self.data, pst_prefix=False)
+        buffer = bytearray(b'head')
+        self.assertIs(storable.freeze_into(self.data, buffer,
+                                           pst_prefix=False), buffer)
+        self.assertEqual(bytes(buffer), b'head' + frozen)
+        fh = io.BytesIO()
+        storable.freeze_into(self.data, fh, pst_prefix=False)
+        self.assertEqual(fh.getvalue(), frozen)
+
+    def test_output_is_written_once(self):
+        # every piece is written straight to the buffer as it is produced,
+        # never joined into bigger pieces that are then copied again
+        class Writer(object):
+            def __init__(self):
+                self.pieces = []
+
+            def write(self, piece):
+                self.pieces.append(len(piece))
+
+        count = 4000
+        data = dict(('key%06d' % i, ['v', i]) for i in range(count))
+        writer = Writer()
+        storable.freeze_into(data, writer, pst_prefix=False)
+        self.assertEqual(sum(writer.pieces),
+                         len(storable.freeze(data, pst_prefix=False)))
+        self.assertLessEqual(max(writer.pieces), len('key000000'))
+        self.assertLessEqual(len(writer.pieces), 10 * count)
+
+
+class TestEncoders(unittest.TestCase):
+
+    def setUp(self):
+        encoders = dict(storable.core.encoders)
+
+        def restore():
+            storable.core.encoders.clear()
+            storable.core.encoders.update(encoders)
+            storable.core._dispatch.clear()
+            storable.core._dispatch.update(encoders)
+        self.addCleanup(restore)
+
+    def test_strings(self):
+        self.assertEqual(storable.freeze('abc', pst_prefix=False)[2:],
+                         b'\x0a\x03abc')
+        self.assertEqual(storable.freeze('\x80', pst_prefix=False)[2:],
+                         b'\x17\x02\xc2\x80')
+        self.assertEqual(storable.thaw(storable.freeze('é' * 200)),
+                         'é' * 200)
+
+    def test_subclasses(self):
+        class Text(str):
+            pass
+
+        data = OrderedDict([('a', Text('x')), ('b', True)])
+        self.assertEqual(storable.thaw(storable.freeze(data)),
+                         {'a': 'x', 'b': 1})
+        self.assertIs(storable.core.detect_type(Text('y')),
+                      storable.core.serialize_str)
+        self.assertIs(storable.core._dispatch[Text],
+                      storable.core.serialize_str)
+
+    def test_register_encoder(self):
+        with self.assertRaises(NotImplementedError):
+            storable.freeze(decimal.Decimal('1.5'))
+        storable.register_encoder(decimal.Decimal, str)
+        storable.register_encoder(datetime.date,
+                                  lambda value: value.isoformat())
+        storable.register_encoder(uuid.UUID, lambda value: [str(value)])
+        key = uuid.UUID(int=1)
+        data = [decimal.Decimal('1.5'), datetime.datetime(2020, 1, 2),
+                key, 'after']
+        self.assertEqual(storable.thaw(storable.freeze(data)), [
+            1.5, '2020-01-02T00:00:00', [str(key)], 'after'])
+        # object numbers stay right around converted values
+        shared = []
+        data = [key, shared, shared]
+        data = storable.thaw(storable.freeze(data))
+        self.assertIs(data[1], data[2])
+        # every converted container is its own, not a back-reference to
+        # an earlier one that was freed
+        keys = [uuid.UUID(int=i) for i in range(5)]
+        self.assertEqual(storable.thaw(storable.freeze(keys)),
+                         [[str(k)] for k in keys])
+        storable.register_encoder(uuid.UUID,
+                                  lambda value: {'uuid': str(value)})
+        self.assertEqual(storable.thaw(storable.freeze(keys)),
+                         [{'uuid': str(k)} for k in keys])
+
+
+class TestSharedData(unittest.TestCase):
+
+    def test_backrefs(self):
+        # 0: outer array, 1: ref, 2: inner array, 3: ref to 2
+        inner = []
+        self.assertEqual(
+            storable.freeze([inner, inner], pst_prefix=False),
+            b'\x05\x09' + array(ref(array()), ref(backref(2))))
+
+    def test_shared_data_stays_shared(self):
+        row = {'name': 'x'}
+        data = {'rows': [row] * 1000, 'first': row}
+        frozen = storable.freeze(data)
+        self.assertLess(len(frozen), 1000 * 6 + 100)
+        data = storable.thaw(frozen)
+        self.assertEqual(data['first'], {'name': 'x'})
+        for item in data['rows']:
+            self.assertIs(item, data['first'])
+
+    def test_cycles(self):
+        parent = {'name': 'parent', 'children': []}
+        parent['children'].append({'name': 'child', 'parent': parent})
+        loop = []
+        loop.append(loop)
+        for native in (False, True):
+            data = storable.thaw(storable.freeze([parent, loop],
+                                                 native=native))
+            self.assertIs(data[0]['children'][0]['parent'], data[0])
+            self.assertIs(data[1][0], data[1])
+            data = storable.thaw(storable.freeze(loop, native=native))
+            self.assertIs(data[0], data)
+
+
+class TestNative(unittest.TestCase):
+
+    data = {'small': [0, -128, 127], 'int': [300, -70000, 2 ** 40, -2 ** 63],
+            'huge': 2 ** 70, 'double': [1.5, 1.0, -2.25e300], 'text': 'x'}
+
+    def test_round_trip(self):
+        for version in ((5, 11), (4, 7), (4, 1)):
+            frozen = storable.freeze(self.data, pst_prefix=False,
+                                     version=version, native=True)
+            self.assertEqual(frozen[0], version[0] & ~1)
+            self.assertEqual(frozen[1], version[1])
+            data = storable.thaw(frozen)
+            self.assertEqual(data, self.data)
+            self.assertIs(type(data['double'][1]), float)
+
+    def test_header_matches_perl(self):
+        if (sys.byteorder, calcsize('l'), calcsize('P')) != ('little', 8, 8):
+            self.skipTest('not a 64-bit little endian platform')
+        infile = glob.glob('tests/resources/x86_64-linux/3.23/'
+                           '001_*_store.storable')[0]
+        with open(infile, 'rb') as fh:
+            header = fh.read(4 + 2 + 1 + 8 + 4)
+        self.assertEqual(
+            storable.freeze(None, version=(4, 11), native=True)[:len(header)],
+            header)
+
+    def test_corpus_in_native_order(self):
+        for infile in glob.glob('tests/resources/*/*/*_store.storable'):
+            data = storable.retrieve(infile)
+            fh = io.BytesIO()
+            try:
+                storable.store_fd(data, fh)
+            except NotImplementedError:
+                # v-strings
+                continue
+            fh.seek(0)
+            self.assertEqual(fh.read(4), b'pst0')
+            # the same as what the network order output decodes to
+            self.assertEqual(repr(storable.deserialize(fh)),
+                             repr(storable.thaw(storable.freeze(data))),
+                             infile)
+
+
+class _ShortWrites(object):
+    # a raw file that writes at most 100 bytes per call
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data[:100]))
+        return len(self.chunks[-1])
+
+
+class _WouldBlock(io.RawIOBase):
+    # a non-blocking raw file that takes 1000 bytes and then would block
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if len(self.data) >= 1000:
+            return None
+        size = min(len(data), 1000 - len(self.data))
+        self.data += data[:size]
+        return size
+
+
+class TestStore(unittest.TestCase):
+
+    data = {'rows': [{'id': i, 'name': 'name %d' % i} for i in range(2000)]}
+
+    def test_store_and_nstore(self):
+        for function in (storable.store, storable.nstore):
+            fd, path = tempfile.mkstemp(suffix='.storable')
+            os.close(fd)
+            try:
+                function(self.data, path)
+                self.assertEqual(storable.retrieve(path), self.data)
+            finally:
+                os.unlink(path)
+
+    def test_chunks(self):
+        sizes = []
+        fh = io.BytesIO()
+        write = fh.write
+        fh.write = lambda data: sizes.append(len(data)) or write(data)
+        storable.nstore_fd(self.data, fh, chunk_size=1024)
+        self.assertEqual(fh.getvalue(), storable.freeze(self.data))
+        self.assertGreater(len(sizes), 10)
+        self.assertLess(max(sizes), 1024 + 100)
+
+    def test_short_writes(self):
+        fh = _ShortWrites()
+        storable.nstore_fd(self.data, fh)
+        self.assertEqual(b''.join(fh.chunks), storable.freeze(self.data))
+
+    def test_raw_file_that_would_block(self):
+        fh = _WouldBlock()
+        with self.assertRaises(BlockingIOError) as caught:
+            storable.nstore_fd(self.data, fh, chunk_size=600)
+        # the second chunk was only partly written
+        self.assertTrue(0 < caught.exception.characters_written < 600)
+        self.assertEqual(bytes(fh.data), storable.freeze(self.data)[:1000])
+
+    def test_socket(self):
+        reader, writer = socket.socketpair()
+        received = []
+
+        def receive():
+            while True:
+                data = reader.recv(65536)
+                if not data:
+                    break
+                received.append(data)
+
+        thread = threading.Thread(target=receive)
+        thread.start()
+        try:
+            storable.nstore_fd(self.data, writer)
+        finally:
+            writer.close()
+            thread.join()
+            reader.close()
+        self.assertEqual(storable.thaw(b''.join(received)[4:]), self.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import storable
+from storable.index import StorableIndex, build_index
+from storable.paths import _Walker
+
+from test_decoder import NETORDER_HEADER, array, hash_, ref, scalar
+
+
+class TestOffsetIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def store(self, blob, name='data.storable'):
+        filepath = os.path.join(self.tmpdir, name)
+        with open(filepath, 'wb') as fh:
+            fh.write(b'pst0' + blob)
+        return filepath
+
+    def test_same_result_as_retrieve(self):
+        files = glob.glob('tests/resources/x86_64-linux/3.23/*_nstore.storable')
+        for infile in files:
+            filepath = os.path.join(self.tmpdir, os.path.basename(infile))
+            shutil.copy(infile, filepath)
+            data = storable.retrieve(filepath)
+            if isinstance(data, list):
+                keys = range(len(data))
+            elif isinstance(data, dict):
+                keys = list(data)
+            else:
+                continue
+            if '...' in repr(data):
+                # a reference back to the top is decoded as a copy of it
+                continue
+            build_index(filepath, depth=2)
+            for key in keys:
+                self.assertEqual(
+                    repr(storable.retrieve(filepath, key=key)),
+                    repr(data[key]), (infile, key))
+
+    def test_sidecar_round_trip(self):
+        with open('tests/large_simple01_nfreeze.storable', 'rb') as fh:
+            filepath = self.store(fh.read())
+        index = build_index(filepath)
+        self.assertTrue(os.path.exists(filepath + '.idx'))
+        self.assertEqual(len(index.offsets), 10000)
+
+        loaded = StorableIndex.read(filepath + '.idx')
+        self.assertTrue(loaded.is_valid_for(filepath))
+        for name in ('parents', 'offsets', 'tags', 'opcodes', 'key_ends',
+                     'key_blob'):
+            self.assertEqual(getattr(loaded, name), getattr(index, name))
+        self.assertEqual(storable.retrieve(filepath, key=(-1, 'b')), 'y' * 50)
+
+    def test_nested_keys(self):
+        filepath = self.store(NETORDER_HEADER + hash_(
+            config=ref(hash_(db=ref(hash_(host=scalar(b'db1'))))),
+            list=ref(array(scalar(b'a'), scalar(b'b'))),
+        ))
+        for depth in (0, 1, 3):
+            build_index(filepath, depth=depth)
+            self.assertEqual(
+                storable.retrieve(filepath, key=('config', 'db', 'host')),
+                'db1')
+            self.assertEqual(storable.retrieve(filepath, key=('list', 1)), 'b')
+            self.assertEqual(storable.retrieve(filepath, key='list'),
+                             ['a', 'b'])
+            for key in ('nothing', ('config', 'web'), ('list', 2),
+                        ('list', 0, 'x')):
+                with self.assertRaises(KeyError):
+                    storable.retrieve(filepath, key=key)
+
+    def test_one_pass(self):
+        # no byte of the file is skipped over twice
+        filepath = self.store(NETORDER_HEADER + hash_(
+            config=ref(hash_(db=ref(hash_(host=scalar(b'db1'))))),
+            list=ref(array(scalar(b'a'), scalar(b'b'))),
+        ))
+        skip = _Walker.skip
+        for depth in (0, 1, 2, 3):
+            spans = []
+
+            def recording_skip(walker, pos):
+                end, used = skip(walker, pos)
+                spans.append((pos, end))
+                return end, used
+            with mock.patch.object(_Walker, 'skip', recording_skip):
+                build_index(filepath, depth=depth)
+            spans.sort()
+            for (_, end), (start, _) in zip(spans, spans[1:]):
+                self.assertLessEqual(end, start, depth)
+
+    def test_sidecar_is_built_and_refreshed(self):
+        filepath = self.store(NETORDER_HEADER + hash_(a=scalar(b'old')))
+        self.assertEqual(storable.retrieve(filepath, key='a'), 'old')
+        self.assertTrue(os.path.exists(filepath + '.idx'))
+
+        self.store(NETORDER_HEADER + hash_(a=scalar(b'new value')))
+        self.assertEqual(storable.retrieve(filepath, key='a'), 'new value')
+
+        # same size, different mtime
+        self.store(NETORDER_HEADER + hash_(a=scalar(b'new VALUE')))
+        stat = os.stat(filepath)
+        os.utime(filepath, (stat.st_atime, stat.st_mtime + 10))
+        self.assertEqual(storable.retrieve(filepath, key='a'), 'new VALUE')
+        self.assertTrue(StorableIndex.read(filepath + '.idx')
+                        .is_valid_for(filepath))
+
+
+if __name__ == '__main__':
+    unittest.main()
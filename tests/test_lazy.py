@@ -0,0 +1,84 @@
+import glob
+import unittest
+
+import storable
+from storable.lazy import LazyArray, LazyHash, materialize
+
+from test_decoder import NETORDER_HEADER, array, backref, hash_, ref, scalar
+
+
+class TestLazyThaw(unittest.TestCase):
+
+    def test_same_result_as_thaw(self):
+        files = glob.glob('tests/resources/*/*/*freeze.storable')
+        for infile in files:
+            with open(infile, 'rb') as fh:
+                frozen = fh.read()
+            self.assertEqual(
+                repr(materialize(storable.thaw(frozen, lazy=True))),
+                repr(storable.thaw(frozen)), infile)
+
+    def test_blessed_root(self):
+        # the hook refers to the class name of the root by its index
+        blob = NETORDER_HEADER + b'\x11\x03Foo' + array(
+            b'\x13\x20\x00\x01x')
+        self.assertEqual(materialize(storable.thaw(blob, lazy=True)),
+                         storable.thaw(blob))
+
+    def test_retrieve(self):
+        for infile in glob.glob('tests/resources/x86_64-linux/*/*_nstore.storable'):
+            for use_mmap in (False, True):
+                self.assertEqual(
+                    repr(materialize(storable.retrieve(
+                        infile, use_mmap=use_mmap, lazy=True))),
+                    repr(storable.retrieve(infile)), infile)
+
+    def test_only_accessed_items_are_decoded(self):
+        with open('tests/large_simple01_nfreeze.storable', 'rb') as fh:
+            data = storable.thaw(fh.read(), lazy=True)
+        self.assertIsInstance(data, LazyArray)
+        self.assertEqual(len(data), 10000)
+        row = data[-2]
+        self.assertIsInstance(row, LazyHash)
+        self.assertEqual(row['b'], 'y' * 50)
+        self.assertIs(data[9998], row)
+        self.assertEqual(list(data._children), [9998])
+        self.assertEqual(list(row._children), [1])
+
+    def test_backref_into_undecoded_subtree(self):
+        # 0: outer array, 1: ref, 2: inner array, 3: 'x', 4: ref to 2
+        blob = NETORDER_HEADER + array(
+            ref(array(scalar(b'x'))), ref(backref(2)))
+        data = storable.thaw(blob, lazy=True)
+        shared = data[1]
+        self.assertEqual(list(shared), ['x'])
+        self.assertIs(data[0], shared)
+
+    def test_cycle(self):
+        blob = NETORDER_HEADER + hash_(
+            child=ref(hash_(parent=ref(backref(0)))),
+            name=scalar(b'root'),
+        )
+        data = storable.thaw(blob, lazy=True)
+        self.assertIs(data['child']['parent'], data)
+        self.assertEqual(data['name'], 'root')
+        self.assertEqual(sorted(data), ['child', 'name'])
+
+    def test_sequence_and_mapping_protocols(self):
+        blob = NETORDER_HEADER + hash_(
+            a=ref(array(scalar(b'1'), scalar(b'2'), scalar(b'3'))))
+        data = storable.thaw(blob, lazy=True)
+        self.assertEqual(data, {'a': [1, 2, 3]})
+        self.assertEqual(data.get('b'), None)
+        self.assertIn('a', data)
+        self.assertEqual(data['a'][1:], [2, 3])
+        self.assertEqual(data['a'][-1], 3)
+        self.assertEqual(list(reversed(data['a'])), [3, 2, 1])
+        with self.assertRaises(IndexError):
+            data['a'][3]
+        with self.assertRaises(KeyError):
+            data['b']
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import glob
+import multiprocessing
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+try:
+    from unittest import mock
+except ImportError:  # Python 2
+    import mock
+
+import storable
+from storable import parallel
+
+
+class TestThawParallel(unittest.TestCase):
+
+    def setUp(self):
+        self.files = sorted(glob.glob('tests/resources/x86_64-linux/*/*.storable'))
+        self.blobs = []
+        for infile in self.files:
+            with open(infile, 'rb') as fh:
+                self.blobs.append(fh.read())
+
+    def test_same_result_as_thaw_many(self):
+        with mock.patch.object(parallel, 'MIN_PARALLEL_BYTES', 0):
+            results = parallel.thaw_parallel(self.blobs, workers=2,
+                                             chunksize=50)
+        self.assertEqual(repr(results), repr(storable.thaw_many(self.blobs)))
+
+    def test_retrieve_parallel(self):
+        paths = [infile for infile in self.files
+                 if infile.endswith('store.storable')]
+        with mock.patch.object(parallel, 'MIN_PARALLEL_BYTES', 0):
+            results = parallel.retrieve_parallel(paths, workers=2)
+        self.assertEqual(repr(results),
+                         repr([storable.retrieve(path) for path in paths]))
+
+    def test_small_batches_stay_in_process(self):
+        with mock.patch('multiprocessing.Pool') as pool:
+            results = parallel.thaw_parallel(self.blobs[:10], workers=4)
+            results += parallel.retrieve_parallel(self.files[:1], workers=4)
+        self.assertFalse(pool.called)
+        self.assertEqual(len(results), 11)
+
+
+def _scalar(value):
+    return b'\x0a' + bytes([len(value)]) + value
+
+
+class TestThawSplit(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = multiprocessing.Pool(2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.close()
+        cls.pool.join()
+
+    def setUp(self):
+        patcher = mock.patch.object(parallel, 'MIN_PARALLEL_BYTES', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_large_array(self):
+        with open('tests/large_simple01_nfreeze.storable', 'rb') as fh:
+            frozen = fh.read()
+        self.assertEqual(storable.thaw(frozen, workers=2),
+                         storable.thaw(frozen))
+
+    def test_retrieve_split_same_as_retrieve(self):
+        paths = [infile for infile in glob.glob(
+                 'tests/resources/x86_64-linux/*/*.storable')
+                 if infile.endswith('store.storable')]
+        for path in sorted(paths):
+            self.assertEqual(
+                repr(parallel.retrieve_split(path, pool=self.pool)),
+                repr(storable.retrieve(path)), path)
+
+    def test_retrieve_workers(self):
+        with open('tests/large_simple01_nfreeze.storable', 'rb') as fh:
+            frozen = fh.read()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'large.storable')
+        with open(path, 'wb') as fh:
+            fh.write(b'pst0' + frozen)
+        self.assertEqual(storable.retrieve(path, workers=2),
+                         storable.thaw(frozen))
+
+    def test_back_references(self):
+        # [\{k => 'v0'}, \{k => 'v1'}, ..., with element 60 a reference to
+        # the array itself and element 150 the same hash as element 3
+        tags = []
+        tag = 1
+        body = b''
+        for i in range(200):
+            tags.append(tag)
+            if i == 60:
+                body += b'\x04\x00' + struct.pack('!I', 0)
+                tag += 1
+            elif i == 150:
+                body += b'\x00' + struct.pack('!I', tags[3])
+            else:
+                body += (b'\x04\x03' + struct.pack('!I', 1)
+                         + _scalar(b'v%d' % i) + struct.pack('!I', 1) + b'k')
+                tag += 3
+        frozen = b'\x05\x0b\x02' + struct.pack('!I', 200) + body
+
+        data = parallel.thaw_split(frozen, pool=self.pool)
+        self.assertEqual(len(data), 200)
+        self.assertIs(data[60], data)
+        self.assertIs(data[150], data[3])
+        self.assertEqual(data[199], {'k': 'v199'})
+        self.assertEqual(repr(data), repr(storable.thaw(frozen)))
+
+    def test_ranges_referring_back_are_merged(self):
+        ranges = [[0, 10, 1, 0, False, None],
+                  [10, 10, 11, 0, False, None],
+                  [20, 10, 21, 0, True, None],
+                  [30, 10, 31, 0, False, 12],
+                  [40, 10, 41, 0, False, None]]
+        self.assertEqual(parallel._group_ranges(ranges),
+                         [[0, 0, False], [1, 3, True], [4, 4, False]])
+
+
+if __name__ == '__main__':
+    unittest.main()
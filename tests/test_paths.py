@@ -0,0 +1,101 @@
+import unittest
+
+import storable
+
+from test_decoder import NETORDER_HEADER, array, backref, hash_, ref, scalar
+
+
+USERS = NETORDER_HEADER + hash_(
+    users=ref(hash_(
+        alice=ref(hash_(email=scalar(b'a@example.com'), age=scalar(b'31'))),
+        bob=ref(hash_(email=scalar(b'b@example.com'))),
+        carol=ref(hash_(age=scalar(b'40'))),
+    )),
+    config=ref(hash_(db=ref(hash_(host=scalar(b'db1'), port=scalar(b'5432'))))),
+)
+
+
+class TestSelect(unittest.TestCase):
+
+    def test_wildcard(self):
+        self.assertEqual(
+            storable.thaw(USERS, select=['users', '*', 'email']),
+            {'users': {'alice': {'email': 'a@example.com'},
+                       'bob': {'email': 'b@example.com'}}})
+
+    def test_key_set(self):
+        self.assertEqual(
+            storable.thaw(USERS, select=['users', {'alice', 'carol'}, 'age']),
+            {'users': {'alice': {'age': 31}, 'carol': {'age': 40}}})
+
+    def test_subtree(self):
+        self.assertEqual(
+            storable.thaw(USERS, select=['config']),
+            {'config': {'db': {'host': 'db1', 'port': 5432}}})
+        self.assertIsNone(storable.thaw(USERS, select=['nothing']))
+        self.assertIsNone(storable.thaw(USERS, select=['users', '*', 'x']))
+
+    def test_array_indices(self):
+        blob = NETORDER_HEADER + array(
+            *[ref(hash_(a=scalar(b'%d' % i), b=scalar(b'x'))) for i in range(5)])
+        self.assertEqual(storable.thaw(blob, select=[1, 'a']), [{'a': 1}])
+        self.assertEqual(storable.thaw(blob, select=[-1, 'a']), [{'a': 4}])
+        self.assertEqual(storable.thaw(blob, select=[{0, 3}, 'a']),
+                         [{'a': 0}, {'a': 3}])
+        self.assertIsNone(storable.thaw(blob, select=[7]))
+        self.assertEqual(storable.thaw(blob, select=['*', {'a', 'c'}]),
+                         [{'a': i} for i in range(5)])
+
+    def test_backref_out_of_the_selection(self):
+        # 0: outer array, 1: ref, 2: shared hash, 3: 'v', 4: ref to 2
+        blob = NETORDER_HEADER + array(
+            ref(hash_(k=scalar(b'v'))), ref(backref(2)))
+        self.assertEqual(storable.thaw(blob, select=[1, 'k']), [{'k': 'v'}])
+        self.assertEqual(storable.thaw(blob, select=[1]), [{'k': 'v'}])
+
+    def test_blessed_root(self):
+        with open('tests/resources/x86_64-linux/2.41/'
+                  '033_bless06_2.41_x86_64-linux_nfreeze.storable', 'rb') as fh:
+            frozen = fh.read()
+        data = storable.thaw(frozen)
+        self.assertEqual(storable.thaw(frozen, select=['*']), data)
+        self.assertEqual(storable.thaw(frozen, select=[-1, 1]), [[data[-1][1]]])
+
+    def test_same_result_as_thaw(self):
+        with open('tests/large_simple01_nfreeze.storable', 'rb') as fh:
+            frozen = fh.read()
+        data = storable.thaw(frozen)
+        self.assertEqual(storable.thaw(frozen, select=['*', 'b']),
+                         [{'b': row['b']} for row in data])
+        self.assertEqual(storable.thaw(frozen, select=[{10, 20}]),
+                         [data[10], data[20]])
+
+
+class TestGetPath(unittest.TestCase):
+
+    def test_get_path(self):
+        self.assertEqual(
+            storable.get_path(USERS, ('config', 'db', 'host')), 'db1')
+        self.assertEqual(
+            storable.get_path(USERS, ['config', 'db']),
+            {'host': 'db1', 'port': 5432})
+
+    def test_missing(self):
+        for path in (('config', 'db', 'user'), ('users', 'dave'),
+                     ('config', 'db', 'host', 'x')):
+            with self.assertRaises(KeyError):
+                storable.get_path(USERS, path)
+
+    def test_wildcards_not_allowed(self):
+        with self.assertRaises(ValueError):
+            storable.get_path(USERS, ('users', '*'))
+
+    def test_array_index(self):
+        with open('tests/large_simple01_nfreeze.storable', 'rb') as fh:
+            frozen = fh.read()
+        self.assertEqual(storable.get_path(frozen, (9000, 'a')), 'x' * 100)
+        self.assertEqual(storable.get_path(frozen, (-1, 'b')), 'y' * 50)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,215 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import glob
+import unittest
+try:
+    from unittest import mock
+except ImportError:  # Python 2
+    import mock
+
+import storable
+from storable import aio
+from storable.aio import read_storable, read_storables, thaw_async
+from storable.push import PushDecoder
+
+
+def corpus():
+    files = sorted(glob.glob('tests/resources/x86_64-linux/3.23/*.storable'))
+    blobs = []
+    for infile in files:
+        with open(infile, 'rb') as fh:
+            blobs.append(fh.read())
+    return blobs
+
+
+def thaw(blob):
+    return storable.thaw(blob[4:] if blob[:4] == b'pst0' else blob)
+
+
+class TestPushDecoder(unittest.TestCase):
+
+    def setUp(self):
+        self.blobs = corpus()
+        self.data = b''.join(self.blobs)
+        self.expected = repr([thaw(blob) for blob in self.blobs])
+
+    def test_any_chunk_size(self):
+        for size in (1, 3, 64, 4096, len(self.data)):
+            decoder = PushDecoder()
+            results = []
+            for i in range(0, len(self.data), size):
+                results.extend(decoder.feed(self.data[i:i + size]))
+            decoder.close()
+            self.assertEqual(repr(results), self.expected)
+
+    def test_needed(self):
+        # feeding exactly what is needed ends right at every storable
+        decoder = PushDecoder()
+        pos = 0
+        for blob in self.blobs:
+            end = pos + len(blob)
+            results = []
+            while not results:
+                needed = decoder.needed
+                self.assertLessEqual(pos + needed, end)
+                results = decoder.feed(self.data[pos:pos + needed])
+                pos += needed
+            self.assertEqual(pos, end)
+            self.assertEqual(repr(results), repr([thaw(blob)]))
+
+    def test_raw(self):
+        decoder = PushDecoder(raw=True)
+        self.assertEqual(decoder.feed(b'pst0' + self.data), [
+            blob[4:] if blob[:4] == b'pst0' else blob
+            for blob in [b'pst0' + self.blobs[0]] + self.blobs[1:]])
+
+    def test_truncated(self):
+        decoder = PushDecoder()
+        self.assertEqual(decoder.feed(self.blobs[0][:-1]), [])
+        with self.assertRaises(ValueError):
+            decoder.close()
+
+    def test_large(self):
+        with open('tests/large_simple01_nfreeze.storable', 'rb') as fh:
+            frozen = fh.read()
+        decoder = PushDecoder()
+        results = []
+        for i in range(0, len(frozen), 65536):
+            results.extend(decoder.feed(frozen[i:i + 65536]))
+        self.assertEqual(results, [storable.thaw(frozen)])
+
+
+class TestAsyncio(unittest.TestCase):
+
+    def setUp(self):
+        self.blobs = corpus()[:50]
+        self.expected = [thaw(blob) for blob in self.blobs]
+
+    def test_read_storable(self):
+        async def run():
+            reader = asyncio.StreamReader()
+            reader.feed_data(b''.join(self.blobs[:2]) + b'rest')
+            reader.feed_eof()
+            first = await read_storable(reader)
+            second = await read_storable(reader)
+            return first, second, await reader.read()
+
+        first, second, rest = asyncio.run(run())
+        self.assertEqual(repr([first, second]), repr(self.expected[:2]))
+        self.assertEqual(rest, b'rest')
+
+    def test_read_storable_large(self):
+        # the reads are sized by the elements still to come, not one per
+        # item
+        with open('tests/large_simple01_nfreeze.storable', 'rb') as fh:
+            frozen = fh.read()
+
+        async def run():
+            reader = asyncio.StreamReader()
+            reader.feed_data(frozen + b'rest')
+            reader.feed_eof()
+            sizes = []
+            readexactly = reader.readexactly
+
+            async def counting(size):
+                sizes.append(size)
+                return await readexactly(size)
+            reader.readexactly = counting
+            return await read_storable(reader), sizes, await reader.read()
+
+        data, sizes, rest = asyncio.run(run())
+        self.assertEqual(data, storable.thaw(frozen))
+        self.assertEqual(rest, b'rest')
+        self.assertLess(len(sizes), 2000)
+
+    def test_read_storable_at_eof(self):
+        async def run(data):
+            reader = asyncio.StreamReader()
+            reader.feed_data(data)
+            reader.feed_eof()
+            return await read_storable(reader)
+
+        with self.assertRaises(EOFError):
+            asyncio.run(run(b''))
+        with self.assertRaises(ValueError):
+            asyncio.run(run(self.blobs[0][:-1]))
+
+    def test_slow_peer(self):
+        data = b''.join(self.blobs)
+
+        async def peer(reader):
+            for i in range(0, len(data), 1000):
+                reader.feed_data(data[i:i + 1000])
+                await asyncio.sleep(0)
+            reader.feed_eof()
+
+        async def run():
+            reader = asyncio.StreamReader()
+            ticks = []
+
+            async def ticker():
+                while True:
+                    ticks.append(None)
+                    await asyncio.sleep(0)
+
+            tick = asyncio.ensure_future(ticker())
+            feeding = asyncio.ensure_future(peer(reader))
+            results = [result async for result in read_storables(reader)]
+            await feeding
+            tick.cancel()
+            return results, len(ticks)
+
+        results, ticks = asyncio.run(run())
+        self.assertEqual(repr(results), repr(self.expected))
+        # the loop kept running other tasks while the data trickled in
+        self.assertGreater(ticks, 1)
+
+
+class TestThawAsync(unittest.TestCase):
+
+    def setUp(self):
+        with open('tests/large_simple01_nfreeze.storable', 'rb') as fh:
+            self.frozen = fh.read()
+
+    def test_slices(self):
+        async def run():
+            ticks = []
+
+            async def ticker():
+                while True:
+                    ticks.append(None)
+                    await asyncio.sleep(0)
+
+            tick = asyncio.ensure_future(ticker())
+            await asyncio.sleep(0)
+            data = await thaw_async(self.frozen, slice_ms=1)
+            tick.cancel()
+            return data, len(ticks)
+
+        data, ticks = asyncio.run(run())
+        self.assertEqual(data, storable.thaw(self.frozen))
+        self.assertGreater(ticks, 10)
+
+    def test_corpus(self):
+        async def run(blobs):
+            return [await thaw_async(blob, slice_ms=0) for blob in blobs]
+
+        blobs = corpus()
+        with mock.patch.object(aio, '_FIRST_SLICE', 1):
+            results = asyncio.run(run(blobs))
+        self.assertEqual(repr(results), repr([thaw(blob) for blob in blobs]))
+
+    def test_executor(self):
+        async def run(executor):
+            return await thaw_async(self.frozen, executor=executor,
+                                    executor_threshold=0)
+
+        with ThreadPoolExecutor(1) as executor:
+            with mock.patch.object(aio, 'process_item') as process_item:
+                data = asyncio.run(run(executor))
+        self.assertFalse(process_item.called)
+        self.assertEqual(data, storable.thaw(self.frozen))
+
+
+if __name__ == '__main__':
+    unittest.main()
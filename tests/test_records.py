@@ -0,0 +1,120 @@
+import glob
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import storable
+from storable.records import RecordIndex, RecordWriter, iter_records
+
+
+def corpus():
+    files = sorted(glob.glob('tests/resources/x86_64-linux/3.23/*.storable'))
+    blobs = []
+    for infile in files:
+        with open(infile, 'rb') as fh:
+            blobs.append(fh.read())
+    return blobs
+
+
+def thaw(blob):
+    return storable.thaw(blob[4:] if blob[:4] == b'pst0' else blob)
+
+
+class TestRecordLog(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmpdir, 'records.log')
+        self.blobs = corpus()
+        self.expected = repr([thaw(blob) for blob in self.blobs])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_iter_records(self):
+        data = b''.join(self.blobs)
+        self.assertEqual(repr(list(iter_records(data))), self.expected)
+        self.assertEqual(
+            repr(list(iter_records(io.BytesIO(data), chunk_size=7))),
+            self.expected)
+
+    def test_offsets(self):
+        data = b''.join(self.blobs)
+        offsets = [offset for offset, _ in iter_records(data, offsets=True)]
+        starts = [0]
+        for blob in self.blobs[:-1]:
+            starts.append(starts[-1] + len(blob))
+        self.assertEqual(offsets, starts)
+
+    def test_pipe(self):
+        read_fd, write_fd = os.pipe()
+        data = b''.join(self.blobs[:20])
+        with os.fdopen(write_fd, 'wb') as fh:
+            # fits in the pipe buffer
+            fh.write(data)
+        with os.fdopen(read_fd, 'rb') as fh:
+            records = list(iter_records(fh))
+        self.assertEqual(repr(records),
+                         repr([thaw(blob) for blob in self.blobs[:20]]))
+
+    def test_writer_and_index(self):
+        with RecordWriter(self.log, index=True) as writer:
+            for blob in self.blobs:
+                writer.append_frozen(blob)
+        self.assertEqual(repr(list(iter_records(self.log))), self.expected)
+
+        with RecordIndex(self.log) as index:
+            self.assertEqual(len(index), len(self.blobs))
+            self.assertEqual(repr([index[i] for i in range(len(index))]),
+                             self.expected)
+            self.assertEqual(repr(index[-1]), repr(thaw(self.blobs[-1])))
+            with self.assertRaises(IndexError):
+                index[len(self.blobs)]
+
+    def test_index_follows_the_log(self):
+        half = len(self.blobs) // 2
+        with open(self.log, 'wb') as fh:
+            fh.write(b''.join(self.blobs[:half]))
+        index = RecordIndex(self.log)
+        self.assertEqual(len(index), half)
+
+        # appended by another writer, the last record only partly
+        with open(self.log, 'ab') as fh:
+            fh.write(b''.join(self.blobs[half:]) + self.blobs[0][:-1])
+        index.refresh()
+        self.assertEqual(len(index), len(self.blobs))
+        self.assertEqual(repr(index[half]), repr(thaw(self.blobs[half])))
+
+        # the sidecar is picked up again
+        self.assertEqual(list(RecordIndex(self.log).offsets),
+                         list(index.offsets))
+
+        # a log that got shorter is indexed again
+        with open(self.log, 'wb') as fh:
+            fh.write(self.blobs[1])
+        index = RecordIndex(self.log)
+        self.assertEqual(len(index), 1)
+        self.assertEqual(repr(index[0]), repr(thaw(self.blobs[1])))
+
+    def test_record_cut_short_in_its_header(self):
+        native = storable.freeze([1, 2], native=True)
+        # pst0, then the byte order length, inside the byte order, in the
+        # sizes
+        for cut in (1, 5, 7, 12):
+            with open(self.log, 'wb') as fh:
+                fh.write(self.blobs[1] + native[:cut])
+            index = RecordIndex(self.log)
+            self.assertEqual(list(index.offsets), [0], cut)
+            with open(self.log, 'ab') as fh:
+                fh.write(native[cut:])
+            index.refresh()
+            self.assertEqual(index[1], [1, 2])
+            with RecordWriter(self.log, index=True) as writer:
+                writer.append([3])
+            self.assertEqual(RecordIndex(self.log)[2], [3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import glob
+import pickle
+import unittest
+
+import storable
+from storable.shapes import Record
+
+from test_decoder import NETORDER_HEADER, array, backref, hash_, ref, scalar
+
+
+def as_dicts(data, seen=None):
+    # the same data with dicts in place of records and the keys sorted,
+    # cycles included
+    if seen is None:
+        seen = {}
+    if id(data) in seen:
+        return seen[id(data)]
+    if isinstance(data, list):
+        result = seen[id(data)] = []
+        result.extend(as_dicts(item, seen) for item in data)
+        return result
+    if isinstance(data, (dict, Record)):
+        result = seen[id(data)] = {}
+        for key in sorted(data, key=repr):
+            result[key] = as_dicts(data[key], seen)
+        return result
+    return data
+
+
+class TestRecords(unittest.TestCase):
+
+    def test_rows(self):
+        blob = NETORDER_HEADER + array(
+            ref(hash_(name=scalar(b'a'), id=scalar(b'1'))),
+            ref(hash_(name=scalar(b'b'), id=scalar(b'2'))),
+            ref(hash_(id=scalar(b'3'), name=scalar(b'c'))),
+        )
+        first, second, third = storable.thaw(blob, records=True)
+        self.assertIsInstance(first, Record)
+        self.assertIs(type(first), type(second))
+        self.assertEqual((first.id, first.name), (1, 'a'))
+        self.assertEqual(second['name'], 'b')
+        # the keys stay in the order of the hash
+        self.assertEqual(list(second), ['name', 'id'])
+        self.assertEqual(list(third), ['id', 'name'])
+        self.assertEqual(list(second.items()), [('name', 'b'), ('id', 2)])
+        self.assertEqual(list(second.keys()), ['name', 'id'])
+        self.assertEqual(list(second.values()), ['b', 2])
+        self.assertEqual(second.get('id'), 2)
+        self.assertIsNone(second.get('missing'))
+        self.assertEqual(dict(second), {'id': 2, 'name': 'b'})
+        self.assertEqual(first, {'id': 1, 'name': 'a'})
+        self.assertFalse(hasattr(first, '__dict__'))
+
+    def test_keys_that_are_not_names(self):
+        blob = NETORDER_HEADER + array(
+            ref(hash_(**{'1': scalar(b'a')})),
+            ref(hash_(**{'class': scalar(b'a')})),
+            ref(hash_(**{'with space': scalar(b'a')})),
+            ref(hash_(_asdict=scalar(b'a'))),
+            ref(hash_(items=scalar(b'a'))),
+            ref(hash_(_setters=scalar(b'1'), a=scalar(b'2'))),
+            ref(hash_()),
+        )
+        for data in storable.thaw(blob, records=True):
+            self.assertIsInstance(data, dict)
+
+    def test_shared_and_cyclic_hashes(self):
+        # 0: array, 1: ref, 2: hash, 3: 'x', 4: ref to the hash; 5: ref,
+        # 6: hash referring to itself
+        blob = NETORDER_HEADER + array(
+            ref(hash_(v=scalar(b'x'))),
+            ref(backref(2)),
+            ref(hash_(me=ref(backref(6)))),
+        )
+        data = storable.Decoder(records=True).decode(blob)
+        self.assertIsInstance(data[0], Record)
+        self.assertIs(data[0], data[1])
+        self.assertIsInstance(data[2], dict)
+        self.assertIs(data[2]['me'], data[2])
+
+    def test_pickle(self):
+        blob = NETORDER_HEADER + ref(hash_(v=scalar(b'x')))
+        data = storable.thaw(blob, records=True)
+        copy = pickle.loads(pickle.dumps(data))
+        self.assertIs(type(copy), type(data))
+        self.assertEqual(copy, data)
+
+    def test_same_data_as_dicts_on_corpus(self):
+        for infile in glob.glob('tests/resources/*/*/*freeze.storable'):
+            with open(infile, 'rb') as fh:
+                blob = fh.read()
+            self.assertEqual(
+                repr(as_dicts(storable.thaw(blob, records=True))),
+                repr(as_dicts(storable.thaw(blob))), infile)
+
+
+if __name__ == '__main__':
+    unittest.main()